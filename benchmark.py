@@ -0,0 +1,315 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import radfiles
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional
+from weather import EpWeather, get_alt_az
+from radiance import (IlluData, SkyData, ThreePhaseEngine, annual_illuminance, dc_timestep_pipe, gen_sky_vector_pipe,
+                      drawHotMap3D, rgb_to_lux)
+from rmatrix import read_matrix, write_matrix
+from sky import perez_sky_matrix
+
+# Benchmarks of the pipeline stages with the files of radfiles.
+#
+#   python benchmark.py run                  # all stages, results in .benchmarks/<commit>.json
+#   python benchmark.py run --quick          # small scales only
+#   python benchmark.py compare old.json new.json
+#
+# The Radiance programs are taken from PATH, the stand-ins in standin/ are used
+# when they are missing or with --standin. The repository has no vmx files, so
+# view matrices of the requested sizes are generated.
+
+STANDIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standin")
+RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmarks")
+RADIANCE_PROGRAMS = ["gendaylit", "genskyvec", "gendaymtx", "dctimestep"]
+# sensors x timesteps, the subprocess stages only run the small time scales
+SENSOR_SCALES = [40, 1860]
+TIMESTEP_SCALES = [24, 744, 8760]
+SUBPROCESS_TIMESTEPS = 24
+
+
+@dataclass
+class BenchmarkResult:
+    stage: str
+    sensors: int
+    timesteps: int
+    seconds: float
+    timesteps_per_second: float
+    sensor_hours_per_second: float
+    peak_memory_mb: float
+
+
+class Context:
+
+    def __init__(self, work_dir: str) -> None:
+        """Inputs shared by the stages, built once per run.
+        """
+        self.work_dir = work_dir
+        self.weather = EpWeather(radfiles.CHN_ShanghaiCSWD)
+        self.altitude, self.azimuth = self.weather.get_alt_az()
+        columns = self.weather.columns
+        self.direct = columns["direct_normal_radiation"]
+        self.diffuse = columns["diffuse_horizontal_radiation"]
+        self.dmx = [radfiles.dmx_south, radfiles.dmx_north, radfiles.dmx_east, radfiles.dmx_west]
+        self.vmx = {}
+        self.parse_text = {}
+
+    def view_matrix(self, sensors: int) -> str:
+        """A random vmx with the given number of sensors, shaped like the rcontrib output.
+        """
+        if sensors not in self.vmx:
+            path = os.path.join(self.work_dir, "sensors_%d.vmx" % sensors)
+            view = np.random.default_rng(sensors).random((sensors, 145, 3)) * 1e-3
+            write_matrix(path, view, "float")
+            self.vmx[sensors] = path
+        return self.vmx[sensors]
+
+    def groups(self, sensors: int) -> List[IlluData]:
+        return [IlluData(dmx=dmx, xml=radfiles.xml_angle_null, vmx=self.view_matrix(sensors)) for dmx in self.dmx]
+
+    def daytime(self, timesteps: int) -> np.ndarray:
+        # spread the time-steps over the daylight hours of the year
+        day = np.flatnonzero(self.altitude > 0)
+        return day[np.linspace(0, day.size - 1, min(timesteps, day.size)).astype(int)]
+
+    def sky_data(self, timesteps: int) -> List[SkyData]:
+        return [SkyData(altitude=self.altitude[i], azimuth=self.azimuth[i] - 180.0, direct_normal_irradiance=self.direct[i],
+                        diffusion_horizonttal_irradiance=self.diffuse[i]) for i in self.daytime(timesteps)]
+
+
+def bench_epw_load(context: Context, sensors: int, timesteps: int) -> None:
+    EpWeather(radfiles.CHN_ShanghaiCSWD, use_cache=False)
+
+
+def bench_epw_load_cached(context: Context, sensors: int, timesteps: int) -> None:
+    EpWeather(radfiles.CHN_ShanghaiCSWD)
+
+
+def bench_get_alt_az(context: Context, sensors: int, timesteps: int) -> None:
+    location = context.weather.location
+    data = context.weather.data.iloc[:timesteps]
+    for month, day, hour in zip(data["month"], data["day"], data["hour"]):
+        # hour 24 is 00:00 of the next day, like "EpWeather.get_alt_az"
+        local_time = datetime.datetime(context.weather.year, month, day) + datetime.timedelta(hours=int(hour))
+        get_alt_az(location.longitude, location.latitude, location.elevation, local_time.year, local_time.month,
+                   local_time.day, local_time.hour, 0, 0)
+
+
+def bench_alt_az_array(context: Context, sensors: int, timesteps: int) -> None:
+    context.weather.get_alt_az()
+
+
+def bench_sky_pipe(context: Context, sensors: int, timesteps: int) -> None:
+    for sky_data in context.sky_data(timesteps):
+        gen_sky_vector_pipe(sky_data)
+
+
+def bench_sky_matrix(context: Context, sensors: int, timesteps: int) -> None:
+    index = context.daytime(timesteps)
+    perez_sky_matrix(context.altitude[index], context.azimuth[index] - 180.0, context.direct[index], context.diffuse[index])
+
+
+def bench_dc_timestep_pipe(context: Context, sensors: int, timesteps: int) -> None:
+    groups = context.groups(sensors)
+    for sky_data in context.sky_data(timesteps):
+        for illu_data in groups:
+            dc_timestep_pipe(sky_data, illu_data)
+
+
+def bench_parse(context: Context, sensors: int, timesteps: int) -> None:
+    # dctimestep ascii output, one line per sensor and time-step
+    text = context.parse_text.get(sensors * timesteps)
+    if text is None:
+        text = "\n".join(["0.123456 0.234567 0.345678"] * (sensors * timesteps)).encode("utf-8")
+        context.parse_text[sensors * timesteps] = text
+    read_matrix(io.BytesIO(text))
+
+
+def bench_point_ill_loop(context: Context, sensors: int, timesteps: int) -> None:
+    # the loop of main.py, once per time-step
+    results = np.random.default_rng(0).random((4, sensors, 3))
+    for _ in range(timesteps):
+        point_ill = []
+        for i in range(sensors):
+            sou, nor, eas, wes = results[0][i], results[1][i], results[2][i], results[3][i]
+            point_ill.append(179.0 * (sou[0] + nor[0] + eas[0] + wes[0]) * 0.25 +
+                             (sou[1] + nor[1] + eas[1] + wes[1]) * 0.670 + (sou[2] + nor[2] + eas[2] + wes[2]) * 0.065)
+
+
+def bench_rgb_to_lux(context: Context, sensors: int, timesteps: int) -> None:
+    results = np.random.default_rng(0).random((4, timesteps, sensors, 3))
+    rgb_to_lux(results.sum(axis=0))
+
+
+def bench_draw_hot_map(context: Context, sensors: int, timesteps: int) -> None:
+    # the 31 x 60 grid of main.py
+    lux = np.random.default_rng(0).random(1860) * 2000
+    drawHotMap3D(lux, height=31, weight=60, add=os.path.join(context.work_dir, "hot_map.png"))
+
+
+def bench_annual(context: Context, sensors: int, timesteps: int) -> None:
+    # weather, sun, sky matrix and illuminance of the four window groups
+    weather = EpWeather(radfiles.CHN_ShanghaiCSWD)
+    altitude, azimuth = weather.get_alt_az()
+    index = np.linspace(0, weather.max_len - 1, timesteps).astype(int)
+    columns = weather.columns
+    sky_matrix = perez_sky_matrix(altitude[index], azimuth[index] - 180.0, columns["direct_normal_radiation"][index],
+                                  columns["diffuse_horizontal_radiation"][index])
+    engines = [ThreePhaseEngine(illu_data) for illu_data in context.groups(sensors)]
+    annual_illuminance(engines, sky_matrix)
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable
+    sensor_scales: List[int]
+    timestep_scales: List[int]
+
+
+STAGES = [
+    Stage("epw_load", bench_epw_load, [0], [8760]),
+    Stage("epw_load_cached", bench_epw_load_cached, [0], [8760]),
+    Stage("get_alt_az", bench_get_alt_az, [0], [SUBPROCESS_TIMESTEPS, 744]),
+    Stage("alt_az_array", bench_alt_az_array, [0], [8760]),
+    Stage("sky_pipe", bench_sky_pipe, [0], [SUBPROCESS_TIMESTEPS]),
+    Stage("sky_matrix", bench_sky_matrix, [0], TIMESTEP_SCALES),
+    Stage("dc_timestep_pipe", bench_dc_timestep_pipe, SENSOR_SCALES, [SUBPROCESS_TIMESTEPS]),
+    Stage("parse", bench_parse, SENSOR_SCALES, [SUBPROCESS_TIMESTEPS, 744]),
+    Stage("point_ill_loop", bench_point_ill_loop, SENSOR_SCALES, [SUBPROCESS_TIMESTEPS]),
+    Stage("rgb_to_lux", bench_rgb_to_lux, SENSOR_SCALES, TIMESTEP_SCALES),
+    Stage("draw_hot_map", bench_draw_hot_map, [1860], [1]),
+    Stage("annual", bench_annual, SENSOR_SCALES, TIMESTEP_SCALES),
+]
+
+
+def measure(function: Callable, context: Context, sensors: int, timesteps: int, repeat: int) -> BenchmarkResult:
+    """Best wall time of repeat untraced runs, the peak memory of one more run traced by
+    tracemalloc, which numpy reports to. The allocation hooks slow down the Python
+    stages more than the numpy ones, so they are kept out of the timing.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(context, sensors, timesteps)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(context, sensors, timesteps)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = min(seconds)
+    return BenchmarkResult(function.__name__[len("bench_"):], sensors, timesteps, best, timesteps / best,
+                           sensors * timesteps / best, peak / 1024 ** 2)
+
+
+def use_radiance_programs(standin: bool) -> Dict[str, str]:
+    """Put the stand-ins on PATH when asked to or when Radiance is missing.
+
+    Returns:
+        dict: the program used for every Radiance command.
+    """
+    if standin or any(shutil.which(program) is None for program in RADIANCE_PROGRAMS):
+        os.environ["PATH"] = STANDIN_DIR + os.pathsep + os.environ.get("PATH", "")
+    return {program: shutil.which(program) for program in RADIANCE_PROGRAMS}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def run(stages: Optional[List[str]] = None, quick: bool = False, repeat: int = 3, standin: bool = False,
+        output: Optional[str] = None) -> dict:
+    programs = use_radiance_programs(standin)
+    report = {"commit": git_commit(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": platform.node(),
+              "python": platform.python_version(), "numpy": np.__version__, "cpus": os.cpu_count(),
+              "programs": programs, "results": []}
+    with tempfile.TemporaryDirectory() as work_dir:
+        context = Context(work_dir)
+        for stage in STAGES:
+            if stages and stage.name not in stages:
+                continue
+            sensor_scales = stage.sensor_scales[:1] if quick else stage.sensor_scales
+            timestep_scales = stage.timestep_scales[:1] if quick else stage.timestep_scales
+            for sensors in sensor_scales:
+                for timesteps in timestep_scales:
+                    result = measure(stage.function, context, sensors, timesteps, repeat)
+                    report["results"].append(asdict(result))
+                    print("%-18s sensors %5d timesteps %5d %9.4f s %12.1f steps/s %14.1f sensor-h/s %9.1f MB" % (
+                        stage.name, sensors, timesteps, result.seconds, result.timesteps_per_second,
+                        result.sensor_hours_per_second, result.peak_memory_mb))
+    if output is None:
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        output = os.path.join(RESULT_DIR, "%s.json" % report["commit"])
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print("saved", output)
+    return report
+
+
+def compare(old_path: str, new_path: str, threshold: float = 1.2) -> int:
+    """Compare two result files, a stage is a regression when it got slower than threshold times.
+
+    Returns:
+        int: the number of regressions.
+    """
+    with open(old_path, encoding="utf-8") as file:
+        old = {(r["stage"], r["sensors"], r["timesteps"]): r for r in json.load(file)["results"]}
+    with open(new_path, encoding="utf-8") as file:
+        new = json.load(file)["results"]
+    regressions = 0
+    for result in new:
+        key = (result["stage"], result["sensors"], result["timesteps"])
+        if key not in old:
+            continue
+        ratio = result["seconds"] / old[key]["seconds"]
+        memory = result["peak_memory_mb"] - old[key]["peak_memory_mb"]
+        flag = ""
+        if ratio > threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        print("%-18s sensors %5d timesteps %5d  %9.4f -> %9.4f s  x%.2f  %+8.1f MB %s" % (
+            key + (old[key]["seconds"], result["seconds"], ratio, memory, flag)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks of the daylighting pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--stage", action="append", help="run only these stages")
+    run_parser.add_argument("--quick", action="store_true", help="smallest scale of every stage")
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--standin", action="store_true", help="use the stand-in Radiance programs")
+    run_parser.add_argument("--output", default=None, help="result file, .benchmarks/<commit>.json by default")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.stage, args.quick, args.repeat, args.standin, args.output)
+    else:
+        sys.exit(1 if compare(args.old, args.new, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
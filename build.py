@@ -0,0 +1,410 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import subprocess
+import threading
+import radfiles
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+from cache import file_key
+
+# Make-like generation of the three-phase matrices, the steps of the readme as
+# targets with their input files:
+#
+#   view scene ──── oconv ── scene.oct ─────┬── rcontrib ── vmx/south.vmx
+#   points ─────────────────────────────────┤   ...         vmx/north.vmx ...
+#   daylight scene ─ oconv ── scene_dmx.oct ┬── genklemsamp | rcontrib ── dmx/south.dmx
+#   windows/south.rad ──────────────────────┘   ...                       dmx/north.dmx ...
+#
+# A target is rebuilt when its output is missing or when the content hash of its
+# inputs or its command line changed since the last build. An octree rebuilt
+# with the same content does not make the matrices stale. The facades run at the
+# same time and their rcontrib share the cores with "-n". Outputs are written to
+# a temporary file in the output directory and renamed, so an interrupted build
+# never leaves half a matrix behind.
+
+# replaced by the number of rcontrib processes of a target
+NPROC = "{nproc}"
+# rcontrib options of the view matrices, also of "radiance.view_matrix"
+VIEW_OPTIONS = ("-I+", "-ab", "12", "-ad", "50000", "-lw", "2e-5")
+# rcontrib options of the daylight matrices, those of the readme
+DAYLIGHT_OPTIONS = ("-c", "1000")
+DEFAULT_BUILD_DIR = os.path.join(radfiles.current_dir, "oct")
+STATE_FILE = "build_state.json"
+
+
+class BuildError(RuntimeError):
+
+    def __init__(self, target: str, command: str, returncode: int, stderr: str) -> None:
+        """A target whose command failed, with the command line and its messages.
+        """
+        self.target = target
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr.strip()
+        super().__init__("%s: %s exited with status %d: %s" % (target, command, returncode, self.stderr or "no message"))
+
+
+@dataclass
+class Target:
+    # unique name, e.g. "south.vmx"
+    name: str
+    output: str
+    # commands of a pipeline, the stdout of the last one is the output
+    commands: List[List[str]]
+    # files the output depends on, also the outputs of other targets
+    inputs: List[str] = field(default_factory=list)
+    # file on the stdin of the first command, also an input
+    stdin: Optional[str] = None
+
+    @property
+    def parallel(self) -> bool:
+        return any(NPROC in command for command in self.commands)
+
+    def command_line(self, processes: int = 1) -> List[List[str]]:
+        return [[str(processes) if arg == NPROC else arg for arg in command] for command in self.commands]
+
+
+@dataclass
+class Facade:
+    # name of the outputs, "south" gives vmx/south.vmx and dmx/south.dmx
+    name: str
+    # glow material of the windows in the view scene
+    material: str
+    # rad file of the windows for genklemsamp, only needed by the daylight matrix
+    windows: Optional[str] = None
+    # outward normal of the windows, genklemsamp -vd
+    normal: Optional[Tuple[float, float, float]] = None
+    # Klems bin function of klems_full.cal, kbinN, kbinE, kbinS or kbinW
+    klems_bin: str = "kbinS"
+
+
+@dataclass
+class BuildReport:
+    built: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    # seconds spent on every built target
+    seconds: Dict[str, float] = field(default_factory=dict)
+
+    def report(self) -> str:
+        lines = ["%-16s built %.1f s" % (name, self.seconds[name]) for name in self.built]
+        lines += ["%-16s up to date" % name for name in self.skipped]
+        return "\n".join(lines)
+
+
+def oconv_target(name: str, output: str, scene: Sequence[str]) -> Target:
+    """Freeze the rad files of a scene into an octree, "oconv -f".
+    """
+    return Target(name, output, [["oconv", "-f"] + list(scene)], inputs=list(scene))
+
+
+def view_target(facade: Facade, octree: str, points: str, output: str,
+                options: Sequence[str] = VIEW_OPTIONS) -> Target:
+    """The view matrix of a facade, from the sensor points to the Klems bins of its windows.
+    """
+    command = ["rcontrib", "-n", NPROC, "-f", "klems_full.cal", "-b", facade.klems_bin, "-bn", "Nkbins",
+               "-m", facade.material] + list(options) + [octree]
+    return Target(facade.name + ".vmx", output, [command], inputs=[octree], stdin=points)
+
+
+def daylight_target(facade: Facade, octree: str, output: str, options: Sequence[str] = DAYLIGHT_OPTIONS,
+                    sky_material: str = "sky_glow") -> Target:
+    """The daylight matrix of a facade, from the Klems samples of its windows to the sky patches.
+
+    Raises:
+        ValueError: the facade has no windows or normal.
+    """
+    if facade.windows is None or facade.normal is None:
+        raise ValueError("facade %s needs windows and normal for the daylight matrix" % facade.name)
+    sample = ["genklemsamp", "-vd"] + ["%g" % value for value in facade.normal] + [facade.windows]
+    command = ["rcontrib", "-n", NPROC] + list(options) + ["-e", "MF:4", "-f", "reinhart.cal", "-b", "rbin",
+                                                           "-bn", "Nrbins", "-m", sky_material, "-faf", octree]
+    return Target(facade.name + ".dmx", output, [sample, command], inputs=[facade.windows, octree])
+
+
+def three_phase_targets(view_scene: Sequence[str], daylight_scene: Sequence[str], points: str, facades: Sequence[Facade],
+                        build_dir: str = DEFAULT_BUILD_DIR, vmx_dir: str = radfiles.radfiles_vmx,
+                        dmx_dir: str = radfiles.radfiles_dmx, view_options: Sequence[str] = VIEW_OPTIONS,
+                        daylight_options: Sequence[str] = DAYLIGHT_OPTIONS) -> List[Target]:
+    """The targets of the readme: two octrees, and a view and a daylight matrix per facade.
+
+    Args:
+        view_scene (list[str]): rad files with the windows as glow materials, see the readme.
+        daylight_scene (list[str]): rad files with the sky glow of the daylight matrices.
+        points (str): sensor points and directions, one per line.
+        facades (list[Facade]): the window groups.
+        build_dir (str): directory of the octrees.
+        vmx_dir (str): directory of the view matrices, radfiles/vmx by default.
+        dmx_dir (str): directory of the daylight matrices, radfiles/dmx by default.
+        view_options (list[str]): rcontrib options of the view matrices.
+        daylight_options (list[str]): rcontrib options of the daylight matrices.
+
+    Returns:
+        list[Target]: the targets, see "Build".
+    """
+    view_octree = os.path.join(build_dir, "scene.oct")
+    daylight_octree = os.path.join(build_dir, "scene_dmx.oct")
+    targets = [oconv_target("scene.oct", view_octree, view_scene),
+               oconv_target("scene_dmx.oct", daylight_octree, daylight_scene)]
+    for facade in facades:
+        targets.append(view_target(facade, view_octree, points, os.path.join(vmx_dir, facade.name + ".vmx"), view_options))
+        targets.append(daylight_target(facade, daylight_octree, os.path.join(dmx_dir, facade.name + ".dmx"), daylight_options))
+    return targets
+
+
+class Build:
+
+    def __init__(self, targets: Sequence[Target], state_path: Optional[str] = None, jobs: Optional[int] = None,
+                 processes: Optional[int] = None) -> None:
+        """Build the targets whose inputs changed, the independent ones at the same time.
+
+        Args:
+            targets (list[Target]): the targets, a target depends on those whose output is one of its inputs.
+            state_path (str): json file of the input hashes of the last build, "build_state.json"
+                next to the first output by default.
+            jobs (int): targets run at the same time, os.cpu_count() by default.
+            processes (int): cores shared by the "rcontrib -n" of the running targets, os.cpu_count() by default.
+        """
+        self.targets = {target.name: target for target in targets}
+        if len(self.targets) != len(targets):
+            raise ValueError("target names are not unique")
+        producers = {os.path.abspath(target.output): target.name for target in targets}
+        self.dependencies = {target.name: sorted(set(producers[os.path.abspath(path)] for path in self._inputs(target)
+                                                     if os.path.abspath(path) in producers)) for target in targets}
+        self._check_cycles()
+        if state_path is None:
+            state_path = os.path.join(os.path.dirname(os.path.abspath(targets[0].output)), STATE_FILE)
+        self.state_path = state_path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.processes = processes or os.cpu_count() or 1
+        self.state = {"targets": {}, "files": {}}
+        self.lock = threading.Lock()
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as file:
+                self.state = json.load(file)
+
+    @staticmethod
+    def _inputs(target: Target) -> List[str]:
+        return target.inputs + ([target.stdin] if target.stdin else [])
+
+    def _check_cycles(self) -> None:
+        done, visiting = set(), set()
+
+        def visit(name):
+            if name in visiting:
+                raise ValueError("dependency cycle through %s" % name)
+            if name not in done:
+                visiting.add(name)
+                for dependency in self.dependencies[name]:
+                    visit(dependency)
+                visiting.remove(name)
+                done.add(name)
+
+        for name in self.targets:
+            visit(name)
+
+    def file_hash(self, file_path: str) -> str:
+        """sha1 of a file, only hashed again when its size or modification time changed.
+        """
+        path = os.path.abspath(file_path)
+        stat_key = file_key(path, "stat")
+        with self.lock:
+            known = self.state["files"].get(path)
+        if known is None or known[0] != stat_key:
+            known = [stat_key, file_key(path, "hash")]
+            with self.lock:
+                self.state["files"][path] = known
+        return known[1]
+
+    def signature(self, target: Target) -> str:
+        """Hash of the command line and of the content of the inputs of a target.
+        """
+        digest = hashlib.sha1(json.dumps(target.commands).encode("utf-8"))
+        for path in self._inputs(target):
+            if not os.path.exists(path):
+                raise FileNotFoundError("input %s of %s does not exist" % (path, target.name))
+            digest.update(self.file_hash(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _up_to_date(self, target: Target) -> bool:
+        known = self.state["targets"].get(target.name)
+        return os.path.exists(target.output) and known is not None and \
+            known["signature"] == self.signature(target) and known["output"] == self.file_hash(target.output)
+
+    def _selected(self, names: Optional[Sequence[str]]) -> List[str]:
+        # the targets asked for and everything they depend on, dependencies first
+        order = []
+
+        def visit(name):
+            if name not in order:
+                for dependency in self.dependencies[name]:
+                    visit(dependency)
+                order.append(name)
+
+        for name in (self.targets if names is None else names):
+            visit(name)
+        return order
+
+    def stale(self, names: Optional[Sequence[str]] = None) -> List[str]:
+        """The targets a run would build, like "make -n".
+        """
+        stale = []
+        for name in self._selected(names):
+            target = self.targets[name]
+            if any(dependency in stale for dependency in self.dependencies[name]) or \
+                    any(not os.path.exists(path) for path in self._inputs(target)) or not self._up_to_date(target):
+                stale.append(name)
+        return stale
+
+    def run(self, names: Optional[Sequence[str]] = None, force: bool = False, verbose: bool = True) -> BuildReport:
+        """Build the stale targets.
+
+        Args:
+            names (list[str]): targets to build with their dependencies, all by default.
+            force (bool): build the targets even when they are up to date.
+            verbose (bool): print every target when it starts and ends.
+
+        Raises:
+            BuildError: a command failed, the targets already running are finished first.
+
+        Returns:
+            BuildReport: the targets built and skipped.
+        """
+        report = BuildReport()
+        waiting = self._selected(names)
+        running = {}
+        done = set()
+        error = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while True:
+                # up to date targets are skipped at once, which may make others ready
+                ready = []
+                for name in list(waiting):
+                    if error is not None or len(running) + len(ready) >= self.jobs:
+                        break
+                    if any(dependency not in done for dependency in self.dependencies[name]):
+                        continue
+                    waiting.remove(name)
+                    if not force and self._up_to_date(self.targets[name]):
+                        report.skipped.append(name)
+                        done.add(name)
+                        continue
+                    ready.append(name)
+                # the cores are shared by the rcontrib of the running targets
+                parallel = sum(self.targets[name].parallel for name in list(running.values()) + ready)
+                for name in ready:
+                    target = self.targets[name]
+                    processes = max(1, self.processes // parallel) if target.parallel else 1
+                    if verbose:
+                        print("build %s%s" % (name, " with %d processes" % processes if target.parallel else ""))
+                    running[pool.submit(self._build, target, processes)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        report.seconds[name] = future.result()
+                    except BuildError as exception:
+                        error = error or exception
+                        continue
+                    report.built.append(name)
+                    done.add(name)
+                    if verbose:
+                        print("built %s in %.1f s" % (name, report.seconds[name]))
+                    self._save_state()
+        if error is not None:
+            raise error
+        return report
+
+    def _build(self, target: Target, processes: int) -> float:
+        start = time.perf_counter()
+        directory = os.path.dirname(os.path.abspath(target.output))
+        os.makedirs(directory, exist_ok=True)
+        # the signature is taken before running, a change of the inputs during the build makes it stale again
+        signature = self.signature(target)
+        commands = target.command_line(processes)
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(target.output) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as output, tempfile.TemporaryFile() as errors:
+                stdin = open(target.stdin, "rb") if target.stdin else subprocess.DEVNULL
+                processes_list = []
+                try:
+                    for index, command in enumerate(commands):
+                        last = index == len(commands) - 1
+                        source = stdin if index == 0 else processes_list[-1].stdout
+                        # stderr goes to a file, it can not fill a pipe and stall the pipeline
+                        process = subprocess.Popen(command, stdin=source, stdout=output if last else subprocess.PIPE,
+                                                   stderr=errors)
+                        if index > 0:
+                            processes_list[-1].stdout.close()
+                        processes_list.append(process)
+                finally:
+                    if target.stdin:
+                        stdin.close()
+                for command, process in zip(commands, processes_list):
+                    if process.wait() != 0:
+                        errors.seek(0)
+                        raise BuildError(target.name, " ".join(command), process.returncode,
+                                         errors.read().decode("utf-8", errors="ignore"))
+            os.replace(temp_path, target.output)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        output_hash = self.file_hash(target.output)
+        with self.lock:
+            self.state["targets"][target.name] = {"signature": signature, "output": output_hash, "commands": commands}
+        return time.perf_counter() - start
+
+    def _save_state(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w", encoding="utf-8") as file, self.lock:
+            json.dump(self.state, file, indent=1)
+        os.replace(temp_path, self.state_path)
+
+
+def build_test():
+    # python stands in for oconv and rcontrib, the graph is that of "three_phase_targets"
+    directory = tempfile.mkdtemp()
+    scene = os.path.join(directory, "scene.rad")
+    with open(scene, "w") as file:
+        file.write("void glow windowglow\n0\n0\n4 1 1 1 0\n")
+    concat = [sys.executable, "-c", "import sys; [sys.stdout.write(open(p).read()) for p in sys.argv[1:]]"]
+    upper = [sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read().upper())"]
+    octree = os.path.join(directory, "scene.oct")
+    targets = [Target("scene.oct", octree, [concat + [scene]], inputs=[scene])]
+    for name in ("south", "north"):
+        targets.append(Target(name + ".vmx", os.path.join(directory, "vmx", name + ".vmx"), [concat + [octree], upper],
+                              inputs=[octree]))
+    build = Build(targets, jobs=2)
+    assert build.stale() == ["scene.oct", "south.vmx", "north.vmx"]
+    assert sorted(build.run(verbose=False).built) == ["north.vmx", "scene.oct", "south.vmx"]
+    assert open(os.path.join(directory, "vmx", "south.vmx")).read().startswith("VOID GLOW")
+    assert Build(targets).stale() == []
+    # touched but not changed
+    os.utime(scene, None)
+    assert Build(targets).run(verbose=False).built == []
+    with open(scene, "a") as file:
+        file.write("# new window\n")
+    report = Build(targets).run(verbose=False)
+    print(report.report())
+    assert sorted(report.built) == ["north.vmx", "scene.oct", "south.vmx"]
+    failing = Target("bad.vmx", os.path.join(directory, "bad.vmx"), [[sys.executable, "-c", "import sys; sys.exit('bad scene')"]])
+    try:
+        Build([failing]).run(verbose=False)
+    except BuildError as exception:
+        print(exception)
+        assert not os.path.exists(failing.output)
+    else:
+        raise AssertionError("the failing target was built")
+
+
+if __name__ == "__main__":
+    build_test()
@@ -0,0 +1,188 @@
+import os
+import hashlib
+import logging
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+# the cache directory can be moved with this environment variable
+CACHE_DIR_ENV = "RADEXP_CACHE_DIR"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radexp")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+logger = logging.getLogger(__name__)
+
+
+def file_key(file_path: str, mode: str = "stat") -> str:
+    """Identify the content of an input file.
+
+    Args:
+        file_path (str): input file, e.g. a dmx, vmx or xml file.
+        mode (str): "stat" uses the path, size and modification time, "hash" the sha1 of the content.
+
+    Returns:
+        str: key of the file content.
+    """
+    if mode == "hash":
+        digest = hashlib.sha1()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    elif mode == "stat":
+        stat = os.stat(file_path)
+        return "%s:%d:%d" % (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    else:
+        raise ValueError("unknown key mode %s" % mode)
+
+
+def inputs_key(kind: str, inputs: Sequence[str], *params, mode: str = "stat") -> str:
+    """Key of a product of input files, see "MatrixCache.key".
+    """
+    digest = hashlib.sha1(kind.encode("utf-8"))
+    for file_path in inputs:
+        digest.update(file_key(file_path, mode).encode("utf-8"))
+    for param in params:
+        digest.update(repr(param).encode("utf-8"))
+    return "%s-%s" % (kind, digest.hexdigest())
+
+
+class MatrixCache:
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES, key_mode: str = "stat",
+                 memory_items: int = 32) -> None:
+        """Disk cache of numpy arrays computed from input files, with an in-process tier on top.
+
+        Entries are npy files named by the hash of the input files and the kind of
+        product. The least recently used files are removed when the directory grows
+        over max_bytes.
+
+        Args:
+            cache_dir (str): cache directory, $RADEXP_CACHE_DIR or ~/.cache/radexp by default.
+            max_bytes (int): size limit of the cache directory.
+            key_mode (str): "stat" or "hash", see "file_key".
+            memory_items (int): arrays kept in memory, 0 disables the in-process tier.
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_mode = key_mode
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, inputs: Sequence[str], *params) -> str:
+        """Key of a product of input files.
+
+        Args:
+            kind (str): name of the product, e.g. "vtd".
+            inputs (list[str]): input files, their order matters.
+            params: other values the product depends on.
+
+        Returns:
+            str: key used as file name.
+        """
+        return inputs_key(kind, inputs, *params, mode=self.key_mode)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Read an array from memory or disk, None when it is not cached.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+            # the modification time records the last use
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, array)
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> None:
+        """Store an array, the file is written atomically so readers never see half of it.
+
+        An array larger than max_bytes is only kept in memory, on disk it would push
+        out every other entry and then itself.
+        """
+        self._remember(key, array)
+        if array.nbytes > self.max_bytes:
+            logger.warning("%s is %d bytes, over the cache limit of %d bytes, not written to %s",
+                           key, array.nbytes, self.max_bytes, self.cache_dir)
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                np.save(file, array)
+            os.replace(temp_path, self.path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict(keep=key)
+
+    def get_or_compute(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        array = self.get(key)
+        if array is None:
+            array = compute()
+            self.put(key, array)
+        return array
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Remove the least recently used files until the cache fits in max_bytes.
+
+        Args:
+            keep (str): key that is never removed, e.g. the entry just written.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and name == keep + ".npy":
+                continue
+            os.remove(os.path.join(self.cache_dir, name))
+            self.memory.pop(name[:-len(".npy")], None)
+            total -= size
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _remember(self, key: str, array: np.ndarray) -> None:
+        if self.memory_items <= 0:
+            return
+        self.memory[key] = array
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+
+_default_cache = None
+
+
+def default_cache() -> MatrixCache:
+    """The cache shared by all engines of the process.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MatrixCache()
+    return _default_cache
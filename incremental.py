@@ -0,0 +1,95 @@
+import time
+import hashlib
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+from cache import MatrixCache, default_cache
+from radiance import IlluData, ThreePhaseEngine, annual_illuminance
+
+# Incremental evaluation of a window group. The illuminance is the sum of
+# independent group contributions, each depends only on its (vmx, xml, dmx)
+# files and the sky:
+#
+#   sky ──┬── south (vmx, xml, dmx) ──┐
+#         ├── north (vmx, xml, dmx) ──┼── sum
+#         └── ...                   ──┘
+#
+# Every contribution is kept in a MatrixCache under the key of its inputs, so
+# after a new glazing xml of one facade only that facade is recomputed.
+
+
+@dataclass
+class IncrementalResult:
+    # illuminance (lux) of all groups with shape (sensors, timesteps)
+    lux: np.ndarray
+    # contribution of every group, same shape
+    contributions: Dict[str, np.ndarray]
+    # groups recomputed and groups taken from the cache
+    computed: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    # seconds spent on every computed group
+    seconds: Dict[str, float] = field(default_factory=dict)
+
+    def report(self) -> str:
+        lines = ["%-12s computed %.3f s" % (name, self.seconds[name]) for name in self.computed]
+        lines += ["%-12s skipped, inputs unchanged" % name for name in self.skipped]
+        return "\n".join(lines)
+
+
+def sky_digest(sky_matrix: np.ndarray) -> str:
+    """Key of the content of a sky matrix, grey skies are hashed by one channel.
+    """
+    digest = hashlib.sha1(repr(sky_matrix.shape).encode("utf-8"))
+    grey = np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 1]) and \
+        np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 2])
+    for channel in range(1 if grey else 3):
+        digest.update(np.ascontiguousarray(sky_matrix[:, :, channel], dtype=np.float64).data)
+    return digest.hexdigest()
+
+
+class IncrementalEvaluation:
+
+    def __init__(self, cache: Optional[MatrixCache] = None) -> None:
+        """Evaluate window groups, recomputing only the groups whose input files changed.
+
+        Args:
+            cache (MatrixCache): keeps the contributions and the V·T·D products,
+                "cache.default_cache" by default. A cache with key_mode "hash" also
+                skips files that were touched but not changed.
+        """
+        self.cache = cache if cache is not None else default_cache()
+
+    def group_key(self, illu_data: IlluData, sky_key: str) -> str:
+        return self.cache.key("group_lux", [illu_data.vmx, illu_data.xml, illu_data.dmx], sky_key)
+
+    def evaluate(self, illu_group: Union[Dict[str, IlluData], List[IlluData]], sky_matrix: np.ndarray,
+                 sky_key: Optional[str] = None) -> IncrementalResult:
+        """The illuminance of all groups, summed from the cached or recomputed contributions.
+
+        Args:
+            illu_group (dict | list): the window groups by name, or a list named "group0", "group1", ...
+            sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+            sky_key (str): key of the sky, hashed from sky_matrix when None.
+
+        Returns:
+            IncrementalResult: the sum, the contributions and which groups were computed or skipped.
+        """
+        if not isinstance(illu_group, dict):
+            illu_group = {"group%d" % i: illu_data for i, illu_data in enumerate(illu_group)}
+        if sky_key is None:
+            sky_key = sky_digest(sky_matrix)
+        result = IncrementalResult(None, {})
+        for name, illu_data in illu_group.items():
+            key = self.group_key(illu_data, sky_key)
+            contribution = self.cache.get(key)
+            if contribution is None:
+                start = time.perf_counter()
+                contribution = annual_illuminance([ThreePhaseEngine(illu_data, cache=self.cache)], sky_matrix)
+                self.cache.put(key, contribution)
+                result.seconds[name] = time.perf_counter() - start
+                result.computed.append(name)
+            else:
+                result.skipped.append(name)
+            result.contributions[name] = contribution
+        result.lux = sum(np.asarray(contribution) for contribution in result.contributions.values())
+        return result
@@ -0,0 +1,202 @@
+import os
+import time
+import tempfile
+import numpy as np
+import radfiles
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+from rmatrix import load_matrix, write_matrix
+
+# Truncated SVD of a daylight matrix D or of the combined V·T·D, per channel.
+# A (rows, columns) channel is stored as left (rows, rank) @ right (rank, columns),
+# the singular values folded into left. The Klems D of the bundled rooms have a
+# rank of about 80 of 145 at 1e-3, a V·T·D of thousands of sensors keeps the same
+# rank, so its multiply costs (sensors + 2306) x rank instead of sensors x 2306.
+#
+# The factors are two Radiance matrices, "<name>.left.mtx" and "<name>.right.mtx",
+# so "rmtxop name.left.mtx name.right.mtx" gives the approximated matrix back.
+
+
+@dataclass
+class LowRankMatrix:
+    # (rows, rank, 3), the channels with a lower rank are padded with zeros
+    left: np.ndarray
+    # (rank, columns, 3)
+    right: np.ndarray
+    # rank of every channel
+    ranks: tuple
+    # relative Frobenius error bound of every channel
+    tolerance: float
+    # key of the inputs the factors were computed from, see "cache.inputs_key"
+    source: Optional[str] = None
+
+    @property
+    def shape(self) -> tuple:
+        return self.left.shape[0], self.right.shape[1], 3
+
+    @property
+    def nbytes(self) -> int:
+        return self.left.nbytes + self.right.nbytes
+
+    def apply(self, x: np.ndarray) -> np.ndarray:
+        """Multiply the matrix with sky vectors.
+
+        Args:
+            x (np.ndarray): sky vector (columns, 3) or sky matrix (columns, timesteps, 3).
+
+        Returns:
+            np.ndarray: result with shape (rows, 3) or (rows, timesteps, 3).
+        """
+        x = np.asarray(x)
+        result = np.empty((self.left.shape[0],) + x.shape[1:])
+        for channel, rank in enumerate(self.ranks):
+            result[..., channel] = self.left[:, :rank, channel] @ (self.right[:rank, :, channel] @ x[..., channel])
+        return result
+
+    def dense(self) -> np.ndarray:
+        """The approximated matrix with shape (rows, columns, 3)."""
+        return np.stack([self.left[:, :, channel] @ self.right[:, :, channel] for channel in range(3)], axis=2)
+
+
+def truncation_rank(singular_values: np.ndarray, tolerance: float) -> int:
+    """The lowest rank whose relative Frobenius error is at most tolerance.
+    """
+    energy = singular_values ** 2
+    # tail[r] is the error of keeping r singular values
+    tail = np.sqrt(np.maximum(np.cumsum(energy[::-1])[::-1], 0.0) / max(energy.sum(), np.finfo(float).tiny))
+    below = np.flatnonzero(np.append(tail, 0.0) <= tolerance)
+    return max(int(below[0]), 1)
+
+
+def compress_matrix(matrix: np.ndarray, tolerance: float = 1e-3) -> LowRankMatrix:
+    """Truncated SVD of every channel, the rank is chosen from the tolerance.
+
+    Args:
+        matrix (np.ndarray): matrix with shape (rows, columns, 3), e.g. a dmx or a V·T·D product.
+        tolerance (float): relative Frobenius error ||A - A_r|| / ||A|| allowed per channel.
+
+    Returns:
+        LowRankMatrix: the factors.
+    """
+    factors = []
+    for channel in range(3):
+        u, s, vt = np.linalg.svd(np.asarray(matrix[:, :, channel], dtype=np.float64), full_matrices=False)
+        rank = truncation_rank(s, tolerance)
+        factors.append((u[:, :rank] * s[:rank], vt[:rank]))
+    rank = max(left.shape[1] for left, _ in factors)
+    left = np.zeros((matrix.shape[0], rank, 3))
+    right = np.zeros((rank, matrix.shape[1], 3))
+    for channel, (u, vt) in enumerate(factors):
+        left[:, :u.shape[1], channel] = u
+        right[:vt.shape[0], :, channel] = vt
+    return LowRankMatrix(left, right, tuple(u.shape[1] for u, _ in factors), tolerance)
+
+
+def save_lowrank(name: str, matrix: LowRankMatrix, data_format: str = "float") -> None:
+    """Write the factors as "<name>.left.mtx" and "<name>.right.mtx".
+    """
+    command = "lowrank tolerance=%g ranks=%s" % (matrix.tolerance, ",".join(str(rank) for rank in matrix.ranks))
+    if matrix.source is not None:
+        command += " source=%s" % matrix.source
+    write_matrix(name + ".left.mtx", matrix.left, data_format, command=command)
+    write_matrix(name + ".right.mtx", matrix.right, data_format, command=command)
+
+
+def load_lowrank(name: str) -> LowRankMatrix:
+    """Read the factors written by "save_lowrank".
+    """
+    with open(name + ".left.mtx", "rb") as file:
+        file.readline()
+        command = file.readline().decode("utf-8").split()
+    values = dict(item.split("=", 1) for item in command[1:])
+    left = load_matrix(name + ".left.mtx").astype(np.float64)
+    right = load_matrix(name + ".right.mtx").astype(np.float64)
+    return LowRankMatrix(left, right, tuple(int(rank) for rank in values["ranks"].split(",")), float(values["tolerance"]),
+                         values.get("source"))
+
+
+def fidelity_report(illu_data, tolerances: Sequence[float] = (1e-2, 1e-3, 1e-4), targets: Sequence[str] = ("daylight", "vtd"),
+                    skvs: Optional[List[str]] = None) -> List[dict]:
+    """Compare compressed and full results on sky vectors.
+
+    Args:
+        illu_data (IlluData): the window group.
+        tolerances (list[float]): tolerances tried.
+        targets (list[str]): "daylight" compresses D, "vtd" the combined V·T·D.
+        skvs (list[str]): skv files, the bundled ones by default.
+
+    Returns:
+        list[dict]: one row per target and tolerance with the ranks, the memory ratio, the
+            largest and the mean relative illuminance error over the skies and the sensors
+            that get light, and the time of one multiply.
+    """
+    from radiance import ThreePhaseEngine, rgb_to_lux
+    if skvs is None:
+        skvs = [os.path.join(radfiles.radfiles_skv, name) for name in sorted(os.listdir(radfiles.radfiles_skv))]
+    skies = np.stack([load_matrix(skv).reshape(-1, 3) for skv in skvs], axis=1)
+    full = ThreePhaseEngine(illu_data)
+    reference = rgb_to_lux(np.stack([full.dc_timestep(skies[:, i]) for i in range(skies.shape[1])], axis=1))
+    lit = reference > 1e-3 * reference.max()
+    rows = []
+    for target in targets:
+        dense = full.daylight if target == "daylight" else full.vtd()
+        for tolerance in tolerances:
+            engine = ThreePhaseEngine(illu_data, tolerance=tolerance, compress=target)
+            # the factors and the matrices are loaded outside of the timing
+            lowrank = engine.lowrank()
+            _ = engine.view
+            _ = engine.transmission
+            start = time.perf_counter()
+            lux = rgb_to_lux(engine.lowrank_rgb(skies))
+            seconds = time.perf_counter() - start
+            error = np.abs(lux - reference)[lit] / reference[lit]
+            # a V·T·D of few sensors is kept dense, see "ThreePhaseEngine.lowrank"
+            rows.append({"target": target, "tolerance": tolerance, "ranks": None if lowrank is None else lowrank.ranks,
+                         "memory": 1.0 if lowrank is None else lowrank.nbytes / np.asarray(dense, dtype=np.float64).nbytes,
+                         "max_error": float(error.max()), "mean_error": float(error.mean()), "seconds": seconds})
+            print("%-8s tolerance %-7g ranks %-14s memory %5.2f max error %.2e mean error %.2e %.4f s" % (
+                target, tolerance, rows[-1]["ranks"], rows[-1]["memory"], rows[-1]["max_error"],
+                rows[-1]["mean_error"], seconds))
+    return rows
+
+
+def lowrank_test():
+    from radiance import IlluData, ThreePhaseEngine, rgb_to_lux
+    daylight = load_matrix(radfiles.dmx_south)
+    for tolerance in (1e-2, 1e-3):
+        matrix = compress_matrix(daylight, tolerance)
+        error = np.linalg.norm(matrix.dense() - daylight, axis=(0, 1)) / np.linalg.norm(daylight, axis=(0, 1))
+        print("south.dmx tolerance %g ranks %s error %s" % (tolerance, matrix.ranks, error))
+        assert (error <= tolerance * (1 + 1e-6)).all()
+    with tempfile.TemporaryDirectory() as directory:
+        save_lowrank(os.path.join(directory, "south_lowrank"), matrix)
+        loaded = load_lowrank(os.path.join(directory, "south_lowrank"))
+        assert loaded.ranks == matrix.ranks and np.allclose(loaded.dense(), matrix.dense(), rtol=1e-5, atol=1e-6)
+        # the repository has no vmx, a random one like those of "benchmark.py" stands in
+        vmx = os.path.join(directory, "sensors_400.vmx")
+        write_matrix(vmx, np.random.default_rng(400).random((400, 145, 3)) * 1e-3, "float")
+        illu_data = IlluData(dmx=radfiles.dmx_south, xml=radfiles.xml_angle_null, vmx=vmx)
+        for row in fidelity_report(illu_data, tolerances=(1e-2, 1e-3)):
+            assert row["memory"] < 1 and row["max_error"] < 10 * row["tolerance"], row
+        # the factors written by the first engine are read by the second
+        sky = os.path.join(radfiles.radfiles_skv, "6_30_12.skv")
+        factors = os.path.join(directory, "south_vtd")
+        rgb = ThreePhaseEngine(illu_data, tolerance=1e-3, factors=factors).dc_timestep(sky)
+        assert os.path.exists(factors + ".left.mtx") and os.path.exists(factors + ".right.mtx")
+        engine = ThreePhaseEngine(illu_data, tolerance=1e-3, factors=factors)
+        assert engine.lowrank().ranks == load_lowrank(factors).ranks
+        assert np.allclose(engine.dc_timestep(sky), rgb, rtol=1e-4)
+        # the factors of the null angle are not taken for another BSDF, they are computed again
+        other = IlluData(dmx=radfiles.dmx_south, xml=radfiles.get_type25_xml(45), vmx=vmx)
+        lux = rgb_to_lux(ThreePhaseEngine(other, tolerance=1e-3, factors=factors).dc_timestep(sky))
+        reference = rgb_to_lux(ThreePhaseEngine(other).dc_timestep(sky))
+        assert np.abs(lux - reference).max() <= 1e-2 * reference.max()
+        assert load_lowrank(factors).source != engine.lowrank().source
+        # the factors of 20 sensors are larger than their V·T·D, which is kept dense
+        few = ThreePhaseEngine(illu_data, tolerance=1e-3, sensors=list(range(20)))
+        assert few.lowrank() is None
+        assert np.allclose(few.dc_timestep(sky), ThreePhaseEngine(illu_data, sensors=list(range(20))).dc_timestep(sky))
+
+
+if __name__ == "__main__":
+    lowrank_test()
@@ -7,10 +7,16 @@ from radfiles import xml_angle_null, skv_063010, skv_063014, skv_063018
 from radfiles import dmx_north, dmx_east, dmx_south, dmx_west
 from radfiles import vmx_east, vmx_north, vmx_south, vmx_west
 from radiance import IlluData, SkyData
-from radiance import dc_timestep_pipe, dc_timestep_group
+from radiance import dc_timestep_pipe, dc_timestep_group, rgb_group_2_lux
+from radiance import ThreePhaseEngine, gen_sky_vector
+from radiance import annual_illuminance, gen_sky_matrix
+from cache import default_cache
+from incremental import IncrementalEvaluation
+import profiling
 import radfiles
 import os
 import sys
+import tempfile
 
 # 
 
@@ -52,7 +58,8 @@ path_save_skv = os.path.join(radfiles.radfiles_skv, f"skv_{year}_{month}_{day}_{
 xml_angle = xml_angle_null
 skv = skv_063018
 
-skv_data = SkyData(altitude=alt, azimuth=az, \
+# ephem measures the azimuth from north to east, gendaylit west of south
+skv_data = SkyData(altitude=alt, azimuth=az - 180.0, \
                 direct_normal_irradiance=direct_normal_irradiance, \
                 diffusion_horizonttal_irradiance=diffuse_horizontal_irradiance, \
                 direct_normal_illuminance=direct_normal_illuminance, \
@@ -65,15 +72,51 @@ illu_data_north = IlluData(dmx=dmx_north, xml=xml_angle, vmx=vmx_south)
 
 # illu_group = [illu_data_south, illu_data_north, illu_data_east, illu_data_west]
 # result = dc_timestep_group(skv_data, illu_group)
-# result_south = result[0]
-# result_north = result[1]
-# result_east = result[2]
-# result_west = result[3]
-
-result_south = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_south)
-result_north = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_north)
-result_east = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_east)
-result_west = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_west)
+# result_south = result.rgb[0]
+# result_north = result.rgb[1]
+# result_east = result.rgb[2]
+# result_west = result.rgb[3]
+
+# result_south = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_south)
+# result_north = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_north)
+# result_east = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_east)
+# result_west = dc_timestep_pipe(sky_data=skv_data, illu_data=illu_data_west)
+
+# load the matrices once, then every time-step is only a matrix multiplication.
+# the V·T·D products are cached, when only the sky changes the next run starts at the multiply.
+engine_south = ThreePhaseEngine(illu_data_south, cache=default_cache())
+engine_north = ThreePhaseEngine(illu_data_north, cache=default_cache())
+engine_east = ThreePhaseEngine(illu_data_east, cache=default_cache())
+engine_west = ThreePhaseEngine(illu_data_west, cache=default_cache())
+
+sky_vector = gen_sky_vector(sky_data=skv_data)
+result_south = engine_south.dc_timestep(sky_vector)
+result_north = engine_north.dc_timestep(sky_vector)
+result_east = engine_east.dc_timestep(sky_vector)
+result_west = engine_west.dc_timestep(sky_vector)
+
+# annual mode: the whole year of the weather file in one sky matrix
+annual_mode = False
+if annual_mode:
+    # the bundled radfiles/weather/CHN_ShanghaiCSWD.wea is not overwritten
+    wea_path = os.path.join(tempfile.gettempdir(), "CHN_ShanghaiCSWD.wea")
+    weather_data.write_wea(wea_path)
+    sky_matrix = gen_sky_matrix(wea_path)
+    # (sensors, 8760)
+    annual_lux = annual_illuminance([engine_south, engine_north, engine_east, engine_west], sky_matrix)
+    print(annual_lux.shape)
+    # big grids: tiles of sensors and time-steps within a memory budget, float32 halves it
+    # from tiling import tiled_illuminance
+    # run = tiled_illuminance([engine_south, engine_north, engine_east, engine_west], sky_matrix, 2 * 1024 ** 3, "float32")
+    # print(run.report())
+    # validation against Radiance: one dctimestep per group for the whole year
+    # from radiance import annual_illuminance_pipe
+    # annual_lux_pipe = annual_illuminance_pipe([illu_data_south, illu_data_north, illu_data_east, illu_data_west], sky_matrix)
+    # the contributions of the groups are kept, after a change of one facade only that group is recomputed
+    evaluation = IncrementalEvaluation(default_cache())
+    result = evaluation.evaluate({"south": illu_data_south, "north": illu_data_north,
+                                  "east": illu_data_east, "west": illu_data_west}, sky_matrix)
+    print(result.report())
 
 """
 result_south = dc_timestep(vmx_south, xml_angle, dmx_south, skv, "")
@@ -84,13 +127,13 @@ result_east = dc_timestep(vmx_east, xml_angle, dmx_east, skv, "")
 points_num = len(result_east)
 point_ill = []
 for i in range(points_num):
-    sou = result_south[i]
-    nor = result_north[i]
-    eas = result_east[i]
-    wes = result_west[i]
-    illu = 179.0 * (sou[0] + nor[0] + eas[0] + wes[0]) * 0.25 + \
-        (sou[1] + nor[1] + eas[1] + wes[1]) * 0.670 + (sou[2] + nor[2] + eas[2] + wes[2]) * 0.065
+    # the RGB of the four groups are summed, then weighted like "rgb_to_lux"
+    illu = rgb_group_2_lux([result_south[i], result_north[i], result_east[i], result_west[i]])
     point_ill.append(illu)
 
 drawHotMap3D(point_ill, height=31 , weight=60)
 
+# RADEXP_PROFILE=1 python main.py prints the time of every stage
+if profiling.metrics.enabled:
+    print(profiling.metrics.report())
+
@@ -0,0 +1,261 @@
+import numpy as np
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Climate-based daylight metrics of an annual illuminance matrix with shape
+# (sensors, timesteps), e.g. "radiance.annual_illuminance", a np.memmap or a
+# variant of a "results.ResultStore". The matrix is read in blocks of sensors,
+# so it does not have to fit in memory: the per-sensor metrics only need the
+# time series of the block, the per-time-step metrics of the zones are summed
+# over the blocks.
+
+# LM-83 / IES defaults
+DA_THRESHOLD = 300.0
+SDA_FRACTION = 0.5
+ASE_THRESHOLD = 1000.0
+ASE_HOURS = 250
+UDI_EDGES = (100.0, 2000.0)
+
+
+@dataclass
+class ZoneMetrics:
+    # fraction of the sensors with a daylight autonomy of at least SDA_FRACTION
+    spatial_daylight_autonomy: float
+    # fraction of the sensors with more than ASE_HOURS hours over ASE_THRESHOLD
+    annual_sunlight_exposure: float
+    # fraction of the occupied hours in every UDI bin, averaged over the sensors
+    useful_daylight_illuminance: np.ndarray
+    # min / mean illuminance of every occupied time-step, nan when the zone is dark
+    uniformity: np.ndarray
+    # mean illuminance of every occupied time-step
+    mean_illuminance: np.ndarray
+
+    @property
+    def mean_uniformity(self) -> float:
+        return float(np.nanmean(self.uniformity)) if np.isfinite(self.uniformity).any() else np.nan
+
+
+@dataclass
+class DaylightMetrics:
+    # fraction of the occupied hours with at least DA_THRESHOLD lux, shape (sensors,)
+    daylight_autonomy: np.ndarray
+    # fraction of the occupied hours in every UDI bin, shape (bins, sensors)
+    useful_daylight_illuminance: np.ndarray
+    # occupied hours over ASE_THRESHOLD, shape (sensors,)
+    sunlight_hours: np.ndarray
+    # illuminance percentiles of the occupied hours weighted by the occupancy, shape (len(percentiles), sensors)
+    percentile_maps: np.ndarray
+    percentiles: Sequence[float]
+    udi_edges: Sequence[float]
+    # indices of the occupied time-steps, the axis of the zone time series
+    occupied: np.ndarray
+    zones: Dict[str, ZoneMetrics] = field(default_factory=dict)
+
+
+def occupancy_schedule(times: "pd.DatetimeIndex", start: float = 8.0, end: float = 18.0,
+                       weekdays_only: bool = False) -> np.ndarray:
+    """Occupied time-steps of a daily schedule.
+
+    Args:
+        times (pd.DatetimeIndex): time of every time-step, e.g. "EpWeather.get_times".
+        start (float): first occupied hour of the day.
+        end (float): end of the occupied hours, exclusive.
+        weekdays_only (bool): Saturdays and Sundays are not occupied.
+
+    Returns:
+        np.ndarray: bool array with one value per time-step.
+    """
+    import pandas as pd
+    times = pd.DatetimeIndex(times)
+    hour = times.hour + times.minute / 60.0
+    occupied = (hour >= start) & (hour < end)
+    if weekdays_only:
+        occupied &= times.dayofweek < 5
+    return np.asarray(occupied)
+
+
+def sensor_blocks(lux, block_sensors: int = 512, variant=None) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Iterate over blocks of sensors of an illuminance matrix.
+
+    Args:
+        lux: array like with shape (sensors, timesteps), or a ResultStore.
+        block_sensors (int): sensors per block.
+        variant: variant label of a ResultStore, the first variant by default.
+
+    Yields:
+        tuple[slice, np.ndarray]: the sensors of the block and their illuminance (block, timesteps).
+    """
+    if hasattr(lux, "variants"):
+        variants = [lux.variants[0] if variant is None else variant]
+        for start in range(0, lux.sensors, block_sensors):
+            sensors = slice(start, min(start + block_sensors, lux.sensors))
+            yield sensors, lux.read(sensors=sensors, variants=variants)[0].T
+        return
+    for start in range(0, lux.shape[0], block_sensors):
+        sensors = slice(start, min(start + block_sensors, lux.shape[0]))
+        yield sensors, np.asarray(lux[sensors])
+
+
+def weighted_percentile(values: np.ndarray, weights: np.ndarray, percentiles: Sequence[float]) -> np.ndarray:
+    """Percentiles along the last axis with a weight for every column.
+
+    The sorted values are placed at the weight below them over the total weight
+    without the largest value and interpolated, with equal weights this is the
+    "linear" method of np.percentile.
+
+    Args:
+        values (np.ndarray): values with shape (rows, columns).
+        weights (np.ndarray): positive weight of every column.
+        percentiles (list[float]): percentiles between 0 and 100.
+
+    Returns:
+        np.ndarray: percentiles with shape (len(percentiles), rows).
+    """
+    order = np.argsort(values, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    weights = weights[order]
+    below = np.cumsum(weights, axis=1) - weights
+    span = below[:, -1:]
+    positions = np.divide(below, span, out=np.zeros_like(below), where=span > 0)
+    rows = np.arange(values.shape[0])
+    result = np.empty((len(percentiles), values.shape[0]))
+    for i, percentile in enumerate(percentiles):
+        fraction = percentile / 100.0
+        upper = np.clip(np.count_nonzero(positions <= fraction, axis=1), 1, values.shape[1] - 1)
+        lower = upper - 1
+        gap = positions[rows, upper] - positions[rows, lower]
+        step = np.clip(np.divide(fraction - positions[rows, lower], gap, out=np.zeros_like(gap), where=gap > 0), 0.0, 1.0)
+        result[i] = values[rows, lower] + step * (values[rows, upper] - values[rows, lower])
+    return result
+
+
+def average_degree(lux: np.ndarray, lowest: int = 100) -> float:
+    """Mean of the lowest values over the mean, the uniformity of "drawHotMap3D".
+
+    Args:
+        lux (np.ndarray): illuminance of a grid.
+        lowest (int): number of the lowest values averaged.
+
+    Returns:
+        float: uniformity between 0 and 1.
+    """
+    values = np.ravel(lux)
+    lowest = min(lowest, values.size)
+    return float(np.mean(np.partition(values, lowest - 1)[:lowest]) / np.mean(values))
+
+
+def daylight_metrics(lux, occupancy: Optional[np.ndarray] = None, zones: Optional[Dict[str, np.ndarray]] = None,
+                     da_threshold: float = DA_THRESHOLD, sda_fraction: float = SDA_FRACTION,
+                     udi_edges: Sequence[float] = UDI_EDGES, ase_threshold: float = ASE_THRESHOLD,
+                     ase_hours: int = ASE_HOURS, percentiles: Sequence[float] = (10, 50, 90),
+                     direct_lux=None, block_sensors: int = 512, variant=None) -> DaylightMetrics:
+    """Compute DA, sDA, UDI, ASE, uniformity and percentile maps of an annual simulation.
+
+    Args:
+        lux: illuminance with shape (sensors, timesteps), or a ResultStore, see "sensor_blocks".
+        occupancy (np.ndarray): bool or weight of every time-step, all time-steps by default,
+            see "occupancy_schedule". Weights between 0 and 1 count partly occupied hours,
+            in the fractions and in the percentile maps, see "weighted_percentile".
+        zones (dict): name and bool sensor mask of every zone, one zone "all" by default.
+        da_threshold (float): illuminance of the daylight autonomy.
+        sda_fraction (float): daylight autonomy a sensor needs to count in sDA.
+        udi_edges (list[float]): edges of the UDI bins, (100, 2000) gives fell-short, useful and exceeded.
+        ase_threshold (float): illuminance of the annual sunlight exposure.
+        ase_hours (int): hours over ase_threshold a sensor may have.
+        percentiles (list[float]): percentiles of the percentile maps.
+        direct_lux: direct sun only illuminance for ASE, same layout as lux; lux is used when None.
+        block_sensors (int): sensors read at once.
+        variant: variant label when lux is a ResultStore.
+
+    Returns:
+        DaylightMetrics: per-sensor metrics and the metrics of every zone.
+    """
+    sensors, timesteps = (lux.sensors, lux.timesteps) if hasattr(lux, "variants") else lux.shape
+    weights = np.ones(timesteps) if occupancy is None else np.asarray(occupancy, dtype=np.float64)
+    if weights.shape != (timesteps,):
+        raise ValueError("occupancy has %d values for %d time-steps" % (weights.size, timesteps))
+    occupied = np.flatnonzero(weights > 0)
+    weights = weights[occupied]
+    total = weights.sum()
+    if total <= 0:
+        raise ValueError("no occupied time-steps")
+    # partly occupied hours also weigh in the percentile maps
+    weighted = bool(np.any(weights != weights[0]))
+    if zones is None:
+        zones = {"all": np.ones(sensors, dtype=bool)}
+    zones = {name: np.asarray(mask, dtype=bool) for name, mask in zones.items()}
+    edges = np.asarray(udi_edges, dtype=np.float64)
+
+    autonomy = np.empty(sensors)
+    udi = np.empty((edges.size + 1, sensors))
+    sunlight = np.empty(sensors)
+    percentile_maps = np.empty((len(percentiles), sensors))
+    zone_min = {name: np.full(occupied.size, np.inf) for name in zones}
+    zone_sum = {name: np.zeros(occupied.size) for name in zones}
+
+    blocks = sensor_blocks(lux, block_sensors, variant)
+    direct_blocks = None if direct_lux is None else sensor_blocks(direct_lux, block_sensors, variant)
+    for index, block in blocks:
+        block = block[:, occupied]
+        # hours at or over every threshold, the bins are differences of these counts
+        autonomy[index] = (block >= da_threshold) @ weights / total
+        over = np.stack([(block >= edge) @ weights for edge in edges]) / total
+        udi[0, index] = 1.0 - over[0]
+        udi[1:-1, index] = over[:-1] - over[1:]
+        udi[-1, index] = over[-1]
+        direct = block if direct_blocks is None else next(direct_blocks)[1][:, occupied]
+        sunlight[index] = (direct > ase_threshold) @ weights
+        if len(percentiles) and weighted:
+            percentile_maps[:, index] = weighted_percentile(block, weights, percentiles)
+        elif len(percentiles):
+            # np.percentile selects with a partition, it does not sort the hours
+            percentile_maps[:, index] = np.percentile(block, percentiles, axis=1)
+        for name, mask in zones.items():
+            rows = mask[index]
+            if rows.any():
+                zone_min[name] = np.minimum(zone_min[name], block[rows].min(axis=0))
+                zone_sum[name] += block[rows].sum(axis=0)
+
+    result = DaylightMetrics(autonomy, udi, sunlight, percentile_maps, list(percentiles), list(edges), occupied)
+    for name, mask in zones.items():
+        # a zone without sensors has no illuminance rather than a dark one, like its UDI
+        count = int(mask.sum())
+        mean = zone_sum[name] / count if count else np.full(occupied.size, np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            uniformity = np.where(mean > 0, zone_min[name] / mean, np.nan)
+        result.zones[name] = ZoneMetrics(
+            spatial_daylight_autonomy=float(np.mean(autonomy[mask] >= sda_fraction)) if mask.any() else np.nan,
+            annual_sunlight_exposure=float(np.mean(sunlight[mask] > ase_hours)) if mask.any() else np.nan,
+            useful_daylight_illuminance=udi[:, mask].mean(axis=1) if mask.any() else np.full(udi.shape[0], np.nan),
+            uniformity=uniformity,
+            mean_illuminance=mean)
+    return result
+
+
+def variant_metrics(store, **kwargs) -> Dict[object, DaylightMetrics]:
+    """Daylight metrics of every variant of a ResultStore, see "daylight_metrics".
+
+    Returns:
+        dict: variant label and its DaylightMetrics.
+    """
+    return {variant: daylight_metrics(store, variant=variant, **kwargs) for variant in store.variants}
+
+
+def summary_frame(metrics: Dict[object, DaylightMetrics]) -> "pd.DataFrame":
+    """One row per variant and zone with the scalar metrics, for comparing design variants.
+    """
+    import pandas as pd
+    rows = []
+    for variant, result in metrics.items():
+        for name, zone in result.zones.items():
+            row = {"variant": variant, "zone": name, "sDA": zone.spatial_daylight_autonomy,
+                   "ASE": zone.annual_sunlight_exposure, "uniformity": zone.mean_uniformity}
+            edges = result.udi_edges
+            labels = ["UDI<%g" % edges[0]] + ["UDI%g-%g" % (low, high) for low, high in zip(edges[:-1], edges[1:])] + \
+                ["UDI>%g" % edges[-1]]
+            row.update(zip(labels, zone.useful_daylight_illuminance))
+            rows.append(row)
+    return pd.DataFrame(rows).set_index(["variant", "zone"])
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+from radiance import IlluData, SkyData, GendaylitMode, LUMINOUS_EFFICACY, RGB_WEIGHTS, load_klems_xml, sensor_index
+from rmatrix import load_matrix
+
+# Sensor sharding over worker processes. The matrices are copied once into
+# multiprocessing.shared_memory and the tasks only carry the names of the
+# blocks, every worker maps them without pickling any array:
+#
+#   daylight   (groups, 145, 2306, 3)   the dmx files
+#   transmission (groups, 145, 145)     the BSDFs, see "load_klems_xml"
+#   view       (groups, sensors, 435)   V·T with the luminous efficacy folded in,
+#                                       filled by the workers, a shard of rows each
+#   sky        (2306, timesteps, 1|3)   one call, grey skies keep one channel
+#   window     (groups, 435, timesteps) D·s, the time-steps split over the workers
+#   lux        (sensors, timesteps)     the output, the sensors split over the workers
+
+# (name, shape, dtype) of a shared array, the part of a task that is pickled
+SharedSpec = Tuple[str, tuple, str]
+
+
+class SharedArray:
+
+    def __init__(self, shape: tuple, dtype=np.float64) -> None:
+        """A numpy array in a new shared memory block, unlinked by "close".
+        """
+        dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.spec: SharedSpec = (self.shm.name, tuple(shape), dtype.str)
+
+    @classmethod
+    def copy(cls, array: np.ndarray) -> "SharedArray":
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def close(self) -> None:
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+
+# blocks mapped by this worker process, by name
+_attached: Dict[str, tuple] = {}
+
+
+def _attach(spec: SharedSpec) -> np.ndarray:
+    name, shape, dtype = spec
+    if name not in _attached:
+        # the workers share the resource tracker of the parent, which unlinks the block
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    return _attached[name][1]
+
+
+def _detach(names: List[str]) -> None:
+    for name in names:
+        if name in _attached:
+            shm, array = _attached.pop(name)
+            del array
+            shm.close()
+
+
+def _load_view_rows(view_spec: SharedSpec, transmission_spec: SharedSpec, group: int, vmx: str, start: int, stop: int) -> int:
+    # V·T of a shard of sensors, the channels stacked along the Klems axis
+    view = sensor_index(vmx).read(range(start, stop)).astype(np.float64)
+    transmission = _attach(transmission_spec)[group]
+    weights = LUMINOUS_EFFICACY * np.array(RGB_WEIGHTS)
+    _attach(view_spec)[group, start:stop] = np.concatenate(
+        [weights[channel] * (view[:, :, channel] @ transmission) for channel in range(3)], axis=1)
+    return stop - start
+
+
+def _daylight_sky(daylight_spec: SharedSpec, sky_spec: SharedSpec, window_spec: SharedSpec, start: int, stop: int) -> int:
+    daylight, sky, window = _attach(daylight_spec), _attach(sky_spec), _attach(window_spec)
+    patches = daylight.shape[1]
+    for group in range(daylight.shape[0]):
+        for channel in range(3):
+            window[group, channel * patches:(channel + 1) * patches, start:stop] = \
+                daylight[group, :, :, channel] @ sky[:, start:stop, min(channel, sky.shape[2] - 1)]
+    _detach([sky_spec[0], window_spec[0]])
+    return stop - start
+
+
+def _sensor_lux(view_spec: SharedSpec, window_spec: SharedSpec, lux_spec: SharedSpec, start: int, stop: int) -> int:
+    view, window, lux = _attach(view_spec), _attach(window_spec), _attach(lux_spec)
+    result = view[0, start:stop] @ window[0]
+    for group in range(1, view.shape[0]):
+        result += view[group, start:stop] @ window[group]
+    lux[start:stop] = result
+    _detach([window_spec[0], lux_spec[0]])
+    return stop - start
+
+
+def _shards(size: int, count: int) -> List[Tuple[int, int]]:
+    bounds = np.linspace(0, size, min(count, max(size, 1)) + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+class ShardedExecutor:
+
+    def __init__(self, illu_group: List[IlluData], workers: Optional[int] = None) -> None:
+        """Compute the illuminance of a window group with the sensors split over worker processes.
+
+        The daylight matrices and the V·T products are put in shared memory once, the
+        workers read their shard of the vmx rows themselves. Every call shares the sky
+        matrix the same way and the workers write straight into a shared output.
+
+        Args:
+            illu_group (list[IlluData]): one IlluData per window group, with the same sensors.
+            workers (int): processes, os.cpu_count() by default.
+        """
+        self.illu_group = illu_group
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.sensors_num = len(sensor_index(illu_group[0].vmx))
+        self.daylight = SharedArray.copy(np.stack([load_matrix(illu_data.dmx, mmap=True) for illu_data in illu_group]).astype(np.float64))
+        patches = self.daylight.array.shape[1]
+        klems = {}
+        for illu_data in illu_group:
+            if illu_data.xml not in klems:
+                klems[illu_data.xml] = load_klems_xml(illu_data.xml)
+        self.transmission = SharedArray.copy(np.stack([klems[illu_data.xml] for illu_data in illu_group]))
+        self.view = SharedArray((len(illu_group), self.sensors_num, 3 * patches))
+        tasks = [self.pool.submit(_load_view_rows, self.view.spec, self.transmission.spec, group, illu_data.vmx, start, stop)
+                 for group, illu_data in enumerate(illu_group) for start, stop in _shards(self.sensors_num, self.workers)]
+        for task in tasks:
+            task.result()
+
+    def __enter__(self) -> "ShardedExecutor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.shutdown()
+        self.daylight.close()
+        self.transmission.close()
+        self.view.close()
+
+    def annual_illuminance(self, sky_matrix: np.ndarray) -> np.ndarray:
+        """The illuminance of all time-steps, like "radiance.annual_illuminance".
+
+        Args:
+            sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (sensors, timesteps).
+        """
+        grey = np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 1]) and \
+            np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 2])
+        timesteps = sky_matrix.shape[1]
+        sky = SharedArray.copy(sky_matrix[:, :, :1] if grey else sky_matrix)
+        window = SharedArray((len(self.illu_group), self.view.array.shape[2], timesteps))
+        lux = SharedArray((self.sensors_num, timesteps))
+        try:
+            tasks = [self.pool.submit(_daylight_sky, self.daylight.spec, sky.spec, window.spec, start, stop)
+                     for start, stop in _shards(timesteps, self.workers)]
+            for task in tasks:
+                task.result()
+            tasks = [self.pool.submit(_sensor_lux, self.view.spec, window.spec, lux.spec, start, stop)
+                     for start, stop in _shards(self.sensors_num, self.workers)]
+            for task in tasks:
+                task.result()
+            return lux.array.copy()
+        finally:
+            sky.close()
+            window.close()
+            lux.close()
+
+    def illuminance(self, sky_data_list: List[SkyData], mode: GendaylitMode = GendaylitMode.W,
+                    min_altitude: float = 0.0) -> np.ndarray:
+        """The illuminance of a list of SkyData, the skies are generated with "sky.perez_sky_matrix".
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (sensors, len(sky_data_list)).
+        """
+        from sky import perez_sky_matrix, sky_data_arrays
+        sky_matrix = perez_sky_matrix(*sky_data_arrays(sky_data_list, mode), mode=mode, min_altitude=min_altitude)
+        return self.annual_illuminance(sky_matrix)
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+
+# Per-stage timers and counters of a run. Disabled by default, set
+# RADEXP_PROFILE=1 or call "enable" to record:
+#
+#   with profiling.stage("dctimestep") as record:
+#       process = subprocess.run(...)
+#       record.count(bytes_read=len(process.stdout), processes=1)
+#
+#   print(profiling.metrics.to_prometheus())
+#
+# While disabled "stage" returns a shared object whose methods do nothing, so
+# the instrumented code only pays one function call per stage.
+# The metrics are per process, stages run in a ProcessPoolExecutor are not
+# recorded by the parent.
+
+PROFILE_ENV = "RADEXP_PROFILE"
+
+
+@dataclass
+class StageMetrics:
+    calls: int = 0
+    # seconds spent inside the stage
+    wall_time: float = 0.0
+    # CPU seconds of this process (all threads) inside the stage
+    cpu_time: float = 0.0
+    # CPU seconds of the child processes waited for inside the stage
+    child_cpu_time: float = 0.0
+    bytes_read: int = 0
+    processes: int = 0
+
+
+class _Record:
+
+    __slots__ = ("metrics", "name", "wall", "cpu", "child_cpu", "bytes_read", "processes")
+
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.bytes_read = 0
+        self.processes = 0
+
+    def __enter__(self) -> "_Record":
+        times = os.times()
+        self.child_cpu = times.children_user + times.children_system
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        times = os.times()
+        child_cpu = times.children_user + times.children_system - self.child_cpu
+        self.metrics.add(self.name, wall, cpu, child_cpu, self.bytes_read, self.processes)
+
+    def count(self, bytes_read: int = 0, processes: int = 0) -> None:
+        self.bytes_read += bytes_read
+        self.processes += processes
+
+
+class _NullRecord:
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullRecord":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def count(self, bytes_read: int = 0, processes: int = 0) -> None:
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+
+class Metrics:
+
+    def __init__(self, enabled: bool = False) -> None:
+        """Timers and counters of the stages of a run, keyed by stage name.
+
+        Args:
+            enabled (bool): record the stages, "stage" does nothing otherwise.
+        """
+        self.enabled = enabled
+        self.stages: Dict[str, StageMetrics] = {}
+        # peak resident set size of the run in bytes, set by "profile_run"
+        self.peak_rss: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def stage(self, name: str):
+        """Context manager timing one run of a stage.
+
+        Args:
+            name (str): stage name, e.g. "dctimestep" or "matrix_load".
+
+        Returns:
+            a context manager, its "count(bytes_read, processes)" adds to the counters.
+        """
+        if not self.enabled:
+            return _NULL_RECORD
+        return _Record(self, name)
+
+    def add(self, name: str, wall_time: float = 0.0, cpu_time: float = 0.0, child_cpu_time: float = 0.0,
+            bytes_read: int = 0, processes: int = 0) -> None:
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageMetrics()
+            stage.calls += 1
+            stage.wall_time += wall_time
+            stage.cpu_time += cpu_time
+            stage.child_cpu_time += child_cpu_time
+            stage.bytes_read += bytes_read
+            stage.processes += processes
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stages = {}
+            self.peak_rss = None
+
+    def to_dict(self) -> Dict[str, dict]:
+        with self.lock:
+            return {name: asdict(stage) for name, stage in sorted(self.stages.items())}
+
+    def to_json(self, file_path: Optional[str] = None) -> str:
+        """The metrics as JSON, written to file_path when given.
+        """
+        text = json.dumps({"stages": self.to_dict(), "peak_rss": self.peak_rss}, indent=2)
+        if file_path is not None:
+            with open(file_path, "w") as file:
+                file.write(text + "\n")
+        return text
+
+    def to_prometheus(self, prefix: str = "radexp_stage") -> str:
+        """The metrics in the Prometheus text exposition format, one series per stage.
+        """
+        stages = self.to_dict()
+        lines = []
+        for field, unit in [("calls", "total"), ("wall_time", "seconds_total"), ("cpu_time", "seconds_total"),
+                            ("child_cpu_time", "seconds_total"), ("bytes_read", "total"), ("processes", "total")]:
+            metric = "%s_%s_%s" % (prefix, field.replace("_time", ""), unit)
+            lines.append("# TYPE %s counter" % metric)
+            for name, stage in stages.items():
+                lines.append('%s{stage="%s"} %s' % (metric, name, repr(stage[field])))
+        if self.peak_rss is not None:
+            lines.append("# TYPE %s_peak_rss_bytes gauge" % prefix)
+            lines.append("%s_peak_rss_bytes %d" % (prefix, self.peak_rss))
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> str:
+        """A table of the stages, the slowest first.
+        """
+        stages = sorted(self.to_dict().items(), key=lambda item: -item[1]["wall_time"])
+        lines = ["%-32s %8s %10s %10s %10s %12s %6s" % ("stage", "calls", "wall s", "cpu s", "child s", "bytes", "procs")]
+        for name, stage in stages:
+            lines.append("%-32s %8d %10.4f %10.4f %10.4f %12d %6d" % (
+                name, stage["calls"], stage["wall_time"], stage["cpu_time"], stage["child_cpu_time"],
+                stage["bytes_read"], stage["processes"]))
+        if self.peak_rss is not None:
+            lines.append("peak rss %.1f MB" % (self.peak_rss / 1024 ** 2))
+        return "\n".join(lines)
+
+
+# the metrics of the process
+metrics = Metrics(enabled=os.environ.get(PROFILE_ENV, "0") not in ("", "0"))
+
+
+def stage(name: str):
+    """Time a stage in the metrics of the process, see "Metrics.stage".
+    """
+    return metrics.stage(name)
+
+
+def enable(enabled: bool = True) -> None:
+    metrics.enabled = enabled
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of the process in bytes, since its start or the last "reset_peak_rss".
+
+    Read from /proc/self/status on Linux and from getrusage on other unix systems,
+    None where neither is available (Windows).
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Start the peak of "peak_rss" again at the current resident set size, only on Linux.
+
+    Returns:
+        bool: the peak was reset, otherwise it is that of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def profile_run(output_dir: str, name: str = "run", cprofile: bool = True):
+    """Record the metrics of a run and dump them with an optional cProfile of it.
+
+    Writes <output_dir>/<name>.json, <name>.prom and <name>.prof (pstats, open it
+    with "python -m pstats" or snakeviz). The metrics are reset at the start, the
+    enabled state is restored at the end. The peak RSS of the run is recorded too.
+
+    Args:
+        output_dir (str): directory of the dumps.
+        name (str): file name of the dumps.
+        cprofile (bool): also profile the run with cProfile.
+    """
+    enabled = metrics.enabled
+    metrics.reset()
+    metrics.enabled = True
+    reset_peak_rss()
+    profiler = cProfile.Profile() if cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        metrics.enabled = enabled
+        metrics.peak_rss = peak_rss()
+        os.makedirs(output_dir, exist_ok=True)
+        base = os.path.join(output_dir, name)
+        metrics.to_json(base + ".json")
+        with open(base + ".prom", "w") as file:
+            file.write(metrics.to_prometheus())
+        if profiler is not None:
+            profiler.dump_stats(base + ".prof")
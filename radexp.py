@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import time
+import argparse
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# Batch runs of annual simulations described by JSON job files, many jobs in one
+# process:
+#
+#   python radexp.py jobs/south.json jobs/north.json
+#   python -m radexp --keep-going jobs/*.json
+#   cat jobs.jsonl | python -m radexp -          # one job per line
+#
+# A job file holds one job or a list of jobs, paths are relative to the file:
+#
+#   {
+#     "name": "summer_south",
+#     "weather": "radfiles/weather/CHN_ShanghaiCSWD.epw",
+#     "groups": {"south": {"vmx": "radfiles/vmx/south.vmx", "xml": "radfiles/xml/type25_anglenull.xml",
+#                          "dmx": "radfiles/dmx/south.dmx"}},
+#     "bsdf": [null, 45],
+#     "dates": {"start": "06-01", "end": "08-31", "hours": [8, 18]},
+#     "occupancy": {"start": 8, "end": 18},
+#     "outputs": {"lux": "out/summer_south.npy", "metrics": "out/summer_south.json",
+#                 "maps": {"pattern": "out/summer_south_%d.png", "height": 31, "weight": 60}}
+#   }
+#
+# Only the standard library is imported at the start. radiance, weather and sky
+# follow with the first job and matplotlib only for "maps". pandas is imported
+# when a weather file has no binary column cache yet (see "weather.load_epw_columns")
+# or its solar positions are not cached, pvlib only for the solar positions. Once
+# both caches exist a numeric job starts in about the time of importing numpy.
+
+JOB_KEYS = ("name", "weather", "groups", "bsdf", "dates", "mode", "min_altitude", "sensors", "zones", "occupancy",
+            "memory_budget", "dtype", "cache", "outputs")
+GROUP_KEYS = ("vmx", "xml", "dmx")
+DATE_KEYS = ("start", "end", "hours")
+OUTPUT_KEYS = ("lux", "store", "metrics", "maps")
+
+
+@dataclass
+class Job:
+    name: str
+    # epw file
+    weather: str
+    # name and {"vmx", "xml", "dmx"} of every window group
+    groups: Dict[str, dict]
+    # BSDF states, null keeps the xml of the groups, a number is a type25 slat angle, a string an xml file
+    bsdf: list = field(default_factory=lambda: [None])
+    # {"start": "MM-DD", "end": "MM-DD", "hours": [first, end)} in the hours of the epw file, all by default,
+    # a start after the end wraps around the new year, e.g. "11-01" to "02-28"
+    dates: dict = field(default_factory=dict)
+    # gendaylit mode, "W" or "L"
+    mode: str = "W"
+    min_altitude: float = 0.0
+    # rows of the vmx files, all sensors by default
+    sensors: Optional[List[int]] = None
+    # name and sensor indices of every zone of the metrics
+    zones: Optional[Dict[str, List[int]]] = None
+    # {"start": hour, "end": hour} of the metrics, all selected time-steps by default
+    occupancy: Optional[dict] = None
+    # bytes, computes in tiles, see "tiling.tiled_illuminance"
+    memory_budget: Optional[int] = None
+    # "float32" computes in tiles with single precision
+    dtype: str = "float64"
+    # keep the BSDF and V·T·D products in "cache.default_cache"
+    cache: bool = True
+    # "lux" (npy), "store" (ResultStore directory), "metrics" (json), "maps" (PNG of the mean illuminance)
+    outputs: dict = field(default_factory=dict)
+
+
+def _resolve(value: str, base_dir: str) -> str:
+    return value if os.path.isabs(value) else os.path.normpath(os.path.join(base_dir, value))
+
+
+def _is_date(value) -> bool:
+    parts = value.split("-") if isinstance(value, str) else []
+    return len(parts) == 2 and all(part.isdigit() for part in parts)
+
+
+def _json_number(value) -> Optional[float]:
+    value = float(value)
+    return value if value == value and abs(value) != float("inf") else None
+
+
+def check_job(data: dict, index: int = 0) -> None:
+    """Check the keys and values of a JSON job before anything is computed.
+
+    Raises:
+        ValueError: the first wrong key, with the name of the job.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("job %d is not a JSON object" % index)
+    name = data.get("name", "job%d" % index)
+
+    def check(condition: bool, key: str, message: str) -> None:
+        if not condition:
+            raise ValueError("job %s: %s %s" % (name, key, message))
+
+    unknown = set(data) - set(JOB_KEYS)
+    check(not unknown, ", ".join(sorted(unknown)), "unknown keys, expected %s" % ", ".join(JOB_KEYS))
+    for key in ("weather", "groups"):
+        check(key in data, key, "is missing")
+    check(isinstance(data["weather"], str), "weather", "must be an epw path")
+    groups = data["groups"]
+    check(isinstance(groups, dict) and len(groups) > 0, "groups", "must map a name to every window group")
+    for group_name, group in groups.items():
+        check(isinstance(group, dict) and sorted(group) == sorted(GROUP_KEYS) and
+              all(isinstance(path, str) for path in group.values()),
+              "groups.%s" % group_name, "needs the paths %s" % ", ".join(GROUP_KEYS))
+    if "bsdf" in data:
+        bsdf = data["bsdf"]
+        check(isinstance(bsdf, list) and len(bsdf) > 0, "bsdf", "must be a non-empty list of states")
+        check(all(state is None or isinstance(state, (int, str)) and not isinstance(state, bool) for state in bsdf),
+              "bsdf", "states must be null, a type25 slat angle or an xml path")
+    if "dates" in data:
+        dates = data["dates"]
+        check(isinstance(dates, dict) and set(dates) <= set(DATE_KEYS), "dates", "takes %s" % ", ".join(DATE_KEYS))
+        for key in ("start", "end"):
+            check(key not in dates or _is_date(dates[key]), "dates.%s" % key, "must be MM-DD")
+        check("hours" not in dates or isinstance(dates["hours"], list) and len(dates["hours"]) == 2,
+              "dates.hours", "must be [first, end]")
+    check(data.get("mode", "W") in ("W", "L"), "mode", "must be W or L")
+    if data.get("sensors") is not None:
+        check(isinstance(data["sensors"], list) and len(data["sensors"]) > 0, "sensors", "must be a non-empty list of vmx rows")
+    if data.get("zones") is not None:
+        check(isinstance(data["zones"], dict) and all(isinstance(rows, list) for rows in data["zones"].values()),
+              "zones", "must map a name to a list of sensors")
+    if data.get("occupancy") is not None:
+        check(isinstance(data["occupancy"], dict) and set(data["occupancy"]) <= {"start", "end"},
+              "occupancy", "takes start and end")
+    if data.get("memory_budget") is not None:
+        check(isinstance(data["memory_budget"], int) and data["memory_budget"] > 0, "memory_budget", "must be bytes > 0")
+    check(data.get("dtype", "float64") in ("float32", "float64"), "dtype", "must be float32 or float64")
+    outputs = data.get("outputs", {})
+    check(isinstance(outputs, dict) and set(outputs) <= set(OUTPUT_KEYS), "outputs", "takes %s" % ", ".join(OUTPUT_KEYS))
+    maps = outputs.get("maps", {})
+    check(isinstance(maps, dict) and ("maps" not in outputs or "pattern" in maps), "outputs.maps", "needs a pattern")
+    for key in ("height", "weight"):
+        check("maps" not in outputs or isinstance(maps.get(key), int) and not isinstance(maps[key], bool) and maps[key] > 0,
+              "outputs.maps.%s" % key, "must be an integer > 0, see \"render.render_frames\"")
+
+
+def parse_job(data: dict, base_dir: str = ".", index: int = 0) -> Job:
+    """Build a Job from its JSON object, relative paths are taken from base_dir.
+
+    Raises:
+        ValueError: wrong keys or values, see "check_job".
+    """
+    check_job(data, index)
+    data = dict(data)
+    data.setdefault("name", "job%d" % index)
+    data["weather"] = _resolve(data["weather"], base_dir)
+    data["groups"] = {name: {kind: _resolve(path, base_dir) for kind, path in group.items()}
+                      for name, group in data["groups"].items()}
+    if "bsdf" in data:
+        data["bsdf"] = [_resolve(state, base_dir) if isinstance(state, str) else state for state in data["bsdf"]]
+    outputs = dict(data.get("outputs", {}))
+    for key, value in outputs.items():
+        if isinstance(value, str):
+            outputs[key] = _resolve(value, base_dir)
+        elif isinstance(value, dict) and "pattern" in value:
+            outputs[key] = dict(value, pattern=_resolve(value["pattern"], base_dir))
+    data["outputs"] = outputs
+    return Job(**data)
+
+
+def load_jobs(file_path: str) -> List[Job]:
+    """The jobs of a job file, "-" reads one JSON job or list of jobs per line from stdin.
+    """
+    if file_path == "-":
+        documents = [json.loads(line) for line in sys.stdin if line.strip()]
+        base_dir = os.getcwd()
+    else:
+        with open(file_path, "r", encoding="utf-8") as file:
+            documents = [json.load(file)]
+        base_dir = os.path.dirname(os.path.abspath(file_path))
+    jobs = []
+    for document in documents:
+        for data in document if isinstance(document, list) else [document]:
+            jobs.append(parse_job(data, base_dir, len(jobs)))
+    return jobs
+
+
+def select_timesteps(columns: dict, dates: dict):
+    """Indices of the weather data within the date range and the hours of a job.
+    """
+    import numpy as np
+    mask = np.ones(len(columns["month"]), dtype=bool)
+    day = columns["month"] * 100 + columns["day"]
+    start_day = end_day = None
+    if "start" in dates:
+        month, first = (int(value) for value in dates["start"].split("-"))
+        start_day = month * 100 + first
+    if "end" in dates:
+        month, last = (int(value) for value in dates["end"].split("-"))
+        end_day = month * 100 + last
+    if start_day is not None and end_day is not None and start_day > end_day:
+        # a winter range goes over the new year
+        mask &= (day >= start_day) | (day <= end_day)
+    else:
+        if start_day is not None:
+            mask &= day >= start_day
+        if end_day is not None:
+            mask &= day <= end_day
+    if "hours" in dates:
+        first, end = dates["hours"]
+        mask &= (columns["hour"] >= first) & (columns["hour"] < end)
+    return np.flatnonzero(mask)
+
+
+class Runner:
+
+    def __init__(self, verbose: bool = True) -> None:
+        """Run jobs in this process, the weather files, engines and sky vectors are kept for the next jobs.
+        """
+        from sky import SkyTolerance, SkyVectorCache
+        self.verbose = verbose
+        self.weathers = {}
+        self.engines = {}
+        # exact keys, equal skies of different jobs are computed once
+        self.sky_cache = SkyVectorCache(SkyTolerance(0.0, 0.0, 0.0, 0.0))
+
+    def weather(self, file_path: str):
+        from weather import EpWeather
+        if file_path not in self.weathers:
+            self.weathers[file_path] = EpWeather(file_path)
+        return self.weathers[file_path]
+
+    def engine(self, illu_data, sensors: Optional[List[int]], cache: bool):
+        from cache import default_cache
+        from radiance import ThreePhaseEngine
+        key = (illu_data.vmx, illu_data.xml, illu_data.dmx, None if sensors is None else tuple(sensors), cache)
+        if key not in self.engines:
+            self.engines[key] = ThreePhaseEngine(illu_data, cache=default_cache() if cache else None, sensors=sensors)
+        return self.engines[key]
+
+    def sky(self, job: Job):
+        """The distinct skies of the selected time-steps and the sky of every time-step.
+        """
+        from cache import CACHE_DIR_ENV, DEFAULT_CACHE_DIR
+        from radiance import GendaylitMode
+        weather = self.weather(job.weather)
+        columns = weather.columns
+        index = select_timesteps(columns, job.dates)
+        altitude, azimuth = weather.get_alt_az(cache_dir=os.path.join(os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR), "sun"))
+        fields = {"W": ("direct_normal_radiation", "diffuse_horizontal_radiation"),
+                  "L": ("direct_normal_illuminance", "diffuse_horizontal_illuminance")}
+        if job.mode not in fields:
+            raise ValueError("job %s: mode %s is not one of %s" % (job.name, job.mode, ", ".join(fields)))
+        direct, diffuse = fields[job.mode]
+        # the solar azimuth goes from north to east, gendaylit measures it west of south
+        sky_matrix, inverse = self.sky_cache.sky_matrix(altitude[index], azimuth[index] - 180.0, columns[direct][index],
+                                                        columns[diffuse][index], GendaylitMode[job.mode], job.min_altitude)
+        return index, sky_matrix, inverse
+
+    def illuminance(self, job: Job, state, sky_matrix, inverse):
+        """Illuminance of one BSDF state with shape (sensors, timesteps).
+        """
+        import numpy as np
+        import radfiles
+        from radiance import IlluData, annual_illuminance
+        engines = []
+        for group in job.groups.values():
+            xml = group["xml"] if state is None else state if isinstance(state, str) else radfiles.get_type25_xml(state)
+            engines.append(self.engine(IlluData(dmx=group["dmx"], xml=xml, vmx=group["vmx"]), job.sensors, job.cache))
+        if job.memory_budget is None and job.dtype == "float64":
+            return annual_illuminance(engines, sky_matrix, inverse)
+        from tiling import tiled_illuminance
+        run = tiled_illuminance(engines, sky_matrix, job.memory_budget or 2 ** 62, job.dtype)
+        if self.verbose:
+            print(run.report())
+        # one column per distinct sky, scattered back to the time-steps
+        return np.take(run.lux, inverse, axis=1)
+
+    def run(self, job: Job) -> dict:
+        """Run a job and write its outputs.
+
+        Returns:
+            dict: name, time-steps, sensors and seconds of the job, and the written outputs.
+        """
+        import numpy as np
+        start = time.perf_counter()
+        index, sky_matrix, inverse = self.sky(job)
+        lux = np.stack([self.illuminance(job, state, sky_matrix, inverse) for state in job.bsdf])
+        outputs = job.outputs
+        written = []
+        if "lux" in outputs:
+            os.makedirs(os.path.dirname(os.path.abspath(outputs["lux"])), exist_ok=True)
+            np.save(outputs["lux"], lux)
+            written.append(outputs["lux"])
+        if "store" in outputs:
+            self.write_store(job, lux, outputs["store"])
+            written.append(outputs["store"])
+        if "metrics" in outputs:
+            self.write_metrics(job, lux, index, outputs["metrics"])
+            written.append(outputs["metrics"])
+        if "maps" in outputs:
+            from render import render_frames
+            maps = dict(outputs["maps"])
+            pattern = maps.pop("pattern")
+            paths = render_frames(lux.mean(axis=2), pattern=pattern, workers=maps.pop("workers", 1), **maps)
+            written += paths
+        summary = {"name": job.name, "timesteps": int(index.size), "sensors": int(lux.shape[1]),
+                   "variants": len(job.bsdf), "seconds": time.perf_counter() - start, "outputs": written}
+        if self.verbose:
+            print("%s: %d sensors x %d time-steps x %d variants in %.3f s" % (
+                job.name, summary["sensors"], summary["timesteps"], summary["variants"], summary["seconds"]))
+        return summary
+
+    def write_store(self, job: Job, lux, path: str) -> None:
+        from results import ResultStore, input_metadata
+        paths = {"weather": job.weather}
+        for name, group in job.groups.items():
+            paths.update({"%s_%s" % (name, kind): file_path for kind, file_path in group.items()})
+        metadata = input_metadata(paths)
+        metadata.update({"dates": job.dates, "mode": job.mode, "min_altitude": job.min_altitude})
+        store = ResultStore(path, sensors=lux.shape[1], variants=job.bsdf, metadata=metadata)
+        # a finished store is kept, a partial one is continued
+        if store.timesteps < lux.shape[2]:
+            store.append(lux[:, :, store.timesteps:].transpose(0, 2, 1))
+            store.flush()
+
+    def write_metrics(self, job: Job, lux, index, path: str) -> None:
+        import numpy as np
+        from metrics import daylight_metrics
+        occupancy = None
+        if job.occupancy is not None:
+            hour = self.weather(job.weather).columns["hour"][index]
+            occupancy = (hour >= job.occupancy.get("start", 0)) & (hour < job.occupancy.get("end", 25))
+        zones = None
+        if job.zones is not None:
+            zones = {}
+            for name, sensors in job.zones.items():
+                zones[name] = np.zeros(lux.shape[1], dtype=bool)
+                zones[name][sensors] = True
+        result = {}
+        for state, values in zip(job.bsdf, lux):
+            metrics = daylight_metrics(values, occupancy, zones)
+            # nan of empty or dark zones is written as null, bare NaN is not JSON
+            result[json.dumps(state)] = {
+                "daylight_autonomy": _json_number(metrics.daylight_autonomy.mean()),
+                "zones": {name: {"sDA": _json_number(zone.spatial_daylight_autonomy),
+                                 "ASE": _json_number(zone.annual_sunlight_exposure),
+                                 "UDI": [_json_number(value) for value in zone.useful_daylight_illuminance],
+                                 "uniformity": _json_number(zone.mean_uniformity)}
+                          for name, zone in metrics.zones.items()}}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"name": job.name, "udi_edges": list(metrics.udi_edges), "variants": result}, file, indent=2,
+                      allow_nan=False)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="radexp", description="Run the annual daylight simulations of JSON job files.")
+    parser.add_argument("jobs", nargs="+", help="job files, - reads one job per line from stdin")
+    parser.add_argument("-k", "--keep-going", action="store_true", help="run the other jobs after a failed one")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    parser.add_argument("--profile", metavar="DIR", help="write the stage metrics of every job to DIR, see profiling.py")
+    args = parser.parse_args(argv)
+
+    runner = None
+    failed = 0
+    for job_file in args.jobs:
+        try:
+            jobs = load_jobs(job_file)
+        except (OSError, ValueError, TypeError) as error:
+            print("radexp: %s: %s" % (job_file, error), file=sys.stderr)
+            failed += 1
+            if not args.keep_going:
+                return 1
+            continue
+        for job in jobs:
+            if runner is None:
+                runner = Runner(verbose=not args.quiet)
+            try:
+                if args.profile:
+                    import profiling
+                    with profiling.profile_run(args.profile, job.name, cprofile=False):
+                        runner.run(job)
+                else:
+                    runner.run(job)
+            except Exception as error:
+                print("radexp: job %s failed: %s: %s" % (job.name, type(error).__name__, error), file=sys.stderr)
+                failed += 1
+                if not args.keep_going:
+                    return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,7 @@ weather_data = os.path.join(current_dir, "weather")
 
 # the available weather
 CHN_ShanghaiCSWD = os.path.join(weather_data, "CHN_ShanghaiCSWD.epw")
+CHN_ShanghaiCSWD_wea = os.path.join(weather_data, "CHN_ShanghaiCSWD.wea")
 
 # the available vmx
 vmx_south = os.path.join(radfiles_vmx, "south.vmx")
@@ -32,7 +33,17 @@ def get_type25_xml(angle=None):
     else:
         return os.path.join(radfiles_xml, f"type25_angle{angle}.xml")
 
+def get_type25_angles():
+    """The slat angles of the available type25 xml files, None is the null angle."""
+    angles = []
+    for name in os.listdir(radfiles_xml):
+        if name.startswith("type25_angle") and name.endswith(".xml"):
+            angle = name[len("type25_angle"):-len(".xml")]
+            angles.append(None if angle == "null" else int(angle))
+    return sorted(angles, key=lambda angle: -1 if angle is None else angle)
+
 # skv for testing
 skv_063010 = os.path.join(radfiles_skv, "6_30_10.skv")
+skv_063012 = os.path.join(radfiles_skv, "6_30_12.skv")
 skv_063014 = os.path.join(radfiles_skv, "6_30_14.skv")
 skv_063018 = os.path.join(radfiles_skv, "6_30_18.skv")
\ No newline at end of file
@@ -1,14 +1,21 @@
+import io
 import os
 import numpy as np
-import pandas as pd
+import time
 import subprocess
-from matplotlib import pyplot as plt
-from matplotlib import cm
-from matplotlib import axes
-from mpl_toolkits.mplot3d import Axes3D
+import threading
+import profiling
+import xml.etree.ElementTree as ET
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from rmatrix import read_matrix, load_matrix, count_matrix_rows, matrix_bytes, matrix_header, \
+    MatrixRowIndex, MATRIX_FORMATS
+from cache import MatrixCache, inputs_key
+
+# matplotlib, pandas and "render" are imported by the functions that draw, so that
+# numeric runs start without them, see "radexp.py"
 
 class GendaylitMode(Enum):
     W  = 1 # direct-normal-irradiance diffuse-horizontal-irradiance (W/m^2)
@@ -20,6 +27,7 @@ class GendaylitMode(Enum):
 @dataclass
 class SkyData:
     altitude: float
+    # degrees west of south like gendaylit -ang, the azimuth of "weather.get_alt_az" minus 180
     azimuth: float
     # model W
     direct_normal_irradiance: float = None
@@ -35,6 +43,11 @@ class SkyData:
     global_horizontal_irradiance: float = None
 
 
+# luminous efficacy and RGB weights used to convert Radiance RGB to lux
+LUMINOUS_EFFICACY = 179.0
+RGB_WEIGHTS = (0.265, 0.670, 0.065)
+
+
 @dataclass
 class IlluData:
     dmx: str
@@ -50,12 +63,444 @@ def count_sensors_num(file_path: str) -> int:
     Returns:
         int: the number of sensors.
     """
-    count = 0
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            if line.strip() and line.strip()[0].isdigit():
-                count += 1
-    return count
+    # remembered per file version, the night time-steps of "dc_timestep_pipe" ask for it every hour
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _sensor_counts:
+        _sensor_counts[key] = count_matrix_rows(file_path)
+    return _sensor_counts[key]
+
+
+_sensor_counts: Dict[tuple, int] = {}
+
+
+def sensor_index(file_path: str) -> MatrixRowIndex:
+    """The row index of a vmx file, built once per file version, see "rmatrix.MatrixRowIndex".
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _sensor_indices:
+        _sensor_indices[key] = MatrixRowIndex(file_path)
+    return _sensor_indices[key]
+
+
+_sensor_indices: Dict[tuple, MatrixRowIndex] = {}
+
+
+def grid_region(height: int, weight: int, rows: Tuple[int, int], columns: Tuple[int, int], bias: int = 1) -> List[int]:
+    """The sensor indices of a rectangle of the grid drawn by "drawHotMap3D".
+
+    The sensors are stored row by row, height sensors per row and weight rows, the last
+    bias sensors of every row are not drawn.
+
+    Args:
+        height (int): sensors per grid row.
+        weight (int): number of grid rows.
+        rows (tuple[int, int]): first and end (exclusive) grid row.
+        columns (tuple[int, int]): first and end (exclusive) sensor of a row.
+        bias (int): sensors at the end of every row left out of the grid.
+
+    Returns:
+        list[int]: sensor indices, row by row.
+    """
+    rows = range(max(rows[0], 0), min(rows[1], weight))
+    columns = range(max(columns[0], 0), min(columns[1], height - bias))
+    return [row * height + column for row in rows for column in columns]
+
+
+def klems_lambda(angle_basis: ET.Element) -> np.ndarray:
+    """Projected solid angle of each patch of a Klems angle basis.
+
+    Args:
+        angle_basis (Element): AngleBasis element of a BSDF xml.
+
+    Returns:
+        np.ndarray: projected solid angle per patch, 145 values for Klems full.
+    """
+    ns = {"w": "http://windows.lbl.gov"}
+    lambdas = []
+    for block in angle_basis.findall("w:AngleBasisBlock", ns):
+        n_phis = int(block.findtext("w:nPhis", namespaces=ns))
+        lower = np.radians(float(block.findtext("w:ThetaBounds/w:LowerTheta", namespaces=ns)))
+        upper = np.radians(float(block.findtext("w:ThetaBounds/w:UpperTheta", namespaces=ns)))
+        lambdas += [np.pi * (np.sin(upper) ** 2 - np.sin(lower) ** 2) / n_phis] * n_phis
+    return np.array(lambdas)
+
+
+def load_klems_xml(file_path: str, direction: str = "Transmission Front") -> np.ndarray:
+    """Load the visible Klems transmission matrix of a BSDF xml like dctimestep does.
+
+    The BTDF values are weighted by the projected solid angle of the incident
+    patches, so the result can be used directly in V·T·D·s.
+
+    Args:
+        file_path (str): BSDF xml path, e.g. radfiles.xml_angle_null.
+        direction (str): WavelengthDataDirection to read, "Transmission Back" is used
+            when the front transmission is missing.
+
+    Returns:
+        np.ndarray: transmission matrix with shape (outgoing, incident), 145 x 145 for Klems full.
+    """
+    ns = {"w": "http://windows.lbl.gov"}
+    with profiling.stage("parse_xml") as record:
+        root = ET.parse(file_path).getroot()
+        record.count(bytes_read=os.path.getsize(file_path))
+    bases = {}
+    for basis in root.iter("{http://windows.lbl.gov}AngleBasis"):
+        bases[basis.findtext("w:AngleBasisName", namespaces=ns)] = klems_lambda(basis)
+    blocks = {}
+    for wavelength_data in root.iter("{http://windows.lbl.gov}WavelengthData"):
+        if wavelength_data.findtext("w:Wavelength", namespaces=ns) != "Visible":
+            continue
+        for block in wavelength_data.findall("w:WavelengthDataBlock", ns):
+            blocks[block.findtext("w:WavelengthDataDirection", namespaces=ns)] = block
+    block = blocks.get(direction, blocks.get("Transmission Back"))
+    if block is None:
+        raise ValueError("no visible transmission data in %s" % file_path)
+    lambdas = bases[block.findtext("w:ColumnAngleBasis", namespaces=ns)]
+    values = block.findtext("w:ScatteringData", namespaces=ns).replace(",", " ").split()
+    btdf = np.array(values, dtype=np.float64).reshape(len(lambdas), len(lambdas))
+    # "Columns": every text row is one outgoing direction.
+    if root.findtext(".//w:IncidentDataStructure", namespaces=ns) == "Rows":
+        btdf = btdf.T
+    return btdf * lambdas[np.newaxis, :]
+
+
+class ThreePhaseEngine:
+
+    def __init__(self, illu_data: IlluData, cache: Optional[MatrixCache] = None, tolerance: Optional[float] = None,
+                 compress: str = "vtd", sensors: Optional[List[int]] = None, factors: Optional[str] = None) -> None:
+        """Three-phase method computed in-process with numpy, replacing dctimestep.
+
+        The view, transmission and daylight matrices are loaded once on first use,
+        after that every time-step is only a matrix multiplication. With a cache the
+        parsed BSDF, the V·T product of single skies and the V·T·D product of sky
+        matrices are kept on disk, so a run where only the sky changes does not load
+        the view matrix or the BSDF again.
+
+        With a tolerance the daylight matrix or the V·T·D product is replaced by its
+        truncated SVD, see "lowrank.compress_matrix". A V·T·D whose factors would not be
+        smaller than itself, e.g. of a few sensors, is kept dense.
+
+        With sensors only those rows of the view matrix are read and every result has one
+        row per chosen sensor, e.g. the control points of a "grid_region".
+
+        Args:
+            illu_data (IlluData): contain dmx, vmx and xml
+            cache (MatrixCache): cache of the BSDF and V·T·D, see "cache.default_cache".
+            tolerance (float): relative error of the compressed matrix, None does not compress.
+            compress (str): "vtd" compresses V·T·D, "daylight" compresses D.
+            sensors (list[int]): rows of the vmx to evaluate, all sensors by default.
+            factors (str): name of the factors of the compressed matrix, see "lowrank.save_lowrank".
+                They are read when they exist, were computed from the same inputs and sensors and
+                with a tolerance at most tolerance, written otherwise.
+        """
+        if compress not in ("vtd", "daylight"):
+            raise ValueError("unknown compressed matrix %s" % compress)
+        self.illu_data = illu_data
+        self.cache = cache
+        self.tolerance = tolerance
+        self.compress = compress
+        self.sensors = None if sensors is None else np.asarray(sensors, dtype=np.int64)
+        self.factors = factors
+        self._view = None
+        self._transmission = None
+        self._daylight = None
+        self._vt = None
+        self._vtd = None
+        self._lowrank = None
+        self._lowrank_dense = False
+
+    @property
+    def view(self) -> np.ndarray:
+        """View matrix with shape (sensors, 145, 3)."""
+        if self._view is None:
+            if self.sensors is None:
+                self._view = load_matrix(self.illu_data.vmx).astype(np.float64)
+            else:
+                with profiling.stage("matrix_load_rows"):
+                    self._view = sensor_index(self.illu_data.vmx).read(self.sensors).astype(np.float64)
+        return self._view
+
+    @property
+    def transmission(self) -> np.ndarray:
+        """Transmission matrix with shape (145, 145)."""
+        if self._transmission is None:
+            if self.cache is None:
+                self._transmission = load_klems_xml(self.illu_data.xml)
+            else:
+                key = self.cache.key("klems", [self.illu_data.xml])
+                self._transmission = self.cache.get_or_compute(key, lambda: load_klems_xml(self.illu_data.xml))
+        return self._transmission
+
+    @property
+    def daylight(self) -> np.ndarray:
+        """Daylight matrix with shape (145, 2306, 3), mapped so that processes share the page cache."""
+        if self._daylight is None:
+            self._daylight = load_matrix(self.illu_data.dmx, mmap=True)
+        return self._daylight
+
+    @property
+    def sensors_num(self) -> int:
+        if self._vtd is not None:
+            return self._vtd.shape[0]
+        if self._vt is not None:
+            return self._vt.shape[0]
+        if self._view is not None:
+            return self._view.shape[0]
+        if self.sensors is not None:
+            return len(self.sensors)
+        return count_sensors_num(self.illu_data.vmx)
+
+    def _params(self) -> tuple:
+        # cache key parameters of the sensor subset
+        return () if self.sensors is None else (self.sensors.tolist(),)
+
+    def dc_timestep(self, sky: Union[str, np.ndarray]) -> np.ndarray:
+        """Compute V·T·D·s for the three channels.
+
+        Args:
+            sky (str | np.ndarray): skv file path or sky vector with shape (2306, 3) or (2306, 1, 3).
+
+        Returns:
+            np.ndarray: RGB values of each photo cell, shape (sensors, 3).
+        """
+        if isinstance(sky, str):
+            sky = load_matrix(sky)
+        sky = np.asarray(sky, dtype=np.float64).reshape(-1, 3)
+        if self.tolerance is not None:
+            return self.lowrank_rgb(sky)
+        rgb = np.empty((self.sensors_num, 3))
+        if self._vtd is not None:
+            # a V·T·D already built for a sky matrix is one product per channel
+            with profiling.stage("multiply"):
+                for channel in range(3):
+                    rgb[:, channel] = self._vtd[:, :, channel] @ sky[:, channel]
+            return rgb
+        # one sky does not pay off the sensors x 2306 V·T·D, multiply from the sky side,
+        # the intermediate vectors only have 145 rows. With a cache V·T is read from it.
+        view_transmission, daylight = self.view_transmission(), self.daylight
+        with profiling.stage("multiply"):
+            for channel in range(3):
+                rgb[:, channel] = view_transmission[:, :, channel] @ (daylight[:, :, channel] @ sky[:, channel])
+        return rgb
+
+    def view_transmission(self) -> np.ndarray:
+        """The V·T product, computed on the first call or read from the cache.
+
+        Returns:
+            np.ndarray: view matrix through the BSDF with shape (sensors, 145, 3).
+        """
+        if self._vt is None:
+            if self.cache is None:
+                self._vt = self._compute_vt()
+            else:
+                key = self.cache.key("vt", [self.illu_data.vmx, self.illu_data.xml], *self._params())
+                self._vt = self.cache.get_or_compute(key, self._compute_vt)
+        return self._vt
+
+    def _compute_vt(self) -> np.ndarray:
+        view, transmission = self.view, self.transmission
+        view_transmission = np.empty(view.shape[:1] + transmission.shape[1:] + (3,))
+        for channel in range(3):
+            view_transmission[:, :, channel] = view[:, :, channel] @ transmission
+        return view_transmission
+
+    def vtd(self) -> np.ndarray:
+        """The combined V·T·D product, computed on the first call or read from the cache.
+
+        Returns:
+            np.ndarray: daylight coefficients with shape (sensors, 2306, 3).
+        """
+        if self._vtd is None:
+            if self.cache is None:
+                self._vtd = self._compute_vtd()
+            else:
+                illu_data = self.illu_data
+                key = self.cache.key("vtd", [illu_data.vmx, illu_data.xml, illu_data.dmx], *self._params())
+                self._vtd = self.cache.get_or_compute(key, self._compute_vtd)
+        return self._vtd
+
+    def lowrank(self):
+        """The compressed V·T·D or daylight matrix, computed on the first call or read from
+        the factors files or the cache.
+
+        Returns:
+            lowrank.LowRankMatrix: the factors, None when the V·T·D is kept dense.
+        """
+        if self._lowrank is None and not self._lowrank_dense:
+            from lowrank import LowRankMatrix, compress_matrix, load_lowrank, save_lowrank
+            if self.compress == "vtd":
+                inputs = [self.illu_data.vmx, self.illu_data.xml, self.illu_data.dmx]
+                compute = lambda: compress_matrix(self.vtd(), self.tolerance)
+                shape = (self.sensors_num, self.daylight.shape[1])
+            else:
+                inputs = [self.illu_data.dmx]
+                compute = lambda: compress_matrix(self.daylight, self.tolerance)
+                shape = self.daylight.shape[:2]
+            params = (self.compress,) + (self._params() if self.compress == "vtd" else ())
+            matrix = None
+            if self.factors is not None:
+                # the input files, the target and the sensors the factors were computed from
+                source = inputs_key("lowrank", inputs, *params, mode="stat" if self.cache is None else self.cache.key_mode)
+                if os.path.exists(self.factors + ".left.mtx") and os.path.exists(self.factors + ".right.mtx"):
+                    matrix = load_lowrank(self.factors)
+                    # factors of other inputs or of a coarser tolerance are computed again
+                    if matrix.source != source or matrix.shape[:2] != tuple(shape) or matrix.tolerance > self.tolerance:
+                        matrix = None
+            loaded = matrix is not None
+            if not loaded and self.cache is None:
+                matrix = compute()
+            elif not loaded:
+                # the factors and the ranks are cached as two arrays
+                keys = [self.cache.key("lowrank_" + part, inputs, self.compress, self.tolerance, *params[1:])
+                        for part in ("left", "right")]
+                left, right = self.cache.get(keys[0]), self.cache.get(keys[1])
+                if left is None or right is None:
+                    matrix = compute()
+                    self.cache.put(keys[0], matrix.left)
+                    self.cache.put(keys[1], matrix.right)
+                    left, right = matrix.left, matrix.right
+                # the padding of the lower rank channels is zero
+                ranks = tuple(int(np.count_nonzero(np.any(right[:, :, channel] != 0, axis=1))) for channel in range(3))
+                matrix = LowRankMatrix(left, right, ranks, self.tolerance)
+            # (sensors + 2306) x rank is not always below sensors x 2306, then V·T·D stays dense
+            if self.compress == "vtd" and matrix.nbytes >= shape[0] * shape[1] * 3 * 8:
+                self._lowrank_dense = True
+            else:
+                if self.factors is not None and not loaded:
+                    matrix.source = source
+                    save_lowrank(self.factors, matrix)
+                self._lowrank = matrix
+        return self._lowrank
+
+    def lowrank_rgb(self, sky: np.ndarray) -> np.ndarray:
+        """V·T·D·s with the compressed matrix.
+
+        Args:
+            sky (np.ndarray): sky vector (2306, 3) or sky matrix (2306, timesteps, 3).
+
+        Returns:
+            np.ndarray: RGB values with shape (sensors, 3) or (sensors, timesteps, 3).
+        """
+        if self.compress == "vtd":
+            lowrank = self.lowrank()
+            if lowrank is not None:
+                return lowrank.apply(sky)
+            vtd = self.vtd()
+            rgb = np.empty((vtd.shape[0],) + sky.shape[1:])
+            for channel in range(3):
+                rgb[..., channel] = vtd[:, :, channel] @ sky[..., channel]
+            return rgb
+        window = self.lowrank().apply(sky)
+        rgb = np.empty((self.sensors_num,) + window.shape[1:])
+        for channel in range(3):
+            rgb[..., channel] = self.view[:, :, channel] @ (self.transmission @ window[..., channel])
+        return rgb
+
+    def _compute_vtd(self) -> np.ndarray:
+        view_transmission, daylight = self.view_transmission(), self.daylight
+        with profiling.stage("multiply_vtd"):
+            vtd = np.empty((view_transmission.shape[0], daylight.shape[1], 3))
+            for channel in range(3):
+                vtd[:, :, channel] = view_transmission[:, :, channel] @ daylight[:, :, channel]
+        return vtd
+
+    def illuminance(self, sky_matrix: np.ndarray) -> np.ndarray:
+        """Compute the illuminance of many time-steps with one matrix product.
+
+        Args:
+            sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3), see "gen_sky_matrix".
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (sensors, timesteps).
+        """
+        return annual_illuminance([self], sky_matrix)
+
+
+def rgb_to_lux(rgb: np.ndarray) -> np.ndarray:
+    """Vectorized version of "rgb2lux", the last axis holds the RGB channels.
+
+    Args:
+        rgb (np.ndarray): RGB values with shape (..., 3).
+
+    Returns:
+        np.ndarray: illuminance (lux) with shape (...).
+    """
+    return LUMINOUS_EFFICACY * (np.asarray(rgb) @ np.array(RGB_WEIGHTS))
+
+
+def annual_illuminance(engines: List[ThreePhaseEngine], sky_matrix: np.ndarray, inverse: Optional[np.ndarray] = None) -> np.ndarray:
+    """Compute the illuminance of all time-steps, summed over the window groups.
+
+    The luminous efficacy weighting is folded into the V·T·D products first, so a
+    grey sky (genskyvec/gendaymtx "-c 1 1 1") costs one matrix product per group.
+
+    Args:
+        engines (list[ThreePhaseEngine]): one engine per window group, with the same sensors.
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+        inverse (np.ndarray): sky of every time-step when sky_matrix only holds the distinct
+            skies, see "sky.SkyVectorCache.sky_matrix".
+
+    Returns:
+        np.ndarray: illuminance (lux) with shape (sensors, timesteps).
+    """
+    weights = LUMINOUS_EFFICACY * np.array(RGB_WEIGHTS)
+    grey = np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 1]) and \
+        np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 2])
+    lux = np.zeros((engines[0].sensors_num, sky_matrix.shape[1]))
+    for engine in engines:
+        if engine.tolerance is not None:
+            engine.lowrank()
+            with profiling.stage("multiply_lowrank"):
+                lux += engine.lowrank_rgb(sky_matrix) @ weights
+            continue
+        vtd = engine.vtd()
+        with profiling.stage("multiply"):
+            if grey:
+                lux += (vtd @ weights) @ sky_matrix[:, :, 0]
+            else:
+                for channel in range(3):
+                    lux += weights[channel] * (vtd[:, :, channel] @ sky_matrix[:, :, channel])
+    if inverse is not None:
+        return lux[:, inverse]
+    return lux
+
+
+class DctimestepError(RuntimeError):
+
+    def __init__(self, command: List[str], returncode: Optional[int], stderr: Union[str, bytes]) -> None:
+        """A Radiance process that failed, with its command line, exit status and messages.
+        """
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode("utf-8", errors="ignore")
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr.strip()
+        super().__init__("%s exited with status %s: %s" % (" ".join(command), returncode, self.stderr or "no message"))
+
+
+def gen_sky_matrix(wea_path: str, mf: int = 4) -> np.ndarray:
+    """Generate the annual sky matrix of a wea file with a single gendaymtx run.
+
+    Args:
+        wea_path (str): wea weather file, see "EpWeather.write_wea".
+        mf (int): Reinhart subdivision, 4 gives the 2306 patches of the dmx files.
+
+    Raises:
+        RuntimeError: process command failed.
+
+    Returns:
+        np.ndarray: sky matrix with shape (2306, timesteps, 3).
+    """
+    command = ["gendaymtx", "-m", str(mf), "-c", "1", "1", "1", "-of", wea_path]
+    with profiling.stage("gendaymtx") as record:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        record.count(bytes_read=len(process.stdout), processes=1)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.decode("utf-8", errors="ignore"))
+    with profiling.stage("parse_matrix"):
+        return read_matrix(io.BytesIO(process.stdout), "gendaymtx")
 
 
 def dc_timestep(view, transmission, daylight, sky, save_path = "", option="", if_print=False):
@@ -76,18 +521,93 @@ def dc_timestep(view, transmission, daylight, sky, save_path = "", option="", if
     if if_print:
         print(command)
     # os.system(command)
-    process = subprocess.Popen(["dctimestep", "-h", view, transmission, daylight, sky], \
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate()
-    if stderr != '':
-        raise RuntimeError
-    rgb_lines = stdout.strip().split('\n')
-    rgb_list = []
-    for line in rgb_lines:
-        r, g, b = map(float, line.strip().split())
-        rgb_list.append((r, g, b))
+    with profiling.stage("dctimestep") as record:
+        process = subprocess.Popen(["dctimestep", "-h", view, transmission, daylight, sky], \
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        stdout, stderr = process.communicate()
+        record.count(bytes_read=len(stdout), processes=1)
+    if stderr != '' or process.returncode != 0:
+        raise DctimestepError(process.args, process.returncode, stderr)
+    with profiling.stage("parse_rgb"):
+        rgb_lines = stdout.strip().split('\n')
+        rgb_list = []
+        for line in rgb_lines:
+            r, g, b = map(float, line.strip().split())
+            rgb_list.append((r, g, b))
     return rgb_list
 
+def gendaylit_command(sky_data: SkyData, mode: GendaylitMode = GendaylitMode.W) -> List[str]:
+    """Build the gendaylit command of a sky.
+
+    Args:
+        sky_data (SkyData): altitude, azimuth and the values of the mode.
+        mode (GendaylitMode): gendaylit mode.
+
+    Returns:
+        list[str]: gendaylit command.
+    """
+    if mode == GendaylitMode.W:
+        return ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-W", str(sky_data.direct_normal_irradiance), str(sky_data.diffusion_horizonttal_irradiance)]
+    elif mode == GendaylitMode.L:
+        return ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-L", str(sky_data.direct_normal_illuminance), str(sky_data.diffusion_horizonttal_illumiance)]
+    elif mode == GendaylitMode.G:
+        return ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-G", str(sky_data.direct_horizontal_irradiance), str(sky_data.diffusion_horizonttal_irradiance)]
+    elif mode == GendaylitMode.E:
+        return ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-E", str(sky_data.global_horizontal_irradiance)]
+    else:
+        raise NotImplementedError
+
+
+def gen_sky_vector(sky_data: SkyData, min_altitude: float = 0.0, mode: GendaylitMode = GendaylitMode.W,
+                   cache=None) -> np.ndarray:
+    """Generate a sky vector in-process, the same sky as gendaylit | genskyvec -m 4 -c 1 1 1.
+
+    Args:
+        sky_data (SkyData): contain altitude, azimuth and the values of the mode.
+        min_altitude (float): skies with a lower solar altitude are dark, see "dc_timestep_pipe".
+        mode (GendaylitMode): gendaylit mode.
+        cache (sky.SkyVectorCache): reuse the vectors of equal skies.
+
+    Returns:
+        np.ndarray: sky vector with shape (2306, 3).
+    """
+    # sky imports this module
+    from sky import perez_sky_vector
+    with profiling.stage("sky_vector"):
+        if cache is not None:
+            return cache.sky_vector(sky_data, mode=mode, min_altitude=min_altitude)
+        return perez_sky_vector(sky_data, mode=mode, min_altitude=min_altitude)
+
+
+def gen_sky_vector_pipe(sky_data: SkyData, min_altitude: float = 0.0, mode: GendaylitMode = GendaylitMode.W) -> np.ndarray:
+    """Generate a sky vector with gendaylit | genskyvec without writing a skv file.
+
+    Args:
+        sky_data (SkyData): contain altitude, azimuth and the values of the mode.
+        min_altitude (float): skies with a lower solar altitude are dark, see "dc_timestep_pipe".
+        mode (GendaylitMode): gendaylit mode.
+
+    Raises:
+        RuntimeError: process command failed.
+
+    Returns:
+        np.ndarray: sky vector with shape (2306, 3).
+    """
+    if sky_data.altitude < min_altitude:
+        return np.zeros((2306, 3))
+    command_1 = gendaylit_command(sky_data, mode)
+    command_2 = ["genskyvec", "-m", "4", "-c", "1", "1", "1"]
+    with profiling.stage("gendaylit|genskyvec") as record:
+        with subprocess.Popen(command_1, stdout=subprocess.PIPE) as process_1:
+            with subprocess.Popen(command_2, stdin=process_1.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process_2:
+                stdout, stderr = process_2.communicate()
+        record.count(bytes_read=len(stdout), processes=2)
+    if process_2.returncode != 0:
+        raise RuntimeError(stderr.decode("utf-8", errors="ignore"))
+    with profiling.stage("parse_matrix"):
+        return read_matrix(io.BytesIO(stdout), "genskyvec").reshape(-1, 3)
+
+
 def dc_timestep_pipe(sky_data: SkyData, illu_data: IlluData, min_altitude: float= 0.0, mode: GendaylitMode = GendaylitMode.W) -> List[Tuple[float]]:
     """Use pipe to compute annual simulation time-step(s) via matrix multiplication, which avoid outputing files.
 
@@ -99,7 +619,7 @@ def dc_timestep_pipe(sky_data: SkyData, illu_data: IlluData, min_altitude: float
             the atmospheric mass value will become very large, enven exceding the upper limit set by the Radiance software.
             Radiance will raise a warning:air mass has reached the maximal value. Set min_altitude to  avoid it.
     Raises:
-        RuntimeError: process command failed.
+        DctimestepError: a process failed, with the command and its messages.
 
     Returns:
         list[tuple(3)]: RGB list 
@@ -109,75 +629,237 @@ def dc_timestep_pipe(sky_data: SkyData, illu_data: IlluData, min_altitude: float
         return rgb_list
 
     # print(sky_data.altitude, sky_data.azimuth, sky_data.direct_normal_irradiance, sky_data.diffusion_horizonttal_irradiance)
-    if mode == GendaylitMode.W:
-        command_1 = ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-W", str(sky_data.direct_normal_irradiance), str(sky_data.diffusion_horizonttal_irradiance)]
-    elif mode == GendaylitMode.L:
-        command_1 = ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-L", str(sky_data.direct_normal_illuminance), str(sky_data.diffusion_horizonttal_illumiance)]
-    else: 
-        raise NotImplementedError
-    
+    command_1 = gendaylit_command(sky_data, mode)
     command_2 = ["genskyvec", "-m", "4", "-c", "1", "1", "1"]
     command_3 = ["dctimestep", "-h", illu_data.vmx, illu_data.xml, illu_data.dmx]
     # 使用with确保io及时关闭
-    with subprocess.Popen(command_1, stdout=subprocess.PIPE) as process_1:
-        with subprocess.Popen(command_2, stdin=process_1.stdout, stdout=subprocess.PIPE) as process_2:
-            with subprocess.Popen(command_3, stdin=process_2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process_3:
-                stdout, stderr = process_3.communicate()
+    with profiling.stage("gendaylit|genskyvec|dctimestep") as record:
+        with subprocess.Popen(command_1, stdout=subprocess.PIPE) as process_1:
+            with subprocess.Popen(command_2, stdin=process_1.stdout, stdout=subprocess.PIPE) as process_2:
+                with subprocess.Popen(command_3, stdin=process_2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process_3:
+                    stdout, stderr = process_3.communicate()
+        record.count(bytes_read=len(stdout), processes=3)
     # process_1 = subprocess.Popen(command_1, stdout=subprocess.PIPE)
     # process_2 = subprocess.Popen(command_2, stdin=process_1.stdout, stdout=subprocess.PIPE)
     # process_3 = subprocess.Popen(command_3, stdin=process_2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
     # stdout, stderr = process_3.communicate()
 
-    if stderr != '':
-        raise RuntimeError
-    rgb_lines = stdout.strip().split('\n')
-    rgb_list = []
-    for line in rgb_lines:
-        r, g, b = map(float, line.strip().split())
-        rgb_list.append((r, g, b))
-    return rgb_list
-
-def dc_timestep_group(sky_data: SkyData, illu_group: List[IlluData]):
-    # not work!
-    command_1 = ["gendaylit", "-ang", str(sky_data.altitude), str(sky_data.azimuth), "-W", str(sky_data.direct_normal_irradiance), str(sky_data.diffusion_horizonttal_irradiance)]
-    command_2 = ["genskyvec", "-m", "4", "-c", "1", "1", "1"]
-    process_1 = subprocess.Popen(command_1, stdout=subprocess.PIPE)
-    process_2 = subprocess.Popen(command_2, stdin=process_1.stdout, stdout=subprocess.PIPE)
-
-
-    rgb_group = []
-
-    for illu_data in illu_group:
-        command_3 = ["dctimestep", "-h", illu_data.vmx, illu_data.xml, illu_data.dmx]
-        process_3 = subprocess.Popen(command_3, stdin=process_2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process_3.communicate()
-        if stderr != '':
-            print(stderr)
-            raise RuntimeError
+    if stderr != '' or process_3.returncode != 0:
+        raise DctimestepError(command_3, process_3.returncode, stderr)
+    with profiling.stage("parse_rgb"):
         rgb_lines = stdout.strip().split('\n')
         rgb_list = []
         for line in rgb_lines:
             r, g, b = map(float, line.strip().split())
             rgb_list.append((r, g, b))
-        rgb_group.append(rgb_list)
-    return rgb_group
+    return rgb_list
+
+@dataclass
+class GroupResult:
+    # RGB of every group, each with shape (sensors, 3)
+    rgb: List[np.ndarray]
+    # illuminance (lux) of all groups together, shape (sensors,)
+    lux: np.ndarray
+
+
+def dctimestep_sky(illu_data: IlluData, sky: bytes) -> np.ndarray:
+    """Run dctimestep for one group with the sky vector written to its stdin.
+
+    Args:
+        illu_data (IlluData): contain dmx, vmx and xml
+        sky (bytes): sky vector in the Radiance matrix format, see "rmatrix.matrix_bytes".
+
+    Raises:
+        DctimestepError: a process failed, with the command and its messages.
 
+    Returns:
+        np.ndarray: RGB values of each photo cell, shape (sensors, 3).
+    """
+    command = ["dctimestep", "-h", illu_data.vmx, illu_data.xml, illu_data.dmx]
+    with profiling.stage("dctimestep") as record:
+        process = subprocess.run(command, input=sky, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        record.count(bytes_read=len(process.stdout), processes=1)
+    if process.returncode != 0 or process.stderr:
+        raise DctimestepError(command, process.returncode, process.stderr)
+    with profiling.stage("parse_rgb"):
+        return np.array(process.stdout.split(), dtype=np.float64).reshape(-1, 3)
+
+
+def dc_timestep_group(sky_data: SkyData, illu_group: List[IlluData], min_altitude: float = 0.0, mode: GendaylitMode = GendaylitMode.W,
+                      workers: Optional[int] = None, executor: str = "thread", sky_cache=None) -> GroupResult:
+    """Compute a time-step of several window groups, the sky is generated once and shared by all groups.
+
+    Every group runs its own dctimestep in parallel, so the wall time is about that of the slowest group.
+
+    Args:
+        sky_data (SkyData): contain altitude, azimuth and the values of the mode.
+        illu_group (list[IlluData]): one IlluData per window group, with the same sensors.
+        min_altitude (float): skies with a lower solar altitude are dark, see "dc_timestep_pipe".
+        mode (GendaylitMode): gendaylit mode.
+        workers (int): pool size, one worker per group by default.
+        executor (str): "thread" or "process" pool.
+        sky_cache (sky.SkyVectorCache): reuse the sky vectors of equal skies, see "gen_sky_vector".
+
+    Raises:
+        DctimestepError: a process failed, with the command and its messages.
 
-def view_matrix(octree, photocells, window_material, if_print=False):
+    Returns:
+        GroupResult: RGB of every group and the combined illuminance.
     """
-    compute the view matrix by the view file.
-    There may be some wrongs in native-windows.
-    :param octree: the window must be replaced by a glazing material
-    :param photocells: points in time illuminance or luminance result
-    :param window_material: the glazing materials of the window
-    :return: view_matrix
+    if sky_data.altitude < min_altitude:
+        rgb_group = [np.zeros((count_sensors_num(illu_data.vmx), 3)) for illu_data in illu_group]
+    else:
+        sky = matrix_bytes(gen_sky_vector(sky_data, min_altitude=min_altitude, mode=mode, cache=sky_cache), "float")
+        if executor == "thread":
+            pool = ThreadPoolExecutor(max_workers=workers or len(illu_group))
+        elif executor == "process":
+            pool = ProcessPoolExecutor(max_workers=workers or len(illu_group))
+        else:
+            raise ValueError("unknown executor %s" % executor)
+        with pool:
+            rgb_group = list(pool.map(dctimestep_sky, illu_group, [sky] * len(illu_group)))
+    return GroupResult(rgb_group, rgb_to_lux(sum(rgb_group)))
+
+
+def _write_sky(stream, sky_matrix: np.ndarray, block_patches: int = 64) -> None:
+    # the sky matrix is written a block of patches at a time, never as one big bytes object
+    try:
+        stream.write(matrix_header(sky_matrix.shape, "float"))
+        for start in range(0, sky_matrix.shape[0], block_patches):
+            stream.write(np.ascontiguousarray(sky_matrix[start:start + block_patches], dtype="<f4").tobytes())
+    except (BrokenPipeError, OSError):
+        # the process died, its exit status and stderr tell why
+        pass
+    finally:
+        try:
+            stream.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def dctimestep_stream(illu_data: IlluData, sky_matrix: np.ndarray, data_format: str = "float",
+                      block_sensors: int = 256) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Run one dctimestep over all time-steps of a sky matrix and read its binary output in blocks of sensors.
+
+    The sky matrix is written to the stdin of the process by a thread and stderr is
+    drained by another one, so none of the pipes can fill up and block the others.
+    dctimestep writes the result sensor by sensor, every sensor row holds all the
+    time-steps, so a block is ready as soon as its rows arrived.
+
+    Args:
+        illu_data (IlluData): contain dmx, vmx and xml
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3), e.g. "gen_sky_matrix".
+        data_format (str): "float" or "double" output of dctimestep.
+        block_sensors (int): sensors per block.
+
+    Raises:
+        DctimestepError: dctimestep failed or its output was short, with the command and its messages.
+
+    Yields:
+        tuple[slice, np.ndarray]: the sensors of the block and their RGB values (block, timesteps, 3).
     """
-    command = "rcontrib -f klems_full.cal -b kbinS -bn Nkbins -m "+window_material + " -I+ \
-    -ab 12 -ad 50000 -lw 2e-5 " + octree + " < " + photocells
-    print(command)
-    matrix = os.system(command)
-    return matrix
+    if data_format not in MATRIX_FORMATS:
+        raise ValueError("unsupported output format %s" % data_format)
+    dtype = np.dtype(MATRIX_FORMATS[data_format])
+    sensors_num = count_sensors_num(illu_data.vmx)
+    timesteps = sky_matrix.shape[1]
+    row_bytes = timesteps * 3 * dtype.itemsize
+    command = ["dctimestep", "-h", "-o" + data_format[0], illu_data.vmx, illu_data.xml, illu_data.dmx]
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = []
+    writer = threading.Thread(target=_write_sky, args=(process.stdin, sky_matrix), daemon=True)
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    writer.start()
+    reader.start()
+    bytes_read = 0
+    try:
+        for start in range(0, sensors_num, block_sensors):
+            stop = min(start + block_sensors, sensors_num)
+            data = process.stdout.read((stop - start) * row_bytes)
+            bytes_read += len(data)
+            if len(data) < (stop - start) * row_bytes:
+                process.wait()
+                reader.join()
+                raise DctimestepError(command, process.returncode, b"".join(stderr) or
+                                      b"output ends after %d of %d bytes" % (bytes_read, sensors_num * row_bytes))
+            yield slice(start, stop), np.frombuffer(data, dtype=dtype).reshape(stop - start, timesteps, 3)
+        process.stdout.close()
+        process.wait()
+        writer.join()
+        reader.join()
+        if process.returncode != 0:
+            raise DctimestepError(command, process.returncode, b"".join(stderr))
+    finally:
+        if process.poll() is None:
+            # the caller stopped early
+            process.kill()
+            process.wait()
+        for stream in (process.stdout, process.stderr):
+            stream.close()
+        if profiling.metrics.enabled:
+            profiling.metrics.add("dctimestep_stream", wall_time=time.perf_counter() - start_time,
+                                  bytes_read=bytes_read, processes=1)
+
+
+def annual_illuminance_pipe(illu_group: List[IlluData], sky_matrix: np.ndarray, data_format: str = "float",
+                            block_sensors: int = 256) -> np.ndarray:
+    """The Radiance version of "annual_illuminance", for validation runs.
+
+    Every window group runs a single dctimestep for all time-steps, the groups in
+    parallel, instead of a pipeline per group and time-step as "dc_timestep_pipe".
+
+    Args:
+        illu_group (list[IlluData]): one IlluData per window group, with the same sensors.
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+        data_format (str): "float" or "double" output of dctimestep.
+        block_sensors (int): sensors converted to lux at once.
+
+    Raises:
+        DctimestepError: a dctimestep failed, with the command and its messages.
+
+    Returns:
+        np.ndarray: illuminance (lux) with shape (sensors, timesteps).
+    """
+    def group_lux(illu_data: IlluData) -> np.ndarray:
+        lux = np.empty((count_sensors_num(illu_data.vmx), sky_matrix.shape[1]))
+        for sensors, rgb in dctimestep_stream(illu_data, sky_matrix, data_format, block_sensors):
+            lux[sensors] = rgb_to_lux(rgb)
+        return lux
+
+    with ThreadPoolExecutor(max_workers=len(illu_group)) as pool:
+        return sum(pool.map(group_lux, illu_group))
+
+
+def view_matrix(octree, photocells, window_material, output=None, klems_bin="kbinS", options=None, if_print=False):
+    """Compute the view matrix of a window group, as a target of "build.py".
+
+    The matrix is only computed again when the content of the octree or the points,
+    or the options, changed since the last call.
+
+    Args:
+        octree (str): the window must be replaced by a glow material, see the readme.
+        photocells (str): sensor points and directions, one per line.
+        window_material (str): the glow material of the window.
+        output (str): vmx path, photocells with the material name and ".vmx" by default.
+        klems_bin (str): Klems bin function of klems_full.cal, kbinN, kbinE, kbinS or kbinW.
+        options (list[str]): rcontrib options, "build.VIEW_OPTIONS" by default.
+        if_print (bool): print the build.
+
+    Raises:
+        build.BuildError: rcontrib failed, with the command and its messages.
+
+    Returns:
+        str: the vmx path.
+    """
+    from build import Build, Facade, VIEW_OPTIONS, view_target
+    if output is None:
+        output = "%s_%s.vmx" % (os.path.splitext(photocells)[0], window_material)
+    facade = Facade(os.path.splitext(os.path.basename(output))[0], window_material, klems_bin=klems_bin)
+    target = view_target(facade, octree, photocells, output, VIEW_OPTIONS if options is None else options)
+    Build([target]).run(verbose=if_print)
+    return output
 
 
 def gen_skv_p(altitude, azimuth, epsilon, delta, path_save_skv, if_print=False):
@@ -224,8 +906,7 @@ def rgb_group_2_lux(rgb_list: List[Tuple[float]]):
         r += rgb_item[0]
         g += rgb_item[1]
         b += rgb_item[2]
-    illu = 179.0 * r * 0.25 + g * 0.670 + b * 0.065
-    return illu 
+    return float(rgb_to_lux((r, g, b)))
 
 
 def rgb2lux(rgb_path):
@@ -243,22 +924,22 @@ def rgb2lux(rgb_path):
 
 
 def drawHotMap3D(lux_t, height, weight, add='0', bias=1):
+    from matplotlib import pyplot as plt
+    from render import lux_grid
     # 绘制热图
     y = np.arange(0, weight, 1)
     x = np.arange(0, height-bias, 1)
     X, Y = np.meshgrid(x, y)
-    lux_len = len(lux_t)
-    temp = []
-    for i in range(0, lux_len, height):
-        temp.append(lux_t[i:i + height-bias])
     # plt.imshow(temp, cmap='hot_r', vmin=0, vmax=1600)
     # 增加右侧的颜色刻度条
-    Z = np.array(temp)
-    sort_temp = Z.flatten()
-    sort_temp.sort()
-    temp_mean = np.mean(sort_temp)
+    # one grid row per height sensors, see "render.lux_grid"
+    Z = lux_grid(lux_t, height, weight, bias)
+    flat_temp = Z.flatten()
+    temp_mean = np.mean(flat_temp)
     print(temp_mean)
-    min_list = sort_temp[0:100]
+    # the lowest 100 values are selected with a partition, see "metrics.average_degree"
+    lowest = min(100, flat_temp.size)
+    min_list = np.partition(flat_temp, lowest - 1)[:lowest]
     temp_min = np.mean(min_list)
     print(temp_min)
     average_degree = temp_min/temp_mean
@@ -274,6 +955,8 @@ def drawHotMap3D(lux_t, height, weight, add='0', bias=1):
 
 
 def date_draw():
+    import pandas as pd
+    from render import render_frames
     # 查找某时间对应的气候数据，并计算照度分布
     original_data = "data/angle_null.xlsx"
     all_data = pd.read_excel(original_data)
@@ -300,12 +983,13 @@ def date_draw():
     azimuth_d = input_data[5]
     altitude_d = input_data[6]
     gen_skv_W(altitude_d, azimuth_d, direct_rate, diffuse_rate, skv_d)
+    frames = []
     for i in range(5, 180, 5):
         xml_d = "rad_files/xml/type25_angle%s.xml" % str(i)
         dc_timestep(vmx_d, xml_d, dmx_d, skv_d, path_d)
-        lux = rgb2lux(path_d)
-        save_add = save_root + "%s.jpg" % i
-        drawHotMap3D(lux, 81, 35, add=save_add, bias=0)
+        frames.append(rgb2lux(path_d))
+    # the 35 angle frames are drawn in a process pool
+    render_frames(frames, 81, 35, paths=[save_root + "%s.jpg" % i for i in range(5, 180, 5)], bias=0, kind="surface")
 
 
 def radiance_test():
@@ -0,0 +1,180 @@
+import os
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+from matplotlib import colormaps, colors, image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Headless rendering of illuminance maps. The figures are drawn on their own
+# Agg canvas instead of the pyplot state, so frames can be rendered in worker
+# processes and on machines without a display:
+#
+#   render_frames(lux, height=31, weight=60, pattern="maps/%04d.png")   # (frames, sensors)
+#   animate(lux, height=31, weight=60, output="year.gif", fps=24)
+#
+# The raster path writes the colour mapped grid directly as a PNG, the surface
+# path is the 3D plot of "drawHotMap3D".
+
+DEFAULT_VMAX = 2000.0
+
+
+def lux_grid(lux, height: int, weight: int, bias: int = 1) -> np.ndarray:
+    """Lay out the flat sensor values as the grid of "drawHotMap3D".
+
+    Args:
+        lux (array_like): illuminance of every sensor, stored row by row.
+        height (int): sensors per grid row.
+        weight (int): number of grid rows.
+        bias (int): sensors at the end of every row left out of the grid.
+
+    Returns:
+        np.ndarray: grid with shape (weight, height - bias).
+    """
+    lux = np.asarray(lux, dtype=np.float64)
+    return lux[:weight * height].reshape(weight, height)[:, :height - bias]
+
+
+def raster_image(grid: np.ndarray, vmin: float = 0.0, vmax: float = DEFAULT_VMAX, cmap: str = "viridis",
+                 scale: int = 8) -> np.ndarray:
+    """Colour map a grid into an RGBA image, every sensor a scale x scale block.
+
+    Returns:
+        np.ndarray: uint8 image with shape (rows * scale, columns * scale, 4), the first grid row at the bottom.
+    """
+    values = colors.Normalize(vmin, vmax, clip=True)(grid[::-1])
+    rgba = colormaps[cmap](values, bytes=True)
+    return np.repeat(np.repeat(rgba, scale, axis=0), scale, axis=1)
+
+
+def render_raster(grid: np.ndarray, path: str, vmin: float = 0.0, vmax: float = DEFAULT_VMAX, cmap: str = "viridis",
+                  scale: int = 8) -> None:
+    """Write a grid as a PNG without a figure, the fast path for many frames.
+    """
+    image.imsave(path, raster_image(grid, vmin, vmax, cmap, scale))
+
+
+def render_surface(grid: np.ndarray, path: str, vmax: float = DEFAULT_VMAX, title: Optional[str] = None,
+                   lowest: int = 100, dpi: int = 100) -> None:
+    """Draw a grid as the 3D surface of "drawHotMap3D" and save it.
+
+    Args:
+        grid (np.ndarray): grid with shape (rows, columns), see "lux_grid".
+        path (str): image path, the format follows the extension.
+        vmax (float): top of the colour scale and of the z axis.
+        title (str): figure title, the uniformity of the grid by default.
+        lowest (int): lowest values averaged for the default title.
+        dpi (int): resolution.
+    """
+    if title is None:
+        flat = grid.ravel()
+        mean = flat.mean()
+        lowest = min(lowest, flat.size)
+        minimum = np.partition(flat, lowest - 1)[:lowest].mean()
+        title = 'average degree: %.3f, mean=%.2f, min=%.2f' % (minimum / mean, mean, minimum)
+    figure = Figure(dpi=dpi)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(projection="3d")
+    X, Y = np.meshgrid(np.arange(grid.shape[1]), np.arange(grid.shape[0]))
+    ax.plot_surface(X, Y, grid, rstride=1, cstride=1, cmap='viridis', edgecolor='none', vmax=vmax)
+    ax.set_zlim(0, vmax)
+    ax.set_title(title)
+    figure.savefig(path)
+
+
+def _render_batch(kind: str, frames: np.ndarray, paths: List[str], height: int, weight: int, bias: int, options: dict) -> int:
+    for lux, path in zip(frames, paths):
+        grid = lux_grid(lux, height, weight, bias)
+        if kind == "raster":
+            render_raster(grid, path, **options)
+        else:
+            render_surface(grid, path, **options)
+    return len(paths)
+
+
+def render_frames(frames, height: int, weight: int, pattern: str = "frame_%04d.png", paths: Optional[Sequence[str]] = None,
+                  bias: int = 1, kind: str = "raster", workers: Optional[int] = None, batch: Optional[int] = None, **options) -> List[str]:
+    """Render many maps in a process pool.
+
+    Args:
+        frames (array_like): illuminance with shape (frames, sensors), e.g. the transposed
+            "annual_illuminance" or the angles of a "SweepResult".
+        height (int): sensors per grid row, see "lux_grid".
+        weight (int): number of grid rows.
+        pattern (str): image path of frame i is pattern % i.
+        paths (list[str]): image paths, instead of pattern.
+        bias (int): sensors at the end of every row left out of the grid.
+        kind (str): "raster" writes PNGs of the grid, "surface" draws the 3D plot.
+        workers (int): processes, os.cpu_count() by default, 1 renders in this process.
+        batch (int): frames sent to a worker at once, by default the frames are split evenly
+            over the workers.
+        options: passed to "render_raster" or "render_surface", e.g. vmax.
+
+    Returns:
+        list[str]: the image paths.
+    """
+    if kind not in ("raster", "surface"):
+        raise ValueError("unknown kind %s" % kind)
+    frames = np.asarray(frames)
+    if paths is None:
+        paths = [pattern % i for i in range(len(frames))]
+    paths = list(paths)
+    for directory in set(os.path.dirname(path) for path in paths):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    if batch is None:
+        batch = max(math.ceil(len(paths) / workers), 1)
+    batches = [(frames[start:start + batch], paths[start:start + batch]) for start in range(0, len(paths), batch)]
+    if workers == 1 or len(paths) <= 1:
+        for batch_frames, batch_paths in batches:
+            _render_batch(kind, batch_frames, batch_paths, height, weight, bias, options)
+        return paths
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_render_batch, kind, batch_frames, batch_paths, height, weight, bias, options)
+                   for batch_frames, batch_paths in batches]
+        for future in futures:
+            future.result()
+    return paths
+
+
+def animate(frames, height: int, weight: int, output: str, fps: int = 10, bias: int = 1, vmin: float = 0.0,
+            vmax: float = DEFAULT_VMAX, titles: Optional[Sequence[str]] = None, dpi: int = 100) -> str:
+    """Encode a sequence of maps, e.g. the hours of a year or the slat angles, into an animation.
+
+    One figure is drawn and only the image data change between frames. mp4 needs
+    ffmpeg, gif is written with Pillow.
+
+    Args:
+        frames (array_like): illuminance with shape (frames, sensors).
+        height (int): sensors per grid row, see "lux_grid".
+        weight (int): number of grid rows.
+        output (str): animation path, ".gif" or ".mp4".
+        fps (int): frames per second.
+        titles (list[str]): title of every frame.
+
+    Returns:
+        str: the animation path.
+    """
+    from matplotlib import animation
+    frames = np.asarray(frames)
+    figure = Figure(dpi=dpi)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    picture = ax.imshow(lux_grid(frames[0], height, weight, bias), origin="lower", vmin=vmin, vmax=vmax, cmap="viridis")
+    figure.colorbar(picture, ax=ax, label="lux")
+    title = ax.set_title(titles[0] if titles else "")
+
+    def update(i):
+        picture.set_data(lux_grid(frames[i], height, weight, bias))
+        if titles:
+            title.set_text(titles[i])
+        return picture, title
+
+    if output.endswith(".gif"):
+        writer = animation.PillowWriter(fps=fps)
+    else:
+        writer = animation.FFMpegWriter(fps=fps)
+    animation.FuncAnimation(figure, update, frames=len(frames), blit=False).save(output, writer=writer, dpi=dpi)
+    return output
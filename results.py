@@ -0,0 +1,288 @@
+import os
+import json
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Union
+from cache import file_key
+
+# Chunked on-disk store of illuminance results with the axes
+# (variants, timesteps, sensors), e.g. the BSDF states of a sweep:
+#
+#   store/
+#     meta.json             sensors, variants, chunk sizes, metadata of the inputs
+#     t000000_s0000.npz     timesteps [0, chunk_size) x sensors [0, sensor_chunk)
+#     t000000_s0001.npz     ...
+#
+# Time-steps are appended as they are computed. Every chunk is a compressed npz
+# written atomically, meta.json records how many time-steps are stored, so an
+# interrupted run is resumed from "store.timesteps". Reading an hour or a
+# sensor only decompresses the chunks that hold it.
+
+META_FILE = "meta.json"
+
+
+def input_metadata(paths: Dict[str, str], mode: str = "stat") -> Dict[str, str]:
+    """Describe the input files of a run, stored with the results.
+
+    Args:
+        paths (dict): name and path of every input, e.g. {"dmx_south": radfiles.dmx_south}.
+        mode (str): "stat" or "hash", see "cache.file_key".
+
+    Returns:
+        dict: name and key of every input.
+    """
+    return {name: file_key(path, mode) for name, path in paths.items()}
+
+
+class ResultStore:
+
+    def __init__(self, path: str, sensors: Optional[int] = None, variants: Optional[list] = None, chunk_size: int = 168,
+                 sensor_chunk: int = 1024, metadata: Optional[dict] = None, dtype: str = "float32") -> None:
+        """Open a result store, it is created when the directory has no store yet.
+
+        When the store exists the given sensors, variants and metadata must match the
+        stored ones, so a resumed run can not mix results of different inputs.
+
+        Args:
+            path (str): store directory.
+            sensors (int): number of sensors, needed to create the store.
+            variants (list): labels of the variants, e.g. slat angles, one unnamed variant by default.
+            chunk_size (int): time-steps per chunk, 168 is one week of hours.
+            sensor_chunk (int): sensors per chunk.
+            metadata (dict): JSON serializable description of the inputs, see "input_metadata".
+            dtype (str): dtype of the stored values.
+
+        Raises:
+            ValueError: the store exists with other sensors, variants or metadata.
+        """
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                self.meta = json.load(file)
+            for name, value in [("sensors", sensors), ("variants", variants), ("metadata", metadata)]:
+                if value is not None and self.meta[name] != json.loads(json.dumps(value)):
+                    raise ValueError("%s of %s do not match the stored %s" % (name, path, name))
+        else:
+            if sensors is None:
+                raise ValueError("no result store in %s, the number of sensors is needed to create it" % path)
+            self.meta = {"sensors": sensors, "variants": [None] if variants is None else list(variants),
+                         "chunk_size": chunk_size, "sensor_chunk": sensor_chunk, "dtype": np.dtype(dtype).name,
+                         "timesteps": 0, "metadata": metadata or {}}
+            os.makedirs(path, exist_ok=True)
+            self._write_meta()
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.chunks = OrderedDict()
+        # time-steps of the last, incomplete chunk, rewritten until it is full
+        self.buffer = np.empty((len(self.variants), 0, self.sensors), dtype=self.dtype)
+        partial = self.meta["timesteps"] % self.chunk_size
+        if partial:
+            chunk = self.meta["timesteps"] // self.chunk_size
+            blocks = [self._read_chunk(chunk, block) for block in range(self._blocks())]
+            self.buffer = np.concatenate(blocks, axis=2)[:, :partial]
+
+    @property
+    def sensors(self) -> int:
+        return self.meta["sensors"]
+
+    @property
+    def variants(self) -> list:
+        return self.meta["variants"]
+
+    @property
+    def chunk_size(self) -> int:
+        return self.meta["chunk_size"]
+
+    @property
+    def metadata(self) -> dict:
+        return self.meta["metadata"]
+
+    @property
+    def timesteps(self) -> int:
+        """Time-steps stored, a resumed run starts at this index."""
+        return self.meta["timesteps"] - self.meta["timesteps"] % self.chunk_size + self.buffer.shape[1]
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.variants), self.timesteps, self.sensors
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def append(self, values: np.ndarray) -> None:
+        """Append time-steps, full chunks are written at once.
+
+        Args:
+            values (np.ndarray): illuminance with shape (variants, timesteps, sensors),
+                (variants, sensors) for one time-step, or (sensors,) when there is one variant.
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        if values.ndim == 1:
+            values = values[np.newaxis, np.newaxis, :]
+        elif values.ndim == 2:
+            values = values[:, np.newaxis, :]
+        if values.shape[0] != len(self.variants) or values.shape[2] != self.sensors:
+            raise ValueError("expected values with shape (%d, timesteps, %d), got %s" % (
+                len(self.variants), self.sensors, values.shape))
+        self.buffer = np.concatenate([self.buffer, values], axis=1)
+        while self.buffer.shape[1] >= self.chunk_size:
+            self._write_chunk(self.buffer[:, :self.chunk_size])
+            self.buffer = self.buffer[:, self.chunk_size:]
+
+    def flush(self) -> None:
+        """Write the incomplete last chunk, e.g. before a long computation that may be interrupted.
+        """
+        if self.buffer.shape[1] > 0 and self.meta["timesteps"] != self.timesteps:
+            self._write_chunk(self.buffer)
+
+    def read(self, times: Union[int, slice, Sequence[int]] = slice(None), sensors: Union[int, slice, Sequence[int]] = slice(None),
+             variants: Union[slice, Sequence] = slice(None)) -> np.ndarray:
+        """Read a part of the stored results, only the chunks holding it are loaded.
+
+        Args:
+            times: time-step index, slice or indices.
+            sensors: sensor index, slice or indices.
+            variants: slice of the variants or a list of variant labels.
+
+        Returns:
+            np.ndarray: values with shape (variants, times, sensors), the axes of integer indices are dropped.
+        """
+        time_index = self._index(times, self.timesteps)
+        sensor_index = self._index(sensors, self.sensors)
+        if isinstance(variants, slice):
+            variant_index = np.arange(len(self.variants))[variants]
+        else:
+            variant_index = np.array([self.variants.index(variant) for variant in variants], dtype=int)
+        result = np.empty((variant_index.size, time_index.size, sensor_index.size), dtype=self.dtype)
+        sensor_chunk = self.meta["sensor_chunk"]
+        stored = self.meta["timesteps"] - self.meta["timesteps"] % self.chunk_size
+        for chunk in np.unique(time_index // self.chunk_size):
+            rows = np.flatnonzero(time_index // self.chunk_size == chunk)
+            for block in np.unique(sensor_index // sensor_chunk):
+                columns = np.flatnonzero(sensor_index // sensor_chunk == block)
+                if chunk * self.chunk_size >= stored:
+                    data = self.buffer[:, :, block * sensor_chunk:(block + 1) * sensor_chunk]
+                else:
+                    data = self._read_chunk(chunk, block)
+                data = data[variant_index][:, time_index[rows] - chunk * self.chunk_size]
+                result[:, rows[:, np.newaxis], columns] = data[:, :, sensor_index[columns] - block * sensor_chunk]
+        if isinstance(times, (int, np.integer)):
+            result = result[:, 0]
+            if isinstance(sensors, (int, np.integer)):
+                return result[:, 0]
+            return result
+        if isinstance(sensors, (int, np.integer)):
+            return result[:, :, 0]
+        return result
+
+    def hour(self, index: int) -> np.ndarray:
+        """Values of one time-step with shape (variants, sensors)."""
+        return self.read(times=index)
+
+    def sensor(self, index: int) -> np.ndarray:
+        """Values of one sensor with shape (variants, timesteps)."""
+        return self.read(sensors=index)
+
+    def _index(self, index, size: int) -> np.ndarray:
+        if isinstance(index, slice):
+            return np.arange(size)[index]
+        index = np.atleast_1d(np.asarray(index, dtype=int))
+        if index.size and (index.min() < -size or index.max() >= size):
+            raise IndexError("index out of range 0..%d" % size)
+        return index % size if size else index
+
+    def _chunk_path(self, chunk: int, block: int) -> str:
+        return os.path.join(self.path, "t%06d_s%04d.npz" % (chunk, block))
+
+    def _read_chunk(self, chunk: int, block: int) -> np.ndarray:
+        key = (chunk, block)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        with np.load(self._chunk_path(chunk, block)) as file:
+            data = file["values"]
+        self.chunks[key] = data
+        while len(self.chunks) > 16:
+            self.chunks.popitem(last=False)
+        return data
+
+    def _blocks(self) -> int:
+        return -(-self.sensors // self.meta["sensor_chunk"])
+
+    def _write_chunk(self, values: np.ndarray) -> None:
+        chunk = (self.meta["timesteps"] - self.meta["timesteps"] % self.chunk_size) // self.chunk_size
+        sensor_chunk = self.meta["sensor_chunk"]
+        for block in range(self._blocks()):
+            self.chunks.pop((chunk, block), None)
+            descriptor, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            try:
+                with os.fdopen(descriptor, "wb") as file:
+                    np.savez_compressed(file, values=values[:, :, block * sensor_chunk:(block + 1) * sensor_chunk])
+                os.replace(temp_path, self._chunk_path(chunk, block))
+            except OSError:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        # the chunks are complete on disk before meta.json counts them
+        self.meta["timesteps"] = chunk * self.chunk_size + values.shape[1]
+        self._write_meta()
+
+    def _write_meta(self) -> None:
+        descriptor, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(self.meta, file, indent=2)
+        os.replace(temp_path, os.path.join(self.path, META_FILE))
+
+
+def fill_store(store: ResultStore, compute: Callable[[slice], np.ndarray], total: int, block: Optional[int] = None) -> ResultStore:
+    """Compute the missing time-steps of a store block by block, resuming after the stored ones.
+
+    Args:
+        store (ResultStore): the result store.
+        compute (Callable): gives the values of a slice of time-steps with shape (variants, timesteps, sensors).
+        total (int): time-steps of the whole run.
+        block (int): time-steps per call of compute, the chunk size by default.
+
+    Returns:
+        ResultStore: the store.
+    """
+    block = block or store.chunk_size
+    for start in range(store.timesteps, total, block):
+        store.append(compute(slice(start, min(start + block, total))))
+    store.flush()
+    return store
+
+
+def sweep_store(path: str, engines: List, family, sky_matrix: np.ndarray, chunk_size: int = 168,
+                metadata: Optional[dict] = None) -> ResultStore:
+    """Store the illuminance of every BSDF state of a sweep, see "sweep.sweep_illuminance".
+
+    The sweep is computed one chunk of time-steps at a time, so the memory does not
+    grow with the year and an interrupted run continues where it stopped.
+
+    Args:
+        path (str): store directory.
+        engines (list[ThreePhaseEngine]): one engine per window group, with the same sensors.
+        family (BSDFFamily): BSDF states, their angles are the variants of the store.
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+        chunk_size (int): time-steps per chunk.
+        metadata (dict): description of the inputs, the dmx and vmx files of the engines by default.
+
+    Returns:
+        ResultStore: the store.
+    """
+    from sweep import sweep_illuminance
+    if metadata is None:
+        paths = {}
+        for i, engine in enumerate(engines):
+            paths["dmx_%d" % i] = engine.illu_data.dmx
+            paths["vmx_%d" % i] = engine.illu_data.vmx
+        metadata = {"inputs": input_metadata(paths), "timesteps": sky_matrix.shape[1]}
+    store = ResultStore(path, sensors=engines[0].sensors_num, variants=family.angles, chunk_size=chunk_size,
+                        metadata=metadata)
+    return fill_store(store, lambda times: sweep_illuminance(engines, family, sky_matrix[:, times]).values,
+                      sky_matrix.shape[1])
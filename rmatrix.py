@@ -0,0 +1,331 @@
+import io
+import os
+import numpy as np
+import profiling
+from typing import Dict, Sequence, Tuple
+
+# Radiance matrix files (dmx, vmx, skv, smx) start with a text header:
+#
+#   #?RADIANCE
+#   NCOMP=3
+#   NCOLS=2306
+#   FORMAT=float
+#   BigEndian=0
+#   <empty line>
+#
+# followed by the data, either binary float/double or ascii text.
+
+MATRIX_FORMATS = {"float": "f4", "double": "f8"}
+
+
+def read_matrix_header(file) -> Dict[str, str]:
+    """Read the header of a Radiance matrix file.
+
+    The file position is left at the first byte of the data. Files without a
+    "#?RADIANCE" header (e.g. rcontrib -h output) return an empty dict and
+    keep the position at the start of the file.
+
+    Args:
+        file: file object opened in binary mode.
+
+    Returns:
+        dict: header variables such as NROWS, NCOLS, NCOMP and FORMAT.
+    """
+    header = {}
+    start = file.tell()
+    if file.readline().strip() != b"#?RADIANCE":
+        file.seek(start)
+        return header
+    while True:
+        line = file.readline()
+        line = line.decode("utf-8", errors="ignore").strip()
+        if not line:
+            break
+        key, sep, value = line.partition("=")
+        if sep:
+            header[key.strip()] = value.strip()
+    return header
+
+
+def matrix_dtype(header: Dict[str, str]) -> np.dtype:
+    """The numpy dtype of a binary matrix, None for ascii data.
+
+    Args:
+        header (dict): header read by "read_matrix_header".
+
+    Returns:
+        np.dtype: float32 or float64 with the byte order of the file.
+    """
+    data_format = header.get("FORMAT", "ascii")
+    if data_format == "ascii":
+        return None
+    if data_format not in MATRIX_FORMATS:
+        raise ValueError("unsupported matrix format %s" % data_format)
+    dtype = np.dtype(MATRIX_FORMATS[data_format])
+    return dtype.newbyteorder(">" if header.get("BigEndian", "0") == "1" else "<")
+
+
+def _ascii_values(text: str, header: Dict[str, str]) -> np.ndarray:
+    ncomp = int(header.get("NCOMP", 3))
+    if "NCOLS" not in header:
+        first_line = next(line for line in text.splitlines() if line.strip())
+        header["NCOLS"] = str(len(first_line.split()) // ncomp)
+    return np.array(text.split(), dtype=np.float64)
+
+
+def _matrix_shape(header: Dict[str, str], size: int) -> Tuple[int, int, int]:
+    ncomp = int(header.get("NCOMP", 3))
+    ncols = int(header["NCOLS"])
+    nrows = int(header.get("NROWS", size // (ncols * ncomp)))
+    return nrows, ncols, ncomp
+
+
+def read_matrix(file, name: str = "<stream>") -> np.ndarray:
+    """Read a Radiance matrix from a binary file object, e.g. a process stdout.
+
+    Args:
+        file: file object opened in binary mode.
+        name (str): name used in error messages.
+
+    Returns:
+        np.ndarray: array with shape (rows, columns, components).
+    """
+    if not file.seekable():
+        # e.g. a pipe, the header is read from a copy
+        file = io.BytesIO(file.read())
+    header = read_matrix_header(file)
+    data = file.read()
+    try:
+        dtype = matrix_dtype(header)
+    except ValueError as error:
+        raise ValueError("%s in %s" % (error, name))
+    if dtype is None:
+        values = _ascii_values(data.decode("utf-8"), header)
+    else:
+        values = np.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder("="))
+    nrows, ncols, ncomp = _matrix_shape(header, values.size)
+    return values[:nrows * ncols * ncomp].reshape(nrows, ncols, ncomp)
+
+
+def map_matrix(file_path: str) -> np.ndarray:
+    """Memory-map the binary data of a Radiance matrix file without copying it.
+
+    The returned array is a read-only view of the page cache, so several
+    processes mapping the same dmx file share a single copy in memory. Big
+    endian files are mapped as they are, numpy swaps the bytes on access.
+    Ascii files can not be mapped and are parsed instead.
+
+    Args:
+        file_path (str): matrix file path.
+
+    Returns:
+        np.ndarray: array with shape (rows, columns, components).
+    """
+    with open(file_path, "rb") as file:
+        header = read_matrix_header(file)
+        offset = file.tell()
+        try:
+            dtype = matrix_dtype(header)
+        except ValueError as error:
+            raise ValueError("%s in %s" % (error, file_path))
+        if dtype is None:
+            file.seek(offset)
+            return read_matrix(file, file_path)
+    size = (os.path.getsize(file_path) - offset) // dtype.itemsize
+    shape = _matrix_shape(header, size)
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def load_matrix(file_path: str, mmap: bool = False) -> np.ndarray:
+    """Load a Radiance matrix (vmx, dmx, skv, ...) into a numpy array.
+
+    Args:
+        file_path (str): matrix file path, ascii, float or double format.
+        mmap (bool): map binary data instead of reading it, see "map_matrix".
+
+    Returns:
+        np.ndarray: array with shape (rows, columns, components).
+    """
+    with profiling.stage("matrix_load") as record:
+        if mmap:
+            return map_matrix(file_path)
+        with open(file_path, "rb") as file:
+            matrix = read_matrix(file, file_path)
+            record.count(bytes_read=file.tell())
+        return matrix
+
+
+def count_matrix_rows(file_path: str) -> int:
+    """Count the rows of a matrix file, reading as little of it as possible.
+
+    NROWS in the header is used when present, binary files are sized from the
+    file length, only ascii files without NROWS are scanned.
+
+    Args:
+        file_path (str): matrix file path.
+
+    Returns:
+        int: the number of rows, e.g. the sensors of a vmx file.
+    """
+    with open(file_path, "rb") as file:
+        header = read_matrix_header(file)
+        if "NROWS" in header:
+            return int(header["NROWS"])
+        offset = file.tell()
+        dtype = matrix_dtype(header)
+        if dtype is not None:
+            size = (os.path.getsize(file_path) - offset) // dtype.itemsize
+            return _matrix_shape(header, size)[0]
+        # ascii: one line per row
+        return sum(1 for line in file if _ascii_row(line))
+
+
+def _ascii_row(line: bytes) -> bool:
+    line = line.strip()
+    return bool(line) and (line[:1].isdigit() or line[:1] in b"-+.")
+
+
+class MatrixRowIndex:
+
+    def __init__(self, file_path: str, use_cache: bool = True) -> None:
+        """Byte offset of every row of a matrix file, to read single rows, e.g. sensors of a vmx.
+
+        Binary rows are found from the header, ascii files are scanned once and the
+        offsets are saved next to the file as "<file_path>.rows.npz", rebuilt when the
+        size or the modification time of the file change.
+
+        Args:
+            file_path (str): matrix file path.
+            use_cache (bool): read and write the offsets file of ascii matrices.
+        """
+        self.file_path = file_path
+        with open(file_path, "rb") as file:
+            self.header = read_matrix_header(file)
+            data_offset = file.tell()
+            self.dtype = matrix_dtype(self.header)
+            if self.dtype is not None:
+                nrows, ncols, ncomp = _matrix_shape(self.header, (os.path.getsize(file_path) - data_offset) // self.dtype.itemsize)
+                self.offsets = data_offset + np.arange(nrows, dtype=np.int64) * (ncols * ncomp * self.dtype.itemsize)
+            else:
+                self.offsets = self._ascii_offsets(file, use_cache)
+
+    def _ascii_offsets(self, file, use_cache: bool) -> np.ndarray:
+        stat = os.stat(self.file_path)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        cache_path = self.file_path + ".rows.npz"
+        if use_cache and os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache["source"], source):
+                    return cache["offsets"]
+        offsets = []
+        position = file.tell()
+        for line in iter(file.readline, b""):
+            if _ascii_row(line):
+                offsets.append(position)
+            position += len(line)
+        offsets = np.array(offsets, dtype=np.int64)
+        if use_cache:
+            try:
+                np.savez(cache_path, source=source, offsets=offsets)
+            except OSError:
+                # e.g. a read-only matrix directory, the offsets file is optional
+                pass
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def read(self, rows: Sequence[int]) -> np.ndarray:
+        """Read some rows of the matrix without loading the others.
+
+        Args:
+            rows (list[int]): row indices.
+
+        Returns:
+            np.ndarray: array with shape (len(rows), columns, components).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ncomp = int(self.header.get("NCOMP", 3))
+        if self.dtype is not None:
+            return np.asarray(map_matrix(self.file_path)[rows], dtype=self.dtype.newbyteorder("="))
+        if rows.size == 0:
+            ncols = int(self.header.get("NCOLS", 0))
+            return np.empty((0, ncols, ncomp))
+        values = []
+        with open(self.file_path, "rb") as file:
+            for offset in self.offsets[rows]:
+                file.seek(offset)
+                values.append(np.array(file.readline().split(), dtype=np.float64))
+        values = np.array(values).reshape(len(rows), -1)
+        return values.reshape(len(rows), values.shape[1] // ncomp, ncomp)
+
+
+def matrix_header(shape: Tuple[int, int, int], data_format: str = "float", big_endian: bool = False,
+                  command: str = None) -> bytes:
+    """The header of a Radiance matrix, e.g. to stream the data after it.
+
+    Args:
+        shape (tuple): rows, columns and components.
+        data_format (str): "float", "double" or "ascii".
+        big_endian (bool): byte order of binary data.
+        command (str): optional command line recorded in the header.
+
+    Returns:
+        bytes: header ending with the empty line.
+    """
+    nrows, ncols, ncomp = shape
+    lines = ["#?RADIANCE"]
+    if command:
+        lines.append(command)
+    lines += ["NROWS=%d" % nrows, "NCOLS=%d" % ncols, "NCOMP=%d" % ncomp, "FORMAT=%s" % data_format]
+    if data_format in MATRIX_FORMATS:
+        lines.append("BigEndian=%d" % int(big_endian))
+    elif data_format != "ascii":
+        raise ValueError("unsupported matrix format %s" % data_format)
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def matrix_bytes(matrix: np.ndarray, data_format: str = "float", big_endian: bool = False, command: str = None,
+                 header: bool = True) -> bytes:
+    """Encode a matrix in the Radiance format, e.g. to feed it to the stdin of dctimestep.
+
+    Args:
+        matrix (np.ndarray): array with shape (rows, columns, components) or (rows, components).
+        data_format (str): "float", "double" or "ascii".
+        big_endian (bool): byte order of binary data.
+        command (str): optional command line recorded in the header.
+        header (bool): False gives only the data, like the -h option of the Radiance tools.
+
+    Returns:
+        bytes: header and data.
+    """
+    matrix = np.asarray(matrix)
+    if matrix.ndim == 2:
+        matrix = matrix[:, np.newaxis, :]
+    nrows, ncols, ncomp = matrix.shape
+    text = matrix_header(matrix.shape, data_format, big_endian, command)
+    if not header:
+        text = b""
+    if data_format == "ascii":
+        buffer = io.BytesIO()
+        np.savetxt(buffer, matrix.reshape(nrows, ncols * ncomp), fmt="%g", delimiter="\t")
+        return text + buffer.getvalue()
+    dtype = np.dtype(MATRIX_FORMATS[data_format]).newbyteorder(">" if big_endian else "<")
+    return text + np.ascontiguousarray(matrix, dtype=dtype).tobytes()
+
+
+def write_matrix(file_path: str, matrix: np.ndarray, data_format: str = "float", big_endian: bool = False, command: str = None) -> None:
+    """Write a matrix in the Radiance format, readable by rmtxop and dctimestep.
+
+    Args:
+        file_path (str): output file path.
+        matrix (np.ndarray): array with shape (rows, columns, components) or (rows, components).
+        data_format (str): "float", "double" or "ascii".
+        big_endian (bool): byte order of binary data.
+        command (str): optional command line recorded in the header.
+    """
+    data = matrix_bytes(matrix, data_format, big_endian, command)
+    with open(file_path, "wb") as file:
+        file.write(data)
@@ -0,0 +1,287 @@
+import os
+import json
+import socket
+import asyncio
+import argparse
+import numpy as np
+import radfiles
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from radiance import IlluData, SkyData, GendaylitMode, ThreePhaseEngine, LUMINOUS_EFFICACY, RGB_WEIGHTS
+from sweep import BSDFFamily, load_bsdf_family
+from sky import perez_sky_matrix, sky_data_arrays
+
+# Resident illuminance service. The matrices are loaded once, the requests are
+# newline delimited JSON over a Unix socket or a localhost TCP port:
+#
+#   {"skies": [{"altitude": 45, "azimuth": 30, "direct_normal_irradiance": 500,
+#               "diffusion_horizonttal_irradiance": 100}], "angle": 45, "mode": "W"}
+#
+# and every answer is one line {"lux": [[...], ...]} with one row per sky, or
+# {"error": "..."}. Requests arriving within batch_window are evaluated together,
+# equal (sky, angle) pairs of concurrent requests are computed once.
+
+# digits kept of the sky values when comparing requests
+KEY_DIGITS = 6
+
+
+class IlluminanceModel:
+
+    def __init__(self, illu_group: List[IlluData], family: Optional[BSDFFamily] = None) -> None:
+        """Pre-multiplied matrices of several window groups for every angle of a BSDF family.
+
+        Args:
+            illu_group (list[IlluData]): one IlluData per window group, with the same sensors.
+            family (BSDFFamily): BSDF family, the xml of the first group when None.
+        """
+        if family is None:
+            family = BSDFFamily([None], np.stack([ThreePhaseEngine(illu_group[0]).transmission]))
+        self.family = family
+        weights = LUMINOUS_EFFICACY * np.array(RGB_WEIGHTS)
+        self.view_transmission = []
+        self.daylight = []
+        for illu_data in illu_group:
+            engine = ThreePhaseEngine(illu_data)
+            # (angles, sensors, 3 x 145), like "sweep.sweep_illuminance"
+            self.view_transmission.append(np.concatenate(
+                [weights[channel] * (engine.view[:, :, channel] @ family.transmission) for channel in range(3)], axis=2))
+            # (3, 145, 2306), loaded into memory for fast queries
+            self.daylight.append(np.ascontiguousarray(np.moveaxis(engine.daylight, 2, 0), dtype=np.float64))
+        self.sensors_num = self.view_transmission[0].shape[1]
+
+    def illuminance(self, sky_matrix: np.ndarray, angles: List[int]) -> np.ndarray:
+        """Illuminance of pairs of skies and angles.
+
+        Args:
+            sky_matrix (np.ndarray): sky matrix with shape (2306, n, 3).
+            angles (list[int]): angle of every sky.
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (n, sensors).
+        """
+        index = np.array([self.family.angles.index(angle) for angle in angles])
+        lux = np.zeros((len(angles), self.sensors_num))
+        for view_transmission, daylight in zip(self.view_transmission, self.daylight):
+            # (3 x 145, n)
+            daylight_sky = np.concatenate([daylight[channel] @ sky_matrix[:, :, channel] for channel in range(3)], axis=0)
+            for i in np.unique(index):
+                columns = np.flatnonzero(index == i)
+                lux[columns] += (view_transmission[i] @ daylight_sky[:, columns]).T
+        return lux
+
+
+class IlluminanceService:
+
+    def __init__(self, model: IlluminanceModel, batch_window: float = 0.002, memory_items: int = 4096) -> None:
+        """asyncio front end of an IlluminanceModel with request batching and coalescing.
+
+        Args:
+            model (IlluminanceModel): the loaded matrices.
+            batch_window (float): seconds to wait for more requests before a batch is computed.
+            memory_items (int): recent results kept for repeated queries.
+        """
+        self.model = model
+        self.batch_window = batch_window
+        self.memory_items = memory_items
+        self.pending: Dict[tuple, asyncio.Future] = {}
+        self.queue: List[tuple] = []
+        self.recent = OrderedDict()
+        self.wakeup = None
+        self.computed = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def request_key(sky_data: SkyData, angle, mode: GendaylitMode) -> tuple:
+        altitude, azimuth, direct, diffuse = [round(float(value[0]), KEY_DIGITS) for value in sky_data_arrays([sky_data], mode)]
+        return mode.name, angle, altitude, azimuth, direct, diffuse
+
+    async def query(self, skies: List[SkyData], angle=None, mode: GendaylitMode = GendaylitMode.W) -> np.ndarray:
+        """Illuminance of several skies with the same angle.
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (skies, sensors).
+        """
+        if angle not in self.model.family.angles:
+            raise ValueError("angle %s is not loaded" % angle)
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sky_data in skies:
+            key = self.request_key(sky_data, angle, mode)
+            if key in self.recent:
+                self.coalesced += 1
+                self.recent.move_to_end(key)
+                future = loop.create_future()
+                future.set_result(self.recent[key])
+            elif key in self.pending:
+                self.coalesced += 1
+                future = self.pending[key]
+            else:
+                future = loop.create_future()
+                self.pending[key] = future
+                self.queue.append(key)
+                if self.wakeup is not None:
+                    self.wakeup.set()
+            # a cancelled caller must not cancel the future shared with the other callers
+            futures.append(asyncio.shield(future))
+        return np.array(await asyncio.gather(*futures))
+
+    async def run_batches(self) -> None:
+        """Compute the queued requests, one batch per batch_window.
+        """
+        self.wakeup = asyncio.Event()
+        if self.queue:
+            self.wakeup.set()
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.batch_window)
+            self.wakeup.clear()
+            keys, self.queue = self.queue, []
+            if not keys:
+                continue
+            try:
+                lux = await loop.run_in_executor(None, self.compute, keys)
+            except Exception as error:
+                for key in keys:
+                    future = self.pending.pop(key)
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for key, value in zip(keys, lux):
+                future = self.pending.pop(key)
+                if not future.done():
+                    future.set_result(value)
+                self.recent[key] = value
+            while len(self.recent) > self.memory_items:
+                self.recent.popitem(last=False)
+
+    def compute(self, keys: List[tuple]) -> np.ndarray:
+        self.computed += len(keys)
+        lux = np.empty((len(keys), self.model.sensors_num))
+        # the sky matrix is generated per mode, all skies of a mode in one call
+        for mode_name in set(key[0] for key in keys):
+            rows = [i for i, key in enumerate(keys) if key[0] == mode_name]
+            values = np.array([keys[i][2:] for i in rows], dtype=np.float64)
+            sky_matrix = perez_sky_matrix(values[:, 0], values[:, 1], values[:, 2], values[:, 3], mode=GendaylitMode[mode_name])
+            lux[rows] = self.model.illuminance(sky_matrix, [keys[i][1] for i in rows])
+        return lux
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                mode = GendaylitMode[request.get("mode", "W")]
+                skies = request["skies"] if "skies" in request else [request["sky"]]
+                lux = await self.query([SkyData(**sky) for sky in skies], request.get("angle"), mode)
+                response = {"lux": np.round(lux, 3).tolist()}
+            except Exception as error:
+                response = {"error": "%s: %s" % (type(error).__name__, error)}
+            writer.write((json.dumps(response) + "\n").encode("utf-8"))
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, path: Optional[str] = None, host: str = "127.0.0.1", port: int = 8765) -> None:
+        """Serve forever on a Unix socket when path is given, otherwise on a localhost port.
+        """
+        batches = asyncio.ensure_future(self.run_batches())
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+
+
+def query(skies: List[dict], angle=None, mode: str = "W", path: Optional[str] = None,
+          host: str = "127.0.0.1", port: int = 8765) -> np.ndarray:
+    """Send one request to a running service.
+
+    Args:
+        skies (list[dict]): SkyData fields of every sky.
+        angle: slat angle, None is the null angle.
+        mode (str): gendaylit mode name.
+        path (str): Unix socket of the service, TCP when None.
+
+    Raises:
+        RuntimeError: the service answered with an error.
+
+    Returns:
+        np.ndarray: illuminance (lux) with shape (skies, sensors).
+    """
+    if path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile("rwb") as file:
+        file.write((json.dumps({"skies": skies, "angle": angle, "mode": mode}) + "\n").encode("utf-8"))
+        file.flush()
+        response = json.loads(file.readline())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return np.array(response["lux"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="resident illuminance query service")
+    parser.add_argument("--group", nargs=2, action="append", metavar=("DMX", "VMX"), required=True,
+                        help="daylight and view matrix of a window group, repeat for every group")
+    parser.add_argument("--angles", nargs="*", default=None,
+                        help="type25 slat angles to load, all by default, null is the null angle")
+    parser.add_argument("--socket", default=None, help="Unix socket path, a localhost port otherwise")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-window", type=float, default=0.002)
+    args = parser.parse_args()
+
+    angles = None
+    if args.angles is not None:
+        angles = [None if angle == "null" else int(angle) for angle in args.angles]
+    family = load_bsdf_family(angles)
+    illu_group = [IlluData(dmx=dmx, xml=radfiles.get_type25_xml(family.angles[0]), vmx=vmx) for dmx, vmx in args.group]
+    service = IlluminanceService(IlluminanceModel(illu_group, family), batch_window=args.batch_window)
+    print("serving %d groups, angles %s" % (len(illu_group), family.angles))
+    asyncio.run(service.serve(path=args.socket, port=args.port))
+
+
+def service_test():
+    class ConstantModel:
+        # the total radiance of every sky on both sensors, no matrices needed
+        family = BSDFFamily([None], np.zeros((1, 145, 145)))
+        sensors_num = 2
+
+        def illuminance(self, sky_matrix, angles):
+            return np.repeat(sky_matrix.sum(axis=(0, 2))[:, None], 2, axis=1)
+
+    async def run():
+        service = IlluminanceService(ConstantModel(), batch_window=0.05)
+        batches = asyncio.ensure_future(service.run_batches())
+        sky = SkyData(45.0, 30.0, 500.0, 100.0)
+        # the first client times out while the second waits for the same sky
+        first = asyncio.ensure_future(asyncio.wait_for(service.query([sky]), 0.01))
+        second = asyncio.ensure_future(service.query([sky]))
+        try:
+            await first
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("the first client did not time out")
+        lux = await asyncio.wait_for(second, 5)
+        assert lux.shape == (1, 2) and lux[0, 0] > 0 and service.coalesced == 1
+        # the batch task survived and answers later queries
+        lux = await asyncio.wait_for(service.query([SkyData(30.0, 90.0, 300.0, 80.0)]), 5)
+        assert lux.shape == (1, 2) and service.computed == 2 and not batches.done()
+        batches.cancel()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+import time
+import numpy as np
+import profiling
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from radiance import GendaylitMode, SkyData, LUMINOUS_EFFICACY
+
+# Perez all-weather sky model with Reinhart patch integration, the same sky
+# as "gendaylit -ang alt az -W dn dh | genskyvec -m 4 -c 1 1 1" but computed
+# for many time-steps at once with numpy.
+
+# Perez et al. 1993, coefficients of a, b, c, d, e for the 8 sky clearness bins
+PEREZ_COEFFICIENTS = np.array([
+    [[1.3525, -0.2576, -0.2690, -1.4366], [-0.7670, 0.0007, 1.2734, -0.1233], [2.8000, 0.6004, 1.2375, 1.0000], [1.8734, 0.6297, 0.9738, 0.2809], [0.0356, -0.1246, -0.5718, 0.9938]],
+    [[-1.2219, -0.7730, 1.4148, 1.1016], [-0.2054, 0.0367, -3.9128, 0.9156], [6.9750, 0.1774, 6.4477, -0.1239], [-1.5798, -0.5081, -1.7812, 0.1080], [0.2624, 0.0672, -0.2190, -0.4285]],
+    [[-1.1000, -0.2515, 0.8952, 0.0156], [0.2782, -0.1812, -4.5000, 1.1766], [24.7219, -13.0812, -37.7000, 34.8438], [-5.0000, 1.5218, 3.9229, -2.6204], [-0.0156, 0.1597, 0.4199, -0.5562]],
+    [[-0.5484, -0.6654, -0.2672, 0.7117], [0.7234, -0.6219, -5.6812, 2.6297], [33.3389, -18.3000, -62.2500, 52.0781], [-3.5000, 0.0016, 1.1477, 0.1062], [0.4659, -0.3296, -0.0876, -0.0329]],
+    [[-0.6000, -0.3566, -2.5000, 2.3250], [0.2937, 0.0496, -5.6812, 1.8415], [21.0000, -4.7656, -21.5906, 7.2492], [-3.5000, -0.1554, 1.4062, 0.3988], [0.0032, 0.0766, -0.0656, -0.1294]],
+    [[-1.0156, -0.3670, 1.0078, 1.4051], [0.2875, -0.5328, -3.8500, 3.3750], [14.0000, -0.9999, -7.1406, 7.5469], [-3.4000, -0.1073, -1.0750, 1.5702], [-0.0672, 0.4016, 0.3017, -0.4844]],
+    [[-1.0000, 0.0211, 0.5025, -0.5119], [-0.3000, 0.1922, 0.7023, -1.6317], [19.0000, -5.0000, 1.2438, -1.9094], [-4.0000, 0.0250, 0.3844, 0.2656], [1.0468, -0.3788, -2.4517, 1.4656]],
+    [[-1.0500, 0.0289, 0.4260, 0.3590], [-0.3250, 0.1156, 0.7781, 0.0025], [31.0625, -14.5000, -46.1148, 55.3750], [-7.2312, 0.4050, 13.3500, 0.6234], [1.5000, -0.6426, 1.8564, 0.5636]],
+])
+# upper bounds of the sky clearness bins
+EPSILON_BINS = np.array([1.065, 1.23, 1.5, 1.95, 2.8, 4.5, 6.2])
+# Perez et al. 1990, luminous efficacy a + b W + c cos(Z) + d ln(delta) of the diffuse light
+DIFFUSE_EFFICACY = np.array([
+    [97.24, -0.46, 12.00, -8.91], [107.22, 1.15, 0.59, -3.95], [104.97, 2.96, -5.52, -8.77], [102.39, 5.59, -13.95, -13.90],
+    [100.71, 5.94, -22.75, -23.74], [106.42, 3.83, -36.15, -28.83], [141.88, 1.90, -53.24, -14.03], [152.23, 0.35, -45.27, -7.98]])
+# a + b W + c exp(5.73 Z - 5) + d delta of the direct light
+DIRECT_EFFICACY = np.array([
+    [57.20, -4.55, -2.98, 117.12], [98.99, -3.46, -1.21, 12.38], [109.83, -4.90, -1.71, -8.81], [110.34, -5.84, -1.99, -4.56],
+    [106.36, -3.97, -1.75, -6.16], [107.19, -1.25, -1.51, -26.73], [105.75, 0.77, -1.26, -34.44], [101.18, 1.58, -1.10, -8.29]])
+# atmospheric precipitable water content (cm), fixed like gendaylit
+PRECIPITABLE_WATER = 2.0
+SOLAR_CONSTANT = 1367.0
+# sun disc, 0.533 degrees in diameter
+SUN_SOLID_ANGLE = 2.0 * np.pi * (1.0 - np.cos(np.radians(0.533 / 2.0)))
+SUN_OMEGA = (0.533 / 360.0) ** 2 * np.pi ** 3
+# gendaylit does not go higher
+MAX_ALTITUDE = 87.0
+# Reinhart rows from the horizon to the zenith, subdivided by MF
+TREGENZA_ROWS = [30, 30, 24, 24, 18, 12, 6]
+
+
+@dataclass
+class SkyPatches:
+    # sample directions of every patch, shape (patches, samples, 3), patch 0 is the ground
+    directions: np.ndarray
+    # solid angle of every patch
+    solid_angles: np.ndarray
+    # direction of every patch center, shape (patches, 3)
+    centers: np.ndarray
+
+
+def _direction(altitude: np.ndarray, azimuth: np.ndarray) -> np.ndarray:
+    # x east, y north, z up, the azimuth goes from north to east
+    return np.stack([np.sin(azimuth) * np.cos(altitude), np.cos(azimuth) * np.cos(altitude), np.sin(altitude)], axis=-1)
+
+
+@lru_cache(maxsize=None)
+def reinhart_patches(mf: int = 4, samples: int = 1) -> SkyPatches:
+    """The Reinhart sky subdivision used by genskyvec and gendaymtx.
+
+    Args:
+        mf (int): subdivision, 1 is the 145 Tregenza patches, 4 gives 2306 patches.
+        samples (int): every patch is sampled by samples x samples directions, 1 uses the center.
+
+    Returns:
+        SkyPatches: directions, solid angles and centers, ground patch first.
+    """
+    alpha = np.radians(90.0 / (mf * 7 + 0.5))
+    rows = [mf * TREGENZA_ROWS[row // mf] for row in range(7 * mf)] + [1]
+    x = (np.arange(samples) + 0.5) / samples
+    x1, x2 = [value.ravel() for value in np.meshgrid(x, x, indexing="ij")]
+    directions = [_direction(np.arcsin(-x1), 2.0 * np.pi * x2)]
+    solid_angles = [2.0 * np.pi]
+    centers = [[0.0, 0.0, -1.0]]
+    for row, count in enumerate(rows):
+        width = 2.0 * np.pi / count
+        if row == len(rows) - 1:
+            solid_angle = 2.0 * np.pi * (1.0 - np.cos(alpha / 2.0))
+        else:
+            solid_angle = width * (np.sin(alpha * (row + 1)) - np.sin(alpha * row))
+        for column in range(count):
+            directions.append(_direction((row + x1) * alpha, (column + x2 - 0.5) * width))
+            solid_angles.append(solid_angle)
+            centers.append(_direction((row + 0.5) * alpha, column * width))
+    return SkyPatches(np.array(directions), np.array(solid_angles), np.array(centers))
+
+
+def solar_constant(day_of_year) -> np.ndarray:
+    """Extraterrestrial normal irradiance (W/m^2) of a day, gendaylit uses day 0 with -ang.
+    """
+    b = 2.0 * np.pi * np.asarray(day_of_year, dtype=np.float64) / 365.0
+    return SOLAR_CONSTANT * (1.00011 + 0.034221 * np.cos(b) + 0.00128 * np.sin(b) + 0.000719 * np.cos(2 * b) + 0.000077 * np.sin(2 * b))
+
+
+def air_mass(zenith: np.ndarray) -> np.ndarray:
+    """Kasten 1966 relative optical air mass of a zenith angle in radians.
+    """
+    return 1.0 / (np.cos(zenith) + 0.15 * (93.885 - np.degrees(zenith)) ** -1.253)
+
+
+def sky_clearness(zenith: np.ndarray, direct_normal: np.ndarray, diffuse_horizontal: np.ndarray, day_of_year=0) -> Tuple[np.ndarray, np.ndarray]:
+    """Perez sky clearness epsilon and brightness delta, clamped like gendaylit.
+
+    Args:
+        zenith (np.ndarray): solar zenith angle in radians.
+        direct_normal (np.ndarray): direct normal irradiance (W/m^2).
+        diffuse_horizontal (np.ndarray): diffuse horizontal irradiance (W/m^2).
+        day_of_year: day number used by the extraterrestrial irradiance.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: epsilon and delta.
+    """
+    z3 = 1.041 * zenith ** 3
+    with np.errstate(divide="ignore", invalid="ignore"):
+        epsilon = ((diffuse_horizontal + direct_normal) / diffuse_horizontal + z3) / (1.0 + z3)
+    epsilon = np.clip(np.nan_to_num(epsilon, nan=1.0, posinf=12.01), 1.0, 12.01)
+    delta = np.clip(diffuse_horizontal * air_mass(zenith) / solar_constant(day_of_year), 0.01, 0.6)
+    return epsilon, delta
+
+
+def luminous_efficacy(zenith: np.ndarray, epsilon: np.ndarray, delta: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Perez 1990 luminous efficacy (lm/W) of the diffuse and the direct light.
+    """
+    k = np.searchsorted(EPSILON_BINS, epsilon, side="right")
+    a, b, c, d = DIFFUSE_EFFICACY[k].T
+    diffuse = a + b * PRECIPITABLE_WATER + c * np.cos(zenith) + d * np.log(delta)
+    a, b, c, d = DIRECT_EFFICACY[k].T
+    direct = np.maximum(a + b * PRECIPITABLE_WATER + c * np.exp(5.73 * zenith - 5.0) + d * delta, 0.0)
+    return diffuse, direct
+
+
+def perez_parameters(zenith: np.ndarray, epsilon: np.ndarray, delta: np.ndarray) -> np.ndarray:
+    """The a, b, c, d, e parameters of the Perez all-weather sky.
+
+    Returns:
+        np.ndarray: parameters with shape (5, timesteps).
+    """
+    k = np.searchsorted(EPSILON_BINS, epsilon, side="right")
+    c = PEREZ_COEFFICIENTS[k].transpose(1, 2, 0)
+    # the overcast bin uses the original delta, the bins 2-5 a minimum of 0.2
+    delta = np.where((k >= 1) & (k <= 4), np.maximum(delta, 0.2), delta)
+    parameters = c[:, 0] + c[:, 1] * zenith + delta * (c[:, 2] + c[:, 3] * zenith)
+    overcast = k == 0
+    if overcast.any():
+        z = zenith[overcast]
+        dl = delta[overcast]
+        cc = c[:, :, overcast]
+        parameters[2, overcast] = np.exp((dl * (cc[2, 0] + cc[2, 1] * z)) ** cc[2, 2]) - cc[2, 3]
+        parameters[3, overcast] = -np.exp(dl * (cc[3, 0] + cc[3, 1] * z)) + cc[3, 2] + dl * cc[3, 3]
+    return parameters
+
+
+def _relative_luminance(directions: np.ndarray, sun: np.ndarray, parameters: np.ndarray) -> np.ndarray:
+    # directions (n, 3), sun (timesteps, 3) -> (timesteps, n)
+    a, b, c, d, e = parameters[:, :, np.newaxis]
+    cos_gamma = np.clip(sun @ directions.T, -1.0, 1.0)
+    # the gradation only depends on the altitude, which the patches of a row share
+    dz, inverse = np.unique(np.maximum(directions[:, 2], 0.01), return_inverse=True)
+    gradation = (1.0 + a * np.exp(b / dz))[:, inverse]
+    indicatrix = np.arccos(cos_gamma)
+    indicatrix *= d
+    np.exp(indicatrix, out=indicatrix)
+    indicatrix *= c
+    indicatrix += 1.0
+    cos_gamma *= cos_gamma
+    cos_gamma *= e
+    indicatrix += cos_gamma
+    indicatrix *= gradation
+    return indicatrix
+
+
+def _ground_normalization(altitude: np.ndarray, epsilon: np.ndarray, direct_normal: np.ndarray) -> np.ndarray:
+    # gensky zenith normalization, selected by the sky type like gendaylit
+    x = (altitude - np.pi / 4) / (np.pi / 4)
+    clear = np.polyval([0.059229, 0.009237, -0.369832, 0.547665, 2.766521], x)
+    clear /= 0.274 * (0.91 + 10.0 * np.exp(-3.0 * (np.pi / 2 - altitude)) + 0.45 * np.sin(altitude) ** 2)
+    intermediate = np.polyval([0.60227, 1.0660, -1.3081, -2.7152, 3.5556], x)
+    intermediate /= (2.739 + 0.9891 * np.sin(0.3119 + 2.6 * altitude)) * np.exp(-(np.pi / 2 - altitude) * (0.4441 + 1.48 * altitude))
+    factor = np.where(epsilon >= 6.0, clear, intermediate) / np.pi
+    return np.where(direct_normal <= 0.0, 0.777778, factor)
+
+
+def _erbs(global_horizontal: np.ndarray, altitude: np.ndarray, day_of_year) -> Tuple[np.ndarray, np.ndarray]:
+    # split the global horizontal irradiance into direct normal and diffuse horizontal
+    sin_altitude = np.sin(altitude)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kt = np.nan_to_num(global_horizontal / (solar_constant(day_of_year) * sin_altitude))
+        kd = np.where(kt <= 0.22, 1.0 - 0.09 * kt,
+                      np.where(kt <= 0.8, 0.9511 - 0.1604 * kt + 4.388 * kt ** 2 - 16.638 * kt ** 3 + 12.336 * kt ** 4, 0.165))
+        diffuse = kd * global_horizontal
+        direct = np.nan_to_num((global_horizontal - diffuse) / sin_altitude)
+    return direct, diffuse
+
+
+def perez_sky_matrix(altitude, azimuth, direct, diffuse=None, mode: GendaylitMode = GendaylitMode.W, mf: int = 4,
+                     day_of_year=0, ground_reflectance: float = 0.2, min_altitude: float = 0.0, samples: int = 1,
+                     chunk_size: int = 1024) -> np.ndarray:
+    """Generate the sky vectors of many time-steps in one call.
+
+    Every column is the sky of "gendaylit -ang altitude azimuth -<mode> direct diffuse | genskyvec -m mf -c 1 1 1".
+
+    Args:
+        altitude (array_like): solar altitude in degrees above the horizon.
+        azimuth (array_like): solar azimuth in degrees west of south, like gendaylit.
+        direct (array_like): direct normal irradiance (W), direct normal illuminance (L),
+            direct horizontal irradiance (G) or global horizontal irradiance (E).
+        diffuse (array_like): diffuse horizontal irradiance (W, G) or illuminance (L), unused by E.
+        mode (GendaylitMode): meaning of direct and diffuse.
+        mf (int): Reinhart subdivision, 4 gives the 2306 patches of the dmx files.
+        day_of_year (array_like): day number of the extraterrestrial irradiance, gendaylit -ang uses 0.
+        ground_reflectance (float): ground reflectance.
+        min_altitude (float): skies with a lower solar altitude are dark, see "dc_timestep_pipe".
+        samples (int): samples x samples directions per patch, genskyvec samples randomly.
+        chunk_size (int): time-steps evaluated together, limits the temporary memory.
+
+    Returns:
+        np.ndarray: grey sky matrix with shape (patches, timesteps, 3), a read-only view of
+            a (patches, timesteps) array repeated over the three channels.
+    """
+    altitude = np.atleast_1d(np.asarray(altitude, dtype=np.float64))
+    azimuth = np.broadcast_to(np.asarray(azimuth, dtype=np.float64), altitude.shape)
+    direct = np.broadcast_to(np.asarray(direct, dtype=np.float64), altitude.shape)
+    diffuse = np.broadcast_to(np.asarray(0.0 if diffuse is None else diffuse, dtype=np.float64), altitude.shape)
+    day_of_year = np.broadcast_to(np.asarray(day_of_year, dtype=np.float64), altitude.shape)
+    patches = reinhart_patches(mf, samples)
+    # filled one time-step per row, then transposed
+    sky = np.zeros((altitude.size, len(patches.centers)))
+    day = np.flatnonzero((altitude >= min_altitude) & (altitude > 0.0) & ((direct > 0.0) | (diffuse > 0.0)))
+    with profiling.stage("sky_matrix"):
+        for start in range(0, day.size, chunk_size):
+            columns = day[start:start + chunk_size]
+            sky[columns] = _perez_columns(patches, altitude[columns], azimuth[columns], direct[columns],
+                                          diffuse[columns], mode, day_of_year[columns], ground_reflectance)
+    sky = sky.T
+    return np.broadcast_to(sky[:, :, np.newaxis], sky.shape + (3,))
+
+
+def _perez_columns(patches: SkyPatches, altitude, azimuth, direct, diffuse, mode, day_of_year, ground_reflectance) -> np.ndarray:
+    altitude = np.radians(np.minimum(altitude, MAX_ALTITUDE))
+    zenith = np.pi / 2 - altitude
+    azimuth = np.radians(azimuth)
+    # gendaylit measures the azimuth west of south
+    sun = np.stack([-np.sin(azimuth) * np.cos(altitude), -np.cos(azimuth) * np.cos(altitude), np.sin(altitude)], axis=-1)
+    if mode == GendaylitMode.L:
+        # solve the irradiance of the given illuminance
+        direct_normal, diffuse_horizontal = direct / LUMINOUS_EFFICACY, diffuse / LUMINOUS_EFFICACY
+        for _ in range(20):
+            epsilon, delta = sky_clearness(zenith, direct_normal, diffuse_horizontal, day_of_year)
+            diffuse_efficacy, direct_efficacy = luminous_efficacy(zenith, epsilon, delta)
+            direct_normal = np.divide(direct, direct_efficacy, out=np.zeros_like(direct), where=direct_efficacy > 0)
+            diffuse_horizontal = diffuse / diffuse_efficacy
+        diffuse_illuminance, direct_illuminance = diffuse, direct
+    else:
+        if mode == GendaylitMode.W:
+            direct_normal, diffuse_horizontal = direct, diffuse
+        elif mode == GendaylitMode.G:
+            direct_normal, diffuse_horizontal = direct / np.sin(altitude), diffuse
+        elif mode == GendaylitMode.E:
+            direct_normal, diffuse_horizontal = _erbs(direct, altitude, day_of_year)
+        else:
+            raise ValueError("unsupported gendaylit mode %s" % mode)
+        epsilon, delta = sky_clearness(zenith, direct_normal, diffuse_horizontal, day_of_year)
+        diffuse_efficacy, direct_efficacy = luminous_efficacy(zenith, epsilon, delta)
+        diffuse_illuminance = diffuse_horizontal * diffuse_efficacy
+        direct_illuminance = direct_normal * direct_efficacy
+    parameters = perez_parameters(zenith, epsilon, delta)
+
+    # scale the relative luminance to the diffuse horizontal illuminance, integrated over the Tregenza patches
+    tregenza = reinhart_patches(1, 1)
+    integral = _relative_luminance(tregenza.centers[1:], sun, parameters) @ (tregenza.centers[1:, 2] * tregenza.solid_angles[1:])
+    sky_scale = diffuse_illuminance / LUMINOUS_EFFICACY / integral
+    sun_radiance = direct_illuminance / LUMINOUS_EFFICACY / SUN_SOLID_ANGLE
+    zenith_luminance = _relative_luminance(np.array([[0.0, 0.0, 1.0]]), sun, parameters)[:, 0]
+    ground = ground_reflectance * (sky_scale * zenith_luminance * _ground_normalization(altitude, epsilon, direct_normal) +
+                                   6.8e-5 / np.pi * sun_radiance * np.sin(altitude))
+
+    # blend the sky and the ground brightness around the horizon like the gendaylit skyfunc
+    count, samples, _ = patches.directions.shape
+    directions = patches.directions.reshape(-1, 3)
+    dz = directions[:, 2] + 1.01
+    sky_weight = dz ** 10 / (dz ** 10 + dz ** -10)
+    values = _relative_luminance(directions, sun, parameters)
+    values *= sky_weight
+    values *= sky_scale[:, np.newaxis]
+    values += np.outer(ground, 1.0 - sky_weight)
+    if samples > 1:
+        values = values.reshape(-1, count, samples).mean(axis=2)
+
+    # spread the sun over the three nearest patches
+    cos_angle = sun @ patches.centers[1:].T
+    nearest = np.argpartition(-cos_angle, 3, axis=1)[:, :3]
+    rows = np.arange(sun.shape[0])[:, np.newaxis]
+    angle = np.arccos(np.minimum(cos_angle[rows, nearest], 1.0))
+    weight = 1.0 / (angle + 0.02)
+    weight /= weight.sum(axis=1, keepdims=True)
+    values[rows, nearest + 1] += weight * SUN_OMEGA / patches.solid_angles[nearest + 1] * sun_radiance[:, np.newaxis]
+
+    # the Perez gradation must decrease to the horizon, otherwise gendaylit gives an error sky
+    values[parameters[1] > 0.0] = 0.0
+    return values
+
+
+def sky_data_arrays(sky_data_list: List[SkyData], mode: GendaylitMode = GendaylitMode.W) -> Tuple[np.ndarray, ...]:
+    """Collect the fields of a mode from a list of SkyData.
+
+    Returns:
+        tuple[np.ndarray, ...]: altitude, azimuth, direct and diffuse arrays for "perez_sky_matrix".
+    """
+    fields = {
+        GendaylitMode.W: ("direct_normal_irradiance", "diffusion_horizonttal_irradiance"),
+        GendaylitMode.L: ("direct_normal_illuminance", "diffusion_horizonttal_illumiance"),
+        GendaylitMode.G: ("direct_horizontal_irradiance", "diffusion_horizonttal_irradiance"),
+        GendaylitMode.E: ("global_horizontal_irradiance", None),
+    }[mode]
+    altitude = np.array([sky_data.altitude for sky_data in sky_data_list], dtype=np.float64)
+    azimuth = np.array([sky_data.azimuth for sky_data in sky_data_list], dtype=np.float64)
+    direct = np.array([getattr(sky_data, fields[0]) or 0.0 for sky_data in sky_data_list], dtype=np.float64)
+    diffuse = np.array([getattr(sky_data, fields[1]) or 0.0 if fields[1] else 0.0 for sky_data in sky_data_list], dtype=np.float64)
+    return altitude, azimuth, direct, diffuse
+
+
+def perez_sky_vector(sky_data: SkyData, mode: GendaylitMode = GendaylitMode.W, min_altitude: float = 0.0) -> np.ndarray:
+    """Generate the sky vector of one SkyData.
+
+    Returns:
+        np.ndarray: sky vector with shape (2306, 3).
+    """
+    return perez_sky_matrix(*sky_data_arrays([sky_data], mode), mode=mode, min_altitude=min_altitude)[:, 0, :].copy()
+
+
+@dataclass
+class SkyTolerance:
+    # quantization steps of the sky key, 0 compares the exact values
+    altitude: float = 0.01
+    azimuth: float = 0.01
+    direct: float = 0.1
+    diffuse: float = 0.1
+
+
+class SkyVectorCache:
+
+    def __init__(self, tolerance: Optional[SkyTolerance] = None, max_items: int = 4096) -> None:
+        """LRU cache of sky vectors keyed by the quantized (altitude, azimuth, direct, diffuse, mode).
+
+        Skies that fall in the same quantization step share one vector, computed from the
+        center of the step, so the result does not depend on which sky came first. All dark
+        skies (below min_altitude or without light) share one key. Coarser tolerances give
+        more hits and less accurate skies, "hit_rate" shows the trade.
+
+        Args:
+            tolerance (SkyTolerance): quantization steps, see "SkyTolerance".
+            max_items (int): sky vectors kept, about 18 kB each.
+        """
+        self.tolerance = tolerance or SkyTolerance()
+        self.max_items = max_items
+        self.vectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "items": len(self.vectors)}
+
+    def _quantize(self, values: np.ndarray, step: float) -> np.ndarray:
+        if step <= 0:
+            return values
+        return np.round(values / step)
+
+    def _center(self, values: np.ndarray, step: float) -> np.ndarray:
+        return values if step <= 0 else values * step
+
+    def sky_matrix(self, altitude, azimuth, direct, diffuse=None, mode: GendaylitMode = GendaylitMode.W,
+                   min_altitude: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """The distinct skies of many time-steps, see "perez_sky_matrix" for the arguments.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: the sky matrix of the distinct skies (patches, skies, 3)
+                and the index of the sky of every time-step, e.g. lux[:, inverse] scatters results back.
+        """
+        tolerance = self.tolerance
+        altitude = np.atleast_1d(np.asarray(altitude, dtype=np.float64))
+        azimuth = np.broadcast_to(np.asarray(azimuth, dtype=np.float64), altitude.shape)
+        direct = np.broadcast_to(np.asarray(direct, dtype=np.float64), altitude.shape)
+        diffuse = np.broadcast_to(np.asarray(0.0 if diffuse is None else diffuse, dtype=np.float64), altitude.shape)
+        keys = np.stack([self._quantize(altitude, tolerance.altitude), self._quantize(azimuth, tolerance.azimuth),
+                         self._quantize(direct, tolerance.direct), self._quantize(diffuse, tolerance.diffuse)], axis=1)
+        # the same test as "perez_sky_matrix", every dark sky gets the key of the first row
+        dark = (altitude < min_altitude) | (altitude <= 0.0) | ((direct <= 0.0) & (diffuse <= 0.0))
+        keys[dark] = np.nan
+        keys = np.nan_to_num(keys, nan=-np.inf)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        unique_keys = [(mode.name,) + tuple(row) for row in unique.tolist()]
+        missing = [i for i, key in enumerate(unique_keys) if key not in self.vectors]
+        self.misses += len(missing)
+        self.hits += altitude.size - len(missing)
+        if missing:
+            rows = unique[missing]
+            computed = perez_sky_matrix(self._center(rows[:, 0], tolerance.altitude),
+                                        self._center(rows[:, 1], tolerance.azimuth),
+                                        self._center(rows[:, 2], tolerance.direct),
+                                        self._center(rows[:, 3], tolerance.diffuse), mode=mode)[:, :, 0]
+            # -inf rows are the dark sky
+            computed = np.where(np.isfinite(rows[:, 0]), computed, 0.0)
+            for column, i in enumerate(missing):
+                self.vectors[unique_keys[i]] = computed[:, column].copy()
+        vectors = []
+        for key in unique_keys:
+            self.vectors.move_to_end(key)
+            vectors.append(self.vectors[key])
+        # one sky per row, then transposed like "perez_sky_matrix"
+        sky = np.stack(vectors).T
+        while len(self.vectors) > self.max_items:
+            self.vectors.popitem(last=False)
+        return np.broadcast_to(sky[:, :, np.newaxis], sky.shape + (3,)), inverse
+
+    def sky_vector(self, sky_data: SkyData, mode: GendaylitMode = GendaylitMode.W, min_altitude: float = 0.0) -> np.ndarray:
+        """The sky vector of one SkyData, like "perez_sky_vector".
+
+        Returns:
+            np.ndarray: sky vector with shape (2306, 3).
+        """
+        sky, _ = self.sky_matrix(*sky_data_arrays([sky_data], mode), mode=mode, min_altitude=min_altitude)
+        return sky[:, 0, :].copy()
+
+
+# the inputs of the bundled skv files (altitude, azimuth, direct, diffuse) and the
+# allowed relative errors of the patches (median, max) and of the total.
+# 6_30_14 is the gendaylit call of "radiance_test". The others are 2005-06-30 of the
+# Shanghai epw, the sun of "weather.get_alt_az" at the hour; 6_30_10 and 6_30_18 take
+# the mean radiation of that hour and the next (328/697, 66/86 and 557/0, 30/13).
+# Like "radiance_test" the azimuth is passed as ephem gives it. The low sun of
+# 6_30_18 falls near a patch border, so its largest patch error is higher.
+SKV_CASES = [
+    ("6_30_10.skv", (62.68, 100.19, 512.5, 76.0), (0.03, 0.1, 0.02)),
+    ("6_30_12.skv", (81.76, 183.55, 757.0, 96.0), (0.03, 0.1, 0.02)),
+    ("6_30_14.skv", (61.68, 260.0, 758.0, 89.5), (0.03, 0.1, 0.02)),
+    ("6_30_18.skv", (11.46, 290.3, 278.5, 21.5), (0.03, 0.15, 0.02)),
+]
+
+
+def sky_test():
+    import os
+    import radfiles
+    from rmatrix import load_matrix
+    for name, inputs, (median_limit, max_limit, total_limit) in SKV_CASES:
+        skv = os.path.join(radfiles.radfiles_skv, name)
+        reference = load_matrix(skv)[:, 0, 0]
+        vector = perez_sky_vector(SkyData(*inputs))[:, 0]
+        error = np.abs(vector - reference) / reference
+        total = abs(vector.sum() - reference.sum()) / reference.sum()
+        print("%s median %.4f max %.4f total %.4f" % (name, np.median(error), error.max(), total))
+        assert np.median(error) < median_limit, "%s median error %.4f" % (name, np.median(error))
+        assert error.max() < max_limit, "%s max error %.4f" % (name, error.max())
+        assert total < total_limit, "%s total error %.4f" % (name, total)
+
+    for mode in GendaylitMode:
+        vector = perez_sky_vector(SkyData(45.0, 30.0, 500.0, 100.0, 50000.0, 15000.0, 350.0, 450.0), mode)
+        assert vector.shape == (2306, 3) and (vector >= 0).all() and vector.sum() > 0
+
+    count = 8760
+    altitude = np.linspace(-60.0, 80.0, count)
+    azimuth = np.linspace(-180.0, 180.0, count)
+    start = time.time()
+    matrix = perez_sky_matrix(altitude, azimuth, np.full(count, 600.0), np.full(count, 120.0))
+    print("%d time-steps %.3f s" % (count, time.time() - start), matrix.shape)
+
+    # exact keys give the same skies, with room for all of them the repeated year only hits the cache
+    cache = SkyVectorCache(SkyTolerance(0.0, 0.0, 0.0, 0.0), max_items=count)
+    unique, inverse = cache.sky_matrix(altitude, azimuth, np.full(count, 600.0), np.full(count, 120.0))
+    assert np.array_equal(unique[:, inverse, 0], matrix[:, :, 0])
+    misses = cache.misses
+    assert misses == unique.shape[1]
+    cache.sky_matrix(altitude, azimuth, np.full(count, 600.0), np.full(count, 120.0))
+    assert cache.misses == misses and cache.hits == 2 * count - misses
+    print("distinct skies %d" % unique.shape[1], cache.stats())
+
+
+if __name__ == "__main__":
+    sky_test()
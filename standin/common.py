@@ -0,0 +1,15 @@
+import os
+import sys
+
+# the stand-ins use the numpy implementations of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def fail(program: str, message: str) -> None:
+    sys.stderr.write("%s: %s\n" % (program, message))
+    sys.exit(1)
+
+
+def output_format(option: str) -> str:
+    # -of, -od, -oa like the Radiance tools
+    return {"f": "float", "d": "double", "a": "ascii"}.get(option[2:3], "ascii")
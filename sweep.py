@@ -0,0 +1,108 @@
+import numpy as np
+import radfiles
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence
+from radiance import ThreePhaseEngine, load_klems_xml, LUMINOUS_EFFICACY, RGB_WEIGHTS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+@dataclass
+class BSDFFamily:
+    # slat angles, None is the null angle
+    angles: list
+    # transmission matrices with shape (angles, 145, 145), see "load_klems_xml"
+    transmission: np.ndarray
+
+
+@dataclass
+class SweepResult:
+    # illuminance (lux) with shape (angles, timesteps, sensors)
+    values: np.ndarray
+    angles: list
+    times: Sequence
+    # vmx rows of the sensors
+    sensors: Sequence
+
+    def sel(self, angle) -> np.ndarray:
+        """Illuminance of one slat angle.
+
+        Returns:
+            np.ndarray: illuminance (lux) with shape (timesteps, sensors).
+        """
+        return self.values[self.angles.index(angle)]
+
+    def best_angle(self, target: Optional[float] = None) -> list:
+        """The slat angle of every time-step with the highest mean illuminance, or the
+        mean closest to target.
+
+        Returns:
+            list: one angle per time-step.
+        """
+        mean = self.values.mean(axis=2)
+        if target is None:
+            index = mean.argmax(axis=0)
+        else:
+            index = np.abs(mean - target).argmin(axis=0)
+        return [self.angles[i] for i in index]
+
+    def to_frame(self) -> "pd.DataFrame":
+        """The illuminance as a DataFrame indexed by (angle, time), one column per sensor.
+        """
+        import pandas as pd
+        index = pd.MultiIndex.from_product([["null" if angle is None else angle for angle in self.angles], self.times],
+                                           names=["angle", "time"])
+        return pd.DataFrame(self.values.reshape(-1, self.values.shape[2]), index=index, columns=self.sensors)
+
+
+def load_bsdf_family(angles: Optional[list] = None, xml_path: Callable = radfiles.get_type25_xml) -> BSDFFamily:
+    """Parse the Klems transmission matrices of a BSDF family once.
+
+    Args:
+        angles (list): slat angles, all available type25 angles by default.
+        xml_path (Callable): gives the xml file of an angle.
+
+    Returns:
+        BSDFFamily: the angles and the stacked transmission matrices.
+    """
+    if angles is None:
+        angles = radfiles.get_type25_angles()
+    transmission = np.stack([load_klems_xml(xml_path(angle)) for angle in angles])
+    return BSDFFamily(list(angles), transmission)
+
+
+def sweep_illuminance(engines: List[ThreePhaseEngine], family: BSDFFamily, sky_matrix: np.ndarray,
+                      times: Optional[Sequence] = None) -> SweepResult:
+    """Compute the illuminance of every slat angle and time-step in one batched contraction.
+
+    The window groups share the BSDF of the family, the xml of their IlluData is not used.
+    V and T are multiplied first, the three channels are stacked along the Klems axis, so
+    every angle costs one (sensors, 435) x (435, timesteps) product per group.
+
+    Args:
+        engines (list[ThreePhaseEngine]): one engine per window group, with the same sensors.
+        family (BSDFFamily): the BSDF family, see "load_bsdf_family".
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3) or a sky vector (2306, 3).
+        times (Sequence): labels of the time-steps, the indices by default.
+
+    Returns:
+        SweepResult: illuminance with shape (angles, timesteps, sensors).
+    """
+    if sky_matrix.ndim == 2:
+        sky_matrix = sky_matrix[:, np.newaxis, :]
+    weights = LUMINOUS_EFFICACY * np.array(RGB_WEIGHTS)
+    lux = 0.0
+    for engine in engines:
+        # (angles, sensors, 3 x 145)
+        view_transmission = np.concatenate([weights[channel] * (engine.view[:, :, channel] @ family.transmission)
+                                            for channel in range(3)], axis=2)
+        # (3 x 145, timesteps)
+        daylight_sky = np.concatenate([engine.daylight[:, :, channel] @ sky_matrix[:, :, channel]
+                                       for channel in range(3)], axis=0)
+        lux = lux + view_transmission @ daylight_sky
+    if times is None:
+        times = range(sky_matrix.shape[1])
+    # the vmx rows of an engine built with a sensor subset label the columns
+    sensors = engines[0].sensors.tolist() if engines[0].sensors is not None else range(engines[0].sensors_num)
+    return SweepResult(lux.transpose(0, 2, 1), family.angles, times, sensors)
@@ -0,0 +1,270 @@
+import os
+import mmap
+import time
+import tempfile
+import numpy as np
+import profiling
+from dataclasses import dataclass
+from typing import List, Optional
+from radiance import ThreePhaseEngine, LUMINOUS_EFFICACY, RGB_WEIGHTS, sensor_index
+
+# Annual illuminance under a memory budget. The V·T·D products of "annual_illuminance"
+# take sensors x 2306 x 3 values per group, too much for big grids, so the
+# product is taken in the order of the shared-memory sharding instead:
+#
+#   window (groups, 435, timesteps)  D·s of a block of time-steps, 435 = 3 x 145 Klems bins
+#   view   (groups, sensors, 435)    V·T of a block of sensors, read row by row from the vmx
+#   lux    = Σ view @ window         one tile of (sensors, timesteps)
+#
+# "plan_tiles" picks the largest blocks whose working arrays fit in the budget,
+# the time-steps are split first, since a smaller sensor block computes the D·s
+# products again. An output that does not fit is written to a file instead of
+# being kept in memory. The float32 path halves all the working arrays.
+
+# the time-steps are split down to a week before the sensors are split
+MIN_TIMESTEP_BLOCK = 168
+
+
+@dataclass
+class TilePlan:
+    sensor_block: int
+    timestep_block: int
+    dtype: str
+    # estimated bytes of the working arrays of one tile
+    tile_bytes: int
+    # the output is kept in memory, otherwise it is spilled to a file
+    output_in_memory: bool
+
+    @property
+    def tiles(self) -> str:
+        return "%d x %d" % (self.sensor_block, self.timestep_block)
+
+
+@dataclass
+class TiledRun:
+    # illuminance (lux) with shape (sensors, timesteps), a np.memmap when spilled
+    lux: np.ndarray
+    plan: TilePlan
+    seconds: float
+    # peak resident set size of the run in bytes, None when unknown
+    peak_rss: Optional[int]
+    # resident set size at the start, the sky matrix and the loaded modules
+    start_rss: Optional[int]
+    # file of a spilled output
+    spill_path: Optional[str] = None
+    # error of the float32 path, see "precision_delta"
+    precision: Optional[dict] = None
+
+    def report(self) -> str:
+        lines = ["tiles %s %s, %.1f MB per tile, output %s" % (
+            self.plan.tiles, self.plan.dtype, self.plan.tile_bytes / 1024 ** 2,
+            "in memory" if self.spill_path is None else "spilled to %s" % self.spill_path),
+            "%.2f s, peak rss %s" % (self.seconds, "unknown" if self.start_rss is None else "%.1f MB (%+.1f MB over the start)" % (
+                self.peak_rss / 1024 ** 2, (self.peak_rss - self.start_rss) / 1024 ** 2))]
+        if self.precision is not None:
+            lines.append("float32 max error %.2e mean error %.2e" % (self.precision["max_error"], self.precision["mean_error"]))
+        return "\n".join(lines)
+
+
+def tile_bytes(sensor_block: int, timestep_block: int, groups: int, itemsize: int, channels: int = 3,
+               klems: int = 145, patches: int = 2306) -> int:
+    """Estimated bytes of the working arrays of one tile, see "tiled_illuminance".
+    """
+    fixed = groups * (klems * patches * 3 + klems * klems) * itemsize
+    # the vmx rows as read and in dtype, the V·T of every group and the channels before they are stacked
+    view = sensor_block * klems * 3 * (8 + itemsize) + (groups + 1) * sensor_block * 3 * klems * itemsize
+    sky = patches * timestep_block * channels * itemsize
+    window = (3 * klems * timestep_block + klems * timestep_block) * itemsize
+    lux = 2 * sensor_block * timestep_block * itemsize
+    return fixed + view + sky + window + lux
+
+
+def plan_tiles(sensors: int, timesteps: int, groups: int, memory_budget: int, dtype=np.float64,
+               grey: bool = False, out_given: bool = False) -> TilePlan:
+    """The largest blocks of sensors and time-steps that fit in a memory budget.
+
+    Args:
+        sensors (int): number of sensors.
+        timesteps (int): number of time-steps.
+        groups (int): number of window groups.
+        memory_budget (int): bytes of the working arrays and of an output kept in memory.
+        dtype: float64 or float32 compute path.
+        grey (bool): the sky matrix has one channel.
+        out_given (bool): the caller provides the output array.
+
+    Raises:
+        MemoryError: not even a tile of one sensor and one time-step fits.
+
+    Returns:
+        TilePlan: the blocks.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    channels = 1 if grey else 3
+    output = 0 if out_given else sensors * timesteps * itemsize
+    smallest = tile_bytes(min(sensors, 256), min(timesteps, MIN_TIMESTEP_BLOCK), groups, itemsize, channels)
+    in_memory = not out_given and output + smallest <= memory_budget
+    available = memory_budget - (output if in_memory else 0)
+    sensor_block, timestep_block = sensors, timesteps
+    while tile_bytes(sensor_block, timestep_block, groups, itemsize, channels) > available:
+        if timestep_block > MIN_TIMESTEP_BLOCK:
+            timestep_block = max((timestep_block + 1) // 2, MIN_TIMESTEP_BLOCK)
+        elif sensor_block > 1:
+            sensor_block = (sensor_block + 1) // 2
+        elif timestep_block > 1:
+            timestep_block = (timestep_block + 1) // 2
+        else:
+            raise MemoryError("a budget of %d bytes is too small, one tile needs %d bytes" % (
+                memory_budget, tile_bytes(1, 1, groups, itemsize, channels)))
+    return TilePlan(sensor_block, timestep_block, np.dtype(dtype).name,
+                    tile_bytes(sensor_block, timestep_block, groups, itemsize, channels), in_memory or out_given)
+
+
+def _view_rows(engine: ThreePhaseEngine, start: int, stop: int) -> np.ndarray:
+    # rows of the view matrix, only the block is read unless it is already loaded
+    if engine._view is not None:
+        return engine._view[start:stop]
+    rows = range(start, stop) if engine.sensors is None else engine.sensors[start:stop]
+    with profiling.stage("matrix_load_rows"):
+        return sensor_index(engine.illu_data.vmx).read(rows)
+
+
+def _spill_array(path: str, shape: tuple, dtype: np.dtype):
+    with open(path, "wb+") as file:
+        file.truncate(max(int(np.prod(shape)) * dtype.itemsize, 1))
+        buffer = mmap.mmap(file.fileno(), 0)
+    return buffer, np.ndarray(shape, dtype=dtype, buffer=buffer)
+
+
+def tiled_illuminance(engines: List[ThreePhaseEngine], sky_matrix: np.ndarray, memory_budget: int, dtype=np.float64,
+                      out: Optional[np.ndarray] = None, spill_path: Optional[str] = None,
+                      check_precision: bool = False) -> TiledRun:
+    """"annual_illuminance" computed tile by tile within a memory budget.
+
+    The budget covers the working arrays and the output, not the sky matrix passed
+    in, which can itself be a np.memmap. An output that does not fit is written to
+    spill_path and returned as a read-only np.memmap.
+
+    Args:
+        engines (list[ThreePhaseEngine]): one engine per window group, with the same sensors.
+        sky_matrix (np.ndarray): sky matrix with shape (2306, timesteps, 3).
+        memory_budget (int): bytes, e.g. 2 * 1024 ** 3.
+        dtype: np.float32 halves the memory and speeds up the products, see "precision_delta".
+        out (np.ndarray): array with shape (sensors, timesteps) the tiles are written to,
+            e.g. a np.memmap, instead of a new one.
+        spill_path (str): file of an output that does not fit, a temporary file by default.
+        check_precision (bool): with float32, measure the error against float64 on a sample of time-steps.
+
+    Raises:
+        MemoryError: the budget is too small for a tile of one sensor and one time-step.
+
+    Returns:
+        TiledRun: the illuminance, the plan, the time and the peak RSS of the run.
+    """
+    start_time = time.perf_counter()
+    # right after the reset the peak is the current resident set size
+    start_rss = profiling.peak_rss() if profiling.reset_peak_rss() else None
+    dtype = np.dtype(dtype)
+    grey = np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 1]) and \
+        np.array_equal(sky_matrix[:, :, 0], sky_matrix[:, :, 2])
+    channels = 1 if grey else 3
+    sensors, timesteps = engines[0].sensors_num, sky_matrix.shape[1]
+    plan = plan_tiles(sensors, timesteps, len(engines), memory_budget, dtype, grey, out_given=out is not None)
+    buffer = None
+    if out is None and plan.output_in_memory:
+        out = np.empty((sensors, timesteps), dtype=dtype)
+    elif out is None:
+        if spill_path is None:
+            handle, spill_path = tempfile.mkstemp(suffix=".lux")
+            os.close(handle)
+        buffer, out = _spill_array(spill_path, (sensors, timesteps), dtype)
+    weights = (LUMINOUS_EFFICACY * np.array(RGB_WEIGHTS)).astype(dtype)
+    daylight = [np.asarray(engine.daylight, dtype=dtype) for engine in engines]
+    transmission = [np.asarray(engine.transmission, dtype=dtype) for engine in engines]
+    for sensor_start in range(0, sensors, plan.sensor_block):
+        sensor_stop = min(sensor_start + plan.sensor_block, sensors)
+        view = []
+        for engine, matrix in zip(engines, transmission):
+            rows = np.asarray(_view_rows(engine, sensor_start, sensor_stop), dtype=dtype)
+            view.append(np.concatenate([weights[channel] * (rows[:, :, channel] @ matrix) for channel in range(3)], axis=1))
+            del rows
+        for time_start in range(0, timesteps, plan.timestep_block):
+            time_stop = min(time_start + plan.timestep_block, timesteps)
+            sky = np.asarray(sky_matrix[:, time_start:time_stop, :channels], dtype=dtype)
+            with profiling.stage("multiply_tiled"):
+                lux = np.zeros((sensor_stop - sensor_start, time_stop - time_start), dtype=dtype)
+                for matrix, rows in zip(daylight, view):
+                    window = np.concatenate([matrix[:, :, channel] @ sky[:, :, min(channel, channels - 1)]
+                                             for channel in range(3)], axis=0)
+                    lux += rows @ window
+                out[sensor_start:sensor_stop, time_start:time_stop] = lux
+            del sky, lux
+            if buffer is not None and hasattr(mmap, "MADV_DONTNEED"):
+                # the written pages are unmapped, a shared mapping keeps them in the page cache and the file
+                buffer.madvise(mmap.MADV_DONTNEED)
+    if buffer is not None:
+        del out
+        buffer.flush()
+        buffer.close()
+        out = np.memmap(spill_path, dtype=dtype, mode="r", shape=(sensors, timesteps))
+    run = TiledRun(out, plan, time.perf_counter() - start_time, profiling.peak_rss(), start_rss,
+                   spill_path if buffer is not None else None)
+    if check_precision and dtype == np.float32:
+        run.precision = precision_delta(engines, sky_matrix, memory_budget=memory_budget)
+    return run
+
+
+def precision_delta(engines: List[ThreePhaseEngine], sky_matrix: np.ndarray, samples: int = 48,
+                    memory_budget: int = 1024 ** 3) -> dict:
+    """Relative error of the float32 path against float64 on a sample of the daylight time-steps.
+
+    Returns:
+        dict: the largest and the mean relative error over the sensors that get light,
+            and the time-steps compared.
+    """
+    lit = np.flatnonzero(np.logical_or.reduce([np.any(sky_matrix[:, :, channel] != 0, axis=0) for channel in range(3)]))
+    if lit.size == 0:
+        return {"max_error": 0.0, "mean_error": 0.0, "timesteps": []}
+    chosen = lit[np.linspace(0, lit.size - 1, min(samples, lit.size)).astype(int)]
+    sky = np.ascontiguousarray(sky_matrix[:, chosen])
+    reference = np.asarray(tiled_illuminance(engines, sky, memory_budget, np.float64).lux)
+    single = np.asarray(tiled_illuminance(engines, sky, memory_budget, np.float32).lux, dtype=np.float64)
+    bright = reference > 1e-3 * reference.max()
+    error = np.abs(single - reference)[bright] / reference[bright]
+    return {"max_error": float(error.max()), "mean_error": float(error.mean()), "timesteps": chosen.tolist()}
+
+
+def tiling_test():
+    plan = plan_tiles(20000, 8760, 4, 512 * 1024 ** 2)
+    assert plan.tile_bytes <= 512 * 1024 ** 2 and not plan.output_in_memory
+    assert plan_tiles(100, 24, 1, 1024 ** 3).tiles == "100 x 24"
+    try:
+        plan_tiles(100, 24, 4, 1024 ** 2)
+    except MemoryError as error:
+        print(error)
+    else:
+        raise AssertionError("a 1 MB budget was planned")
+    import radfiles
+    from radiance import IlluData, annual_illuminance
+    from rmatrix import write_matrix
+    with tempfile.TemporaryDirectory() as directory:
+        # the repository has no vmx, a random one like those of "benchmark.py" stands in
+        vmx = os.path.join(directory, "sensors_400.vmx")
+        write_matrix(vmx, np.random.default_rng(400).random((400, 145, 3)) * 1e-3, "float")
+        engines = [ThreePhaseEngine(IlluData(dmx=radfiles.dmx_south, xml=radfiles.xml_angle_null, vmx=vmx))]
+        sky = np.random.default_rng(0).random((2306, 400, 3))
+        reference = annual_illuminance(engines, sky)
+        # new engines, so that the tiles read the vmx rows instead of the loaded view matrix
+        engines = [ThreePhaseEngine(engine.illu_data) for engine in engines]
+        run = tiled_illuminance(engines, sky, 64 * 1024 ** 2, np.float32, check_precision=True)
+        print(run.report())
+        assert np.allclose(run.lux, reference, rtol=1e-4)
+        run = tiled_illuminance(engines, sky, 24 * 1024 ** 2)
+        print(run.report())
+        assert run.plan.timestep_block < 400
+        assert np.allclose(run.lux, reference, rtol=1e-12)
+        if run.spill_path is not None:
+            os.remove(run.spill_path)
+
+
+if __name__ == "__main__":
+    tiling_test()
@@ -1,140 +1,367 @@
-from pyepw.epw import EPW, WeatherData, Location
-from dataclasses import dataclass
-import math
-import datetime
-import ephem
-import pvlib
-import pytz
-
-@dataclass
-class EpWeatherData:
-    year: int
-    month: int
-    day: int
-    hour: int
-    minute: int
-    dry_bulb_temperature: float
-    relative_humidity: float
-    global_horizontal_radiation: float
-    direct_normal_radiation: float
-    diffuse_horizontal_radiation: float
-    global_horizontal_illuminance: float
-    direct_normal_illuminance: float
-    diffuse_horizontal_illuminance: float
-    zenith_luminance: float
-    wind_speed: float
-    wind_direction: float
-
-def get_alt_az(lon, lat, height, year, month, day, hour, minute, second, timezone:str="Asia/Shanghai"):
-    """
-    get the altitude and azimuth of sun by the longitude, latitude and time
-    the time must be Greenwich time of the local
-    :param lon: longitude
-    :param lat: latitude
-    :param height: sea level height
-    :param year: year
-    :param month: month
-    :param day: day
-    :param hour: hour
-    :param minute: minute
-    :param second: second
-    :return: return the azimuth and latitude
-    """
-    # trans local time to UTC
-    loacal_time = datetime.datetime(year, month, day, hour, minute, second)
-    local_tz = pytz.timezone(timezone)
-    local_time = local_tz.localize(loacal_time)
-    utc_time = loacal_time.astimezone(pytz.UTC)
-
-    # date = date.strftime("%Y/%m/%d %H:%M:%S")
-    # print(date)
-    # sun = ephem.Sun()
-    ga_tech = ephem.Observer()
-    ga_tech.lon = str(lon)
-    ga_tech.lat = str(lat)
-    ga_tech.elevation = height
-    ga_tech.date = utc_time
-    # sun.compute(ga_tech)
-    sun = ephem.Sun(ga_tech)
-    # repr() 方法可以将读取到的格式字符，比如换行符、制表符，转化为其相应的转义字符
-    sun_altitude = float(repr(sun.alt))* 180.0/math.pi 
-    sun_azimuth = float(repr(sun.az))* 180.0/math.pi 
-    return sun_altitude, sun_azimuth
-
-class EpWeather:
-    
-    def __init__(self, file_path:str) -> None:
-        """Read epw weather files.
-
-        Args:
-            file_path (str): epw file path
-        """
-        self.file_path = file_path
-        self.epw_data = EPW()
-        self.epw_data.read(self.file_path)
-        self.weather_data = self.epw_data.weatherdata
-        self.max_len = len(self.weather_data)
-        # time interval between two weather data.
-        d1, d2 = self.weather_data[0], self.weather_data[1] 
-        self.interval = (d2.hour - d1.hour) * 60 + (d2.minute - d1.minute) 
-        self.count = 0
-        self.weather_dict = {}
-        self.year = self.weather_data[0].year
-        for item in self.weather_data:
-            year = item.year
-            month = item.month
-            day = item.day
-            hour = item.hour
-            minute = item.minute
-
-            year_dict = self.weather_dict.setdefault(year, {})
-            month_dict = year_dict.setdefault(month, {})
-            day_dict = month_dict.setdefault(day, {})
-            hour_dict = day_dict.setdefault(hour, {})
-
-            hour_dict[minute] = item
-            
-
-    @property
-    def location(self) -> Location:
-        """Get location data dictionary object.
-
-        Returns:
-            Object of type Location or None if not yet set
-
-        """
-        return self.epw_data.location
-    
-    def get_weather(self, month, day, hour, minute=0, year=None) -> EpWeatherData:
-        """Get weather data by date time
-
-        Args:
-            month (int): int
-            day (int): int
-            hour (int): int
-        """
-        if year is None:
-            year = self.year
-        weather: WeatherData = self.weather_dict[year][month][day][hour][minute]
-        # add weather by your need, it only contain a part of the whole weather data.
-        data_dict = EpWeatherData(
-            year = year,
-            month = month,
-            day = day,
-            hour = hour,
-            minute = minute,
-            dry_bulb_temperature = weather.dry_bulb_temperature,
-            relative_humidity = weather.relative_humidity,
-            global_horizontal_radiation = weather.global_horizontal_radiation,
-            direct_normal_radiation = weather.direct_normal_radiation,
-            diffuse_horizontal_radiation =weather.diffuse_horizontal_radiation,
-            global_horizontal_illuminance = weather.global_horizontal_illuminance,
-            direct_normal_illuminance = weather.direct_normal_illuminance,
-            diffuse_horizontal_illuminance = weather.diffuse_horizontal_illuminance,
-            zenith_luminance = weather.zenith_luminance,
-            wind_speed = weather.wind_speed,
-            wind_direction = weather.wind_direction,
-        )
-        return data_dict
-
+from pyepw.epw import EPW, WeatherData, Location
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, Tuple
+import math
+import os
+import datetime
+import numpy as np
+import ephem
+import pytz
+import profiling
+
+# pandas and pvlib take most of the import time, they are imported by the
+# functions that need them, the columns and the cached solar positions do not
+if TYPE_CHECKING:
+    import pandas as pd
+
+@dataclass
+class EpWeatherData:
+    year: int
+    month: int
+    day: int
+    hour: int
+    minute: int
+    dry_bulb_temperature: float
+    relative_humidity: float
+    global_horizontal_radiation: float
+    direct_normal_radiation: float
+    diffuse_horizontal_radiation: float
+    global_horizontal_illuminance: float
+    direct_normal_illuminance: float
+    diffuse_horizontal_illuminance: float
+    zenith_luminance: float
+    wind_speed: float
+    wind_direction: float
+
+# the fields of an epw data line, named like pyepw.epw.WeatherData
+EPW_FIELDS = (
+    "year", "month", "day", "hour", "minute", "data_source_and_uncertainty_flags", "dry_bulb_temperature",
+    "dew_point_temperature", "relative_humidity", "atmospheric_station_pressure", "extraterrestrial_horizontal_radiation",
+    "extraterrestrial_direct_normal_radiation", "horizontal_infrared_radiation_intensity", "global_horizontal_radiation",
+    "direct_normal_radiation", "diffuse_horizontal_radiation", "global_horizontal_illuminance", "direct_normal_illuminance",
+    "diffuse_horizontal_illuminance", "zenith_luminance", "wind_direction", "wind_speed", "total_sky_cover",
+    "opaque_sky_cover", "visibility", "ceiling_height", "present_weather_observation", "present_weather_codes",
+    "precipitable_water", "aerosol_optical_depth", "snow_depth", "days_since_last_snowfall", "albedo",
+    "liquid_precipitation_depth", "liquid_precipitation_quantity",
+)
+EPW_TIME_FIELDS = ("year", "month", "day", "hour", "minute")
+EPW_TEXT_FIELDS = ("data_source_and_uncertainty_flags", "present_weather_codes")
+# the lines before the weather data
+EPW_HEADER_LINES = 8
+
+
+def read_epw_columns(file_path: str) -> Tuple[list, dict]:
+    """Read an epw file into one numpy array per field.
+
+    Args:
+        file_path (str): epw file path
+
+    Returns:
+        tuple[list, dict]: header lines and the columns named by EPW_FIELDS.
+    """
+    with profiling.stage("epw_parse") as record, open(file_path, "r", encoding="utf-8", errors="ignore") as file:
+        header = [file.readline().rstrip("\r\n") for _ in range(EPW_HEADER_LINES)]
+        dtype = {name: str for name in EPW_TEXT_FIELDS}
+        dtype.update({name: np.int64 for name in EPW_TIME_FIELDS})
+        import pandas as pd
+        frame = pd.read_csv(file, header=None, names=EPW_FIELDS, usecols=range(len(EPW_FIELDS)), dtype=dtype)
+        record.count(bytes_read=os.path.getsize(file_path))
+    columns = {}
+    for name in EPW_FIELDS:
+        if name in EPW_TEXT_FIELDS:
+            columns[name] = frame[name].fillna("").to_numpy(dtype=str)
+        elif name in EPW_TIME_FIELDS:
+            columns[name] = frame[name].to_numpy()
+        else:
+            columns[name] = frame[name].to_numpy(dtype=np.float64)
+    return header, columns
+
+
+def load_epw_columns(file_path: str, use_cache: bool = True) -> Tuple[list, dict]:
+    """Read an epw file with a binary npz cache saved next to it.
+
+    The cache records the size and the modification time of the epw file and
+    is rebuilt when they change.
+
+    Args:
+        file_path (str): epw file path
+        use_cache (bool): read and write the cache file "<file_path>.npz".
+
+    Returns:
+        tuple[list, dict]: header lines and the columns named by EPW_FIELDS.
+    """
+    stat = os.stat(file_path)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cache_path = file_path + ".npz"
+    if use_cache and os.path.exists(cache_path):
+        with profiling.stage("epw_cache_load") as record, np.load(cache_path) as cache:
+            if np.array_equal(cache["source"], source):
+                record.count(bytes_read=os.path.getsize(cache_path))
+                return list(cache["header"]), {name: cache[name] for name in EPW_FIELDS}
+    header, columns = read_epw_columns(file_path)
+    if use_cache:
+        try:
+            np.savez(cache_path, source=source, header=np.array(header), **columns)
+        except OSError:
+            # e.g. a read-only weather directory, the cache is optional
+            pass
+    return header, columns
+
+
+def get_alt_az(lon, lat, height, year, month, day, hour, minute, second, timezone:str="Asia/Shanghai"):
+    """
+    get the altitude and azimuth of sun by the longitude, latitude and time
+    the time must be Greenwich time of the local
+    :param lon: longitude
+    :param lat: latitude
+    :param height: sea level height
+    :param year: year
+    :param month: month
+    :param day: day
+    :param hour: hour
+    :param minute: minute
+    :param second: second
+    :return: return the azimuth and latitude
+    """
+    # trans local time to UTC
+    loacal_time = datetime.datetime(year, month, day, hour, minute, second)
+    local_tz = pytz.timezone(timezone)
+    local_time = local_tz.localize(loacal_time)
+    utc_time = loacal_time.astimezone(pytz.UTC)
+
+    # date = date.strftime("%Y/%m/%d %H:%M:%S")
+    # print(date)
+    # sun = ephem.Sun()
+    ga_tech = ephem.Observer()
+    ga_tech.lon = str(lon)
+    ga_tech.lat = str(lat)
+    ga_tech.elevation = height
+    ga_tech.date = utc_time
+    # sun.compute(ga_tech)
+    with profiling.stage("sun_position"):
+        sun = ephem.Sun(ga_tech)
+    # repr() 方法可以将读取到的格式字符，比如换行符、制表符，转化为其相应的转义字符
+    sun_altitude = float(repr(sun.alt))* 180.0/math.pi 
+    sun_azimuth = float(repr(sun.az))* 180.0/math.pi 
+    return sun_altitude, sun_azimuth
+
+def get_alt_az_array(lon, lat, height, times, timezone=8.0) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the altitude and azimuth of the sun for many times at once.
+
+    The NREL SPA of pvlib is evaluated with numpy, so a whole year costs about
+    as much as a few calls of "get_alt_az".
+
+    Args:
+        lon (float): longitude, east positive.
+        lat (float): latitude, north positive.
+        height (float): sea level height.
+        times (array_like): local times, datetimes or a pandas DatetimeIndex.
+        timezone (float | str): utc offset in hours like Location.timezone, or a pytz name.
+            Ignored when the times are timezone aware.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: apparent altitude and azimuth (from north to east) in degrees.
+    """
+    import pandas as pd
+    import pvlib
+    times = pd.DatetimeIndex(times)
+    if times.tz is None:
+        if isinstance(timezone, str):
+            times = times.tz_localize(timezone)
+        else:
+            times = times.tz_localize(pytz.FixedOffset(round(timezone * 60)))
+    with profiling.stage("sun_position_array"):
+        position = pvlib.solarposition.get_solarposition(times, lat, lon, altitude=height)
+    return position["apparent_elevation"].to_numpy(), position["azimuth"].to_numpy()
+
+
+class EpWeather:
+    
+    def __init__(self, file_path:str, use_cache: bool = True) -> None:
+        """Read epw weather files.
+
+        The weather data are kept as columns, "data" is a pandas DataFrame with a
+        DatetimeIndex built on the first use. The index is the end of every epw hour,
+        hour 24 is 00:00 of the next day, so all hours of February are
+        weather.data.loc["2005-02-01 01:00":"2005-03-01 00:00"].
+
+        Args:
+            file_path (str): epw file path
+            use_cache (bool): keep a binary copy of the data next to the epw file, see "load_epw_columns".
+        """
+        self.file_path = file_path
+        self.header, self.columns = load_epw_columns(file_path, use_cache)
+        self.max_len = len(self.columns["year"])
+        # time interval between two weather data.
+        hour, minute = self.columns["hour"], self.columns["minute"]
+        self.interval = int((hour[1] - hour[0]) * 60 + (minute[1] - minute[0]))
+        self.count = 0
+        self.year = int(self.columns["year"][0])
+        self._data = None
+        # position of every (year, month, day, hour, minute)
+        self.positions = {key: i for i, key in enumerate(zip(*[self.columns[name].tolist() for name in EPW_TIME_FIELDS]))}
+        self._epw_data = None
+        self._location = None
+
+    @property
+    def data(self) -> "pd.DataFrame":
+        """The columns as a DataFrame indexed by "get_times", built on the first use.
+        """
+        if self._data is None:
+            import pandas as pd
+            self._data = pd.DataFrame(self.columns, index=self.get_times())
+        return self._data
+
+    @property
+    def epw_data(self) -> EPW:
+        """The pyepw object of the file, parsed on the first use.
+        """
+        if self._epw_data is None:
+            self._epw_data = EPW()
+            self._epw_data.read(self.file_path)
+        return self._epw_data
+
+    @property
+    def weather_data(self) -> list:
+        """The pyepw WeatherData of every line, parsed on the first use.
+        """
+        return self.epw_data.weatherdata
+
+    @property
+    def location(self) -> Location:
+        """Get location data dictionary object.
+
+        Returns:
+            Object of type Location or None if not yet set
+
+        """
+        if self._location is None:
+            self._location = Location()
+            self._location.read(self.header[0].split(",")[1:])
+        return self._location
+    
+    def select(self, month=None, day=None, hour=None) -> "pd.DataFrame":
+        """Select weather data by date fields, e.g. select(month=2) are all hours of February.
+
+        Args:
+            month (int | list[int]): months, all by default.
+            day (int | list[int]): days, all by default.
+            hour (int | list[int]): hours, all by default.
+
+        Returns:
+            pd.DataFrame: the selected rows of "data".
+        """
+        mask = np.ones(self.max_len, dtype=bool)
+        for name, value in (("month", month), ("day", day), ("hour", hour)):
+            if value is not None:
+                mask &= np.isin(self.columns[name], value)
+        return self.data[mask]
+
+    def write_wea(self, file_path:str) -> None:
+        """Write the direct normal and diffuse horizontal radiation to a wea file for gendaymtx.
+
+        The hours are written as they are in the epw file, like radfiles/weather/CHN_ShanghaiCSWD.wea.
+
+        Args:
+            file_path (str): wea file path
+        """
+        location = self.location
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write("place %s_%s\n" % (location.city, location.country))
+            file.write("latitude %s\n" % location.latitude)
+            # radiance measures the longitude and time zone west positive
+            file.write("longitude %s\n" % -location.longitude)
+            file.write("time_zone %d\n" % round(-location.timezone * 15))
+            file.write("site_elevation %s\n" % location.elevation)
+            file.write("weather_data_file_units 1\n")
+            columns = self.columns
+            hours = columns["hour"] + columns["minute"] / 60.0
+            for row in zip(columns["month"], columns["day"], hours, columns["direct_normal_radiation"], columns["diffuse_horizontal_radiation"]):
+                file.write("%d %d %.3f %g %g\n" % row)
+
+    def get_times(self, year=None, shift: float = 0.0) -> "pd.DatetimeIndex":
+        """Local times of all weather data.
+
+        Args:
+            year (int): replace the year of the epw file, e.g. to match a simulation year.
+            shift (float): hours added to every time, e.g. -0.5 for the middle of the hour.
+
+        Returns:
+            pd.DatetimeIndex: one time per weather data, hours are used as they are like "get_weather".
+        """
+        import pandas as pd
+        if year is None:
+            year = self.year
+        dates = pd.to_datetime({"year": np.full(self.max_len, year), "month": self.columns["month"], "day": self.columns["day"]})
+        offsets = self.columns["hour"] * 60 + self.columns["minute"]
+        return pd.DatetimeIndex(dates + pd.to_timedelta(offsets, unit="min") + pd.Timedelta(hours=shift))
+
+    def get_alt_az(self, height: Optional[float] = None, year=None, shift: float = 0.0, cache_dir: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Solar altitude and azimuth of all weather data, see "get_alt_az_array".
+
+        The time zone, longitude, latitude and elevation are taken from the epw location.
+
+        Args:
+            height (float): sea level height, the epw elevation by default.
+            year (int): replace the year of the epw file.
+            shift (float): hours added to every time.
+            cache_dir (str): directory of the solar position cache, the computation is skipped when
+                the same site and year were computed before.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: altitude and azimuth in degrees, one value per weather data.
+        """
+        location = self.location
+        if height is None:
+            height = location.elevation
+        if year is None:
+            year = self.year
+        cache_path = None
+        if cache_dir is not None:
+            name = "sun_%.4f_%.4f_%g_%g_%d_%d_%g.npz" % (location.latitude, location.longitude, location.timezone,
+                                                        height, year, self.max_len, shift)
+            cache_path = os.path.join(cache_dir, name)
+            if os.path.exists(cache_path):
+                with np.load(cache_path) as cache:
+                    return cache["altitude"], cache["azimuth"]
+        times = self.get_times(year=year, shift=shift)
+        altitude, azimuth = get_alt_az_array(location.longitude, location.latitude, height, times, location.timezone)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, altitude=altitude, azimuth=azimuth)
+        return altitude, azimuth
+
+    def get_weather(self, month, day, hour, minute=0, year=None) -> EpWeatherData:
+        """Get weather data by date time
+
+        Args:
+            month (int): int
+            day (int): int
+            hour (int): int
+        """
+        if year is None:
+            year = self.year
+        i = self.positions[(year, month, day, hour, minute)]
+        columns = self.columns
+        # add weather by your need, it only contain a part of the whole weather data.
+        data_dict = EpWeatherData(
+            year = year,
+            month = month,
+            day = day,
+            hour = hour,
+            minute = minute,
+            dry_bulb_temperature = float(columns["dry_bulb_temperature"][i]),
+            relative_humidity = float(columns["relative_humidity"][i]),
+            global_horizontal_radiation = float(columns["global_horizontal_radiation"][i]),
+            direct_normal_radiation = float(columns["direct_normal_radiation"][i]),
+            diffuse_horizontal_radiation = float(columns["diffuse_horizontal_radiation"][i]),
+            global_horizontal_illuminance = float(columns["global_horizontal_illuminance"][i]),
+            direct_normal_illuminance = float(columns["direct_normal_illuminance"][i]),
+            diffuse_horizontal_illuminance = float(columns["diffuse_horizontal_illuminance"][i]),
+            zenith_luminance = float(columns["zenith_luminance"][i]),
+            wind_speed = float(columns["wind_speed"][i]),
+            wind_direction = float(columns["wind_direction"][i]),
+        )
+        return data_dict
+
         
\ No newline at end of file